@@ -1,14 +1,71 @@
 from flask import Flask, render_template
 import argparse
+import logging
+import threading
 import requests
+from time import monotonic
 
 app = Flask(__name__)
 arguments = None
+cam_directory = None
+
+
+class CameraDirectory:
+    """
+    NVR camera list cached for ttl seconds.
+    Expired list is served while one background thread refreshes it,
+    requests wait for NVR only when there is no list at all.
+    """
+
+    def __init__(self, url, token, ttl=60, timeout=10):
+        self.url = url
+        self.headers = {"key": token}
+        self.ttl = ttl
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.lock = threading.Lock()
+        self.fetch_lock = threading.Lock()
+        self.cams = None
+        self.updated = 0
+        self.refreshing = False
+
+    def get_cams(self):
+        with self.lock:
+            if self.cams is not None:
+                if monotonic() - self.updated > self.ttl and not self.refreshing:
+                    self.refreshing = True
+                    threading.Thread(target=self.background_refresh, daemon=True).start()
+                return self.cams
+
+        with self.fetch_lock:
+            if self.cams is None:
+                self.refresh()
+            return self.cams
+
+    def background_refresh(self):
+        try:
+            with self.fetch_lock:
+                self.refresh()
+        except requests.RequestException as e:
+            logging.warning(f'Can not refresh camera list from NVR: {e}')
+        finally:
+            with self.lock:
+                self.refreshing = False
+
+    def refresh(self):
+        response = self.session.get(self.url, headers=self.headers, timeout=self.timeout)
+        response.raise_for_status()
+        cams = response.json()
+        with self.lock:
+            self.cams = cams
+            self.updated = monotonic()
 
 
 def get_arguments():
     parser = argparse.ArgumentParser()
     parser.add_argument("--nvr-token", help="NVR api token", required=True)
+    parser.add_argument("--nvr-url", help="NVR camera list url", default='https://nvr.miem.hse.ru/api/sources/')
+    parser.add_argument("--nvr-cache-ttl", help="Seconds to use cached NVR camera list", type=float, default=60)
     parser.add_argument("-p", "--port", help="Server port", default=443)
     parser.add_argument("--ssl-key", help="Path to ssl key")
     parser.add_argument("--ssl-cert", help="Path to ssl certificate")
@@ -17,15 +74,12 @@ def get_arguments():
 
 @app.route("/")
 def home():
-    headers = {"key": arguments.nvr_token}
-    response = requests.get('https://nvr.miem.hse.ru/api/sources/',
-                            headers=headers)
-    cams = response.json()
-    cams.append({'id': 'test','name': 'test'})
+    cams = cam_directory.get_cams() + [{'id': 'test', 'name': 'test'}]
     return render_template("index.html", cams=cams)
 
 
 if __name__ == "__main__":
     arguments = get_arguments()
+    cam_directory = CameraDirectory(arguments.nvr_url, arguments.nvr_token, ttl=arguments.nvr_cache_ttl)
     ssl_context = (arguments.ssl_cert, arguments.ssl_key)
-    app.run(host='0.0.0.0', port=arguments.port, ssl_context=ssl_context)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=arguments.port, ssl_context=ssl_context)
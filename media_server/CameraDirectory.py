@@ -0,0 +1,102 @@
+import asyncio
+import logging
+from time import monotonic
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, ClientError
+
+from Metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+NVR_FETCH_SECONDS = Histogram('nvr_fetch_seconds', 'NVR camera list request duration')
+NVR_FETCH_ERRORS = Counter('nvr_fetch_errors_total', 'Failed NVR camera list requests')
+
+
+class CameraDirectoryError(Exception):
+    pass
+
+
+class CameraDirectory:
+    """
+    In-process cache of the NVR camera list.
+    Fresh data is served for ttl seconds. After that the cached list is still
+    served while a single background request revalidates it. Only when the cache
+    is older than max_stale (or empty) requests wait for the NVR.
+    If the NVR is down the last known list is served no matter how old it is.
+    """
+
+    def __init__(self, url, token, ttl=60, max_stale=3600, timeout=10):
+        self.__url = url
+        self.__headers = {"key": token}
+        self.__ttl = ttl
+        self.__max_stale = max_stale
+        self.__timeout = ClientTimeout(total=timeout)
+        self.__session = None
+        self.__cams = None
+        self.__index = {}
+        self.__updated = 0
+        self.__retry_at = 0
+        self.__refreshing = None
+
+    async def get_cams(self):
+        """
+        Returned list is shared by all callers and must not be modified
+        """
+        await self.__ensure_fresh()
+        return self.__cams
+
+    async def get_cam(self, cam_id):
+        await self.__ensure_fresh()
+        return self.__index.get(str(cam_id))
+
+    async def close(self):
+        if self.__refreshing is not None:
+            self.__refreshing.cancel()
+        if self.__session is not None:
+            await self.__session.close()
+            self.__session = None
+
+    async def __ensure_fresh(self):
+        now = monotonic()
+        if self.__cams is not None and now < self.__retry_at:
+            return
+
+        age = now - self.__updated
+        if self.__cams is None or age > self.__max_stale:
+            await asyncio.shield(self.__refresh())
+        elif age > self.__ttl:
+            self.__refresh()
+
+    def __refresh(self):
+        if self.__refreshing is None:
+            self.__refreshing = asyncio.ensure_future(self.__fetch())
+            self.__refreshing.add_done_callback(self.__on_refreshed)
+        return self.__refreshing
+
+    def __on_refreshed(self, task):
+        self.__refreshing = None
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f'Can not refresh camera list from NVR: {task.exception()}')
+
+    async def __fetch(self):
+        if self.__session is None:
+            self.__session = ClientSession(connector=TCPConnector(limit=4), timeout=self.__timeout)
+
+        started = monotonic()
+        try:
+            async with self.__session.get(self.__url, headers=self.__headers) as resp:
+                resp.raise_for_status()
+                cams = await resp.json(content_type=None)
+        except (ClientError, asyncio.TimeoutError, ValueError) as e:
+            NVR_FETCH_ERRORS.inc()
+            if self.__cams is not None:
+                logger.warning(f'NVR is not available, serving cached camera list: {e}')
+                self.__retry_at = monotonic() + self.__ttl
+                return
+            raise CameraDirectoryError(f'Can not get camera list from NVR: {e}') from e
+        finally:
+            NVR_FETCH_SECONDS.observe(monotonic() - started)
+
+        self.__cams = cams
+        self.__index = {str(cam['id']): cam for cam in cams}
+        self.__updated = monotonic()
@@ -0,0 +1,271 @@
+import asyncio
+import base64
+import hashlib
+import logging
+import os
+import re
+from time import monotonic
+from urllib.parse import urlparse, unquote
+
+from CameraDirectory import CameraDirectoryError
+from Metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+HEALTH_PROBES = Counter('camera_health_probes_total', 'RTSP DESCRIBE probes of cameras by result', ['result'])
+HEALTH_PROBE_SECONDS = Histogram('camera_health_probe_seconds', 'RTSP DESCRIBE probe duration')
+
+AVAILABLE = 'available'
+UNAUTHORIZED = 'unauthorized'
+UNREACHABLE = 'unreachable'
+ERROR = 'error'
+
+
+class InvalidURL(ValueError):
+    pass
+
+
+def md5_hex(text):
+    return hashlib.md5(text.encode()).hexdigest()
+
+
+def rtsp_authorization(challenges, method, uri, login, password):
+    """
+    :param challenges:
+        WWW-Authenticate header values of 401 response
+    :return:
+        Authorization header value or None if no challenge scheme is supported
+    """
+    schemes = {}
+    for challenge in challenges:
+        scheme, _, params = challenge.partition(' ')
+        schemes[scheme.lower()] = params
+
+    if 'digest' in schemes:
+        fields = dict(re.findall(r'(\w+)="?([^",]*)"?', schemes['digest']))
+        realm, nonce = fields.get('realm', ''), fields.get('nonce', '')
+        ha1, ha2 = md5_hex(f'{login}:{realm}:{password}'), md5_hex(f'{method}:{uri}')
+        header = f'Digest username="{login}", realm="{realm}", nonce="{nonce}", uri="{uri}"'
+        if 'opaque' in fields:
+            header += f', opaque="{fields["opaque"]}"'
+        if 'auth' in [qop.strip() for qop in fields.get('qop', '').split(',')]:
+            # a single request per nonce, the nonce count is always 1
+            nc, cnonce = '00000001', os.urandom(8).hex()
+            response = md5_hex(f'{ha1}:{nonce}:{nc}:{cnonce}:auth:{ha2}')
+            return header + f', qop=auth, nc={nc}, cnonce="{cnonce}", response="{response}"'
+        return header + f', response="{md5_hex(f"{ha1}:{nonce}:{ha2}")}"'
+    if 'basic' in schemes:
+        return 'Basic ' + base64.b64encode(f'{login}:{password}'.encode()).decode()
+    return None
+
+
+async def rtsp_request(host, port, lines):
+    """
+    Sends a single RTSP request on a new connection
+    :return:
+        (status code, list of (header name in lower case, value))
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode())
+        await writer.drain()
+        status_line = (await reader.readline()).decode(errors='replace').split()
+        if len(status_line) < 2 or not status_line[0].startswith('RTSP/'):
+            raise ValueError(f'Not an RTSP response: {" ".join(status_line)[:100]}')
+        headers = []
+        while True:
+            line = (await reader.readline()).decode(errors='replace').strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            headers.append((name.strip().lower(), value.strip()))
+        return int(status_line[1]), headers
+    finally:
+        writer.close()
+
+
+async def rtsp_describe(url):
+    """
+    Sends RTSP DESCRIBE like a player would, authenticating with url credentials if the camera asks
+    :return:
+        RTSP status code of the last response
+    """
+    parsed = urlparse(url)
+    if not parsed.hostname:
+        raise InvalidURL(f'No host in {url}')
+    host = f'[{parsed.hostname}]' if ':' in parsed.hostname else parsed.hostname
+    uri = parsed._replace(netloc=host if parsed.port is None else f'{host}:{parsed.port}').geturl()
+    lines = [f'DESCRIBE {uri} RTSP/1.0', 'CSeq: 1', 'Accept: application/sdp', 'User-Agent: media-server']
+
+    port = parsed.port or 554
+    status, headers = await rtsp_request(parsed.hostname, port, lines)
+    if status == 401 and parsed.username:
+        challenges = [value for name, value in headers if name == 'www-authenticate']
+        authorization = rtsp_authorization(challenges, 'DESCRIBE', uri, unquote(parsed.username),
+                                           unquote(parsed.password or ''))
+        if authorization is not None:
+            lines[1] = 'CSeq: 2'
+            status, _ = await rtsp_request(parsed.hostname, port, lines + [f'Authorization: {authorization}'])
+    return status
+
+
+class CameraHealth:
+    __slots__ = ('url', 'state', 'error', 'latency', 'checked', 'last_seen')
+
+    def __init__(self, url):
+        self.url = url
+        self.state = None
+        self.error = None
+        self.latency = None
+        self.checked = None
+        self.last_seen = None
+
+    @property
+    def available(self):
+        return self.state == AVAILABLE
+
+    def to_json(self):
+        now = monotonic()
+        return {
+            'state': self.state,
+            'error': self.error,
+            'latency_ms': round(self.latency * 1000, 1) if self.latency is not None else None,
+            'checked_seconds_ago': round(now - self.checked, 1) if self.checked is not None else None,
+            'last_seen_seconds_ago': round(now - self.last_seen, 1) if self.last_seen is not None else None,
+        }
+
+
+class CameraHealthMonitor:
+    """
+    Health table of NVR cameras filled by RTSP DESCRIBE probes in background.
+    All rtsp cameras of the directory are probed every interval seconds, at most concurrency at once,
+    so offers read camera state from the table instead of connecting to the camera themselves.
+    A camera missing from the table, or not probed for max_age seconds, is probed on demand once.
+    """
+
+    def __init__(self, directory, interval=30, concurrency=16, timeout=5, max_age=None, owns=None):
+        """
+        :param directory:
+            CameraDirectory
+        :param owns:
+            callable telling whether camera id is served by this process, all cameras by default
+        """
+        self.__directory = directory
+        self.__interval = interval
+        self.__concurrency = concurrency
+        self.__timeout = timeout
+        self.__max_age = max_age if max_age is not None else 3 * interval
+        self.__owns = owns
+        self.__semaphore = None
+        self.__health = {}
+        self.__probing = {}
+        self.__task = None
+
+    @property
+    def table(self):
+        return dict(self.__health)
+
+    def states(self):
+        counts = {}
+        for health in self.__health.values():
+            counts[(health.state,)] = counts.get((health.state,), 0) + 1
+        return counts
+
+    def get(self, cam_id, url):
+        """
+        :return:
+            CameraHealth of camera or None if it is unknown or outdated
+        """
+        health = self.__health.get(str(cam_id))
+        if health is None or health.url != url or monotonic() - health.checked > self.__max_age:
+            return None
+        return health
+
+    async def ensure(self, cam_id, url):
+        return self.get(cam_id, url) or await self.check(cam_id, url)
+
+    async def check(self, cam_id, url):
+        """
+        Probes camera now, concurrent calls for the same camera share one probe
+        """
+        cam_id = str(cam_id)
+        if cam_id not in self.__probing:
+            self.__probing[cam_id] = asyncio.ensure_future(self.__probe(cam_id, url))
+        return await asyncio.shield(self.__probing[cam_id])
+
+    def forget(self, cam_id):
+        """
+        Makes the next ensure() probe camera, e.g. after its stream failed to open
+        """
+        self.__health.pop(str(cam_id), None)
+
+    async def start(self):
+        self.__task = asyncio.ensure_future(self.__run())
+
+    async def close(self):
+        if self.__task is not None:
+            self.__task.cancel()
+        for future in self.__probing.values():
+            future.cancel()
+
+    async def __run(self):
+        while True:
+            try:
+                cams = await self.__directory.get_cams()
+            except CameraDirectoryError as e:
+                logger.warning(f'Can not get cameras to probe: {e}')
+            else:
+                await self.__probe_all(cams)
+            await asyncio.sleep(self.__interval)
+
+    async def __probe_all(self, cams):
+        cams = {str(cam['id']): cam['rtsp'] for cam in cams
+                if cam.get('rtsp') and urlparse(cam['rtsp']).scheme == 'rtsp'
+                and (self.__owns is None or self.__owns(cam['id']))}
+        for cam_id in set(self.__health) - set(cams):
+            del self.__health[cam_id]
+
+        started = monotonic()
+        results = await asyncio.gather(*(self.check(cam_id, url) for cam_id, url in cams.items()))
+        available = sum(1 for health in results if health.available)
+        logger.info(f'Probed {len(results)} cameras in {monotonic() - started:.1f}s, {available} available')
+
+    async def __probe(self, cam_id, url):
+        if self.__semaphore is None:
+            self.__semaphore = asyncio.Semaphore(self.__concurrency)
+
+        health = self.__health.get(cam_id)
+        if health is None or health.url != url:
+            health = CameraHealth(url)
+        try:
+            async with self.__semaphore:
+                started = monotonic()
+                try:
+                    status = await asyncio.wait_for(rtsp_describe(url), self.__timeout)
+                except InvalidURL:
+                    health.state, health.error = ERROR, 'rtsp link has no host. Contact NVR admins to fix it'
+                except asyncio.TimeoutError:
+                    health.state, health.error = UNREACHABLE, 'Can not establish connection with rtsp media source'
+                except (OSError, ValueError) as e:
+                    health.state = UNREACHABLE
+                    health.error = f'Can not establish connection with rtsp media source: {e}'
+                else:
+                    health.latency = monotonic() - started
+                    health.last_seen = monotonic()
+                    HEALTH_PROBE_SECONDS.observe(health.latency)
+                    if status == 200:
+                        health.state, health.error = AVAILABLE, None
+                    elif status in (401, 403):
+                        health.state = UNAUTHORIZED
+                        health.error = 'rtsp stream requires authentication. Contact NVR admins to fix the link'
+                    else:
+                        health.state, health.error = ERROR, f'rtsp media source responded with status {status}'
+                health.checked = monotonic()
+        finally:
+            self.__probing.pop(cam_id, None)
+
+        HEALTH_PROBES.labels(health.state).inc()
+        if health.state != AVAILABLE:
+            logger.debug(f'Camera {cam_id} is {health.state}: {health.error}')
+        self.__health[cam_id] = health
+        return health
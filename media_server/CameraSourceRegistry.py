@@ -0,0 +1,466 @@
+import asyncio
+import logging
+from collections import deque
+from functools import partial
+
+from aiortc import MediaStreamTrack
+from aiortc.contrib.media import MediaPlayer
+from aiortc.mediastreams import MediaStreamError
+
+from FrameTracer import TRACER, SOURCE, DECODE, KEYFRAME
+from H264Passthrough import AudioPacketTrack, H264PacketTrack, PacketDecoder, copy_packet
+from Metrics import Counter
+from RenditionLadder import Rendition, RenditionEncoder, rendition_name
+
+logger = logging.getLogger(__name__)
+
+SOURCE_FRAMES = Counter('camera_source_frames_total', 'Frames read from camera sources', ['camera', 'kind'])
+VIEWER_FRAMES_DROPPED = Counter('viewer_frames_dropped_total', 'Frames dropped because a viewer did not keep up',
+                                ['camera', 'kind'])
+
+
+# probing of a passthrough camera opened again, its parameter sets are known already
+REPROBE_OPTIONS = {'analyzeduration': '200000', 'probesize': '32768'}
+
+
+class CameraSourceError(Exception):
+    pass
+
+
+class SubscriberTrack(MediaStreamTrack):
+    """
+    Track handed to a single peer connection.
+    It keeps only a couple of pending frames, so a slow viewer
+    drops its own old frames instead of holding back the others.
+    """
+
+    def __init__(self, shared_track, queue_size, keyframe_resync=False, backlog=()):
+        """
+        :param keyframe_resync:
+            items are encoded packets depending on previous ones, after dropping
+            a packet the following ones are dropped up to the next keyframe
+        :param backlog:
+            frames received before subscription returned first, so the viewer starts without waiting
+        """
+        super().__init__()
+        self.kind = shared_track.kind
+        self.__shared_track = shared_track
+        self.__queue = asyncio.Queue(maxsize=queue_size)
+        self.__backlog = deque(self.__retime_backlog(backlog) if keyframe_resync else backlog)
+        self.__keyframe_resync = keyframe_resync
+        # packets before the first keyframe can not be decoded
+        self.__waiting_keyframe = keyframe_resync and not backlog
+
+    def put_frame(self, frame):
+        if self.__keyframe_resync and frame is not None:
+            if self.__waiting_keyframe and not frame.is_keyframe:
+                self.__shared_track.frames_dropped.inc()
+                return
+            self.__waiting_keyframe = False
+
+        if self.__queue.full():
+            if self.__keyframe_resync:
+                self.__shared_track.frames_dropped.inc(self.__queue.qsize())
+                while not self.__queue.empty():
+                    self.__queue.get_nowait()
+                if frame is not None and not frame.is_keyframe:
+                    self.__waiting_keyframe = True
+                    self.__shared_track.frames_dropped.inc()
+                    return
+            else:
+                self.__queue.get_nowait()
+                self.__shared_track.frames_dropped.inc()
+        self.__queue.put_nowait(frame)
+
+    async def recv(self):
+        if self.readyState != 'live':
+            raise MediaStreamError
+
+        if self.__backlog:
+            return self.__backlog.popleft()
+        frame = await self.__queue.get()
+        if frame is None:
+            self.stop()
+            raise MediaStreamError
+        return frame
+
+    def stop(self):
+        super().stop()
+        self.__shared_track.unsubscribe(self)
+
+    @staticmethod
+    def __retime_backlog(backlog):
+        """
+        Cached GOP is sent in a burst, with its own timestamps a receiver would play it out in real time
+        and stay up to a GOP behind live. Packets are moved right before the latest one,
+        one time base tick apart, so the GOP is decoded at once and live packets follow in time.
+        """
+        if len(backlog) < 2 or any(packet.pts is None for packet in backlog):
+            return backlog
+        latest = backlog[-1].pts
+        retimed = []
+        for i, packet in enumerate(backlog[:-1]):
+            packet = copy_packet(packet)
+            packet.pts = packet.dts = latest - (len(backlog) - 1 - i)
+            retimed.append(packet)
+        return retimed + [backlog[-1]]
+
+
+class SharedTrack:
+    """
+    Reads a single track and fans every frame out to subscribers.
+    A new video subscriber gets the latest frame right away, or the packets since the last keyframe
+    for tracks of encoded packets, instead of waiting for the camera next frame or keyframe.
+    """
+
+    def __init__(self, cam_id, track, queue_size, kind=None, name=None, keyframe_resync=False, gop_cache_size=0,
+                 trace_stage=None, trace_after=None):
+        """
+        :param track:
+            MediaStreamTrack read until the source is closed, or callable creating a track when
+            the first subscriber arrives, such a track is stopped when the last subscriber leaves
+        :param name:
+            kind label of metrics, kind of track by default
+        :param gop_cache_size:
+            max packets kept since the last keyframe, a longer GOP is not cached
+        :param trace_stage:
+            FrameTracer stage of frames read, without trace_after frames are sampled for tracing here
+        """
+        self.kind = kind or track.kind
+        self.cam_id = cam_id
+        self.trace_stage = trace_stage
+        self.__trace_after = trace_after
+        self.frames = SOURCE_FRAMES.labels(cam_id, name or self.kind)
+        self.frames_dropped = VIEWER_FRAMES_DROPPED.labels(cam_id, name or self.kind)
+        self.__factory = track if callable(track) else None
+        self.__track = None if callable(track) else track
+        self.__queue_size = queue_size
+        self.__keyframe_resync = keyframe_resync
+        self.__gop_cache_size = gop_cache_size
+        self.__backlog = []
+        self.__subscribers = set()
+        self.__task = None
+        self.ended = False
+
+    @property
+    def subscribers(self):
+        return len(self.__subscribers)
+
+    @property
+    def track(self):
+        """
+        Track being read, None while a track created on demand is not needed
+        """
+        return self.__track
+
+    def start(self):
+        if self.__task is None:
+            if self.__track is None:
+                self.__track = self.__factory()
+            self.__task = asyncio.ensure_future(self.__run())
+
+    def subscribe(self, prime=True):
+        """
+        :param prime:
+            start from the latest frame or cached GOP instead of the next frame
+        """
+        subscriber = SubscriberTrack(self, self.__queue_size, self.__keyframe_resync,
+                                     self.__backlog if prime else ())
+        self.__subscribers.add(subscriber)
+        self.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self.__subscribers.discard(subscriber)
+        if not self.__subscribers and self.__factory is not None and self.__task is not None:
+            self.__task.cancel()
+            self.__task = None
+            self.__track.stop()
+            self.__track = None
+            self.__backlog = []
+
+    def stop(self):
+        if self.__task is not None:
+            self.__task.cancel()
+        if self.__track is not None:
+            self.__track.stop()
+        self.__backlog = []
+        self.ended = True
+
+    def __remember(self, frame):
+        if not self.__keyframe_resync:
+            if self.kind == 'video':
+                self.__backlog = [frame]
+        elif frame.is_keyframe:
+            self.__backlog = [frame] if self.__gop_cache_size > 0 else []
+        elif self.__backlog:
+            if len(self.__backlog) < self.__gop_cache_size:
+                self.__backlog.append(frame)
+            else:
+                self.__backlog = []
+
+    async def __run(self):
+        while True:
+            try:
+                frame = await self.__track.recv()
+            except MediaStreamError:
+                frame = None
+                self.__backlog = []
+            else:
+                self.frames.inc()
+                self.__remember(frame)
+                if self.trace_stage is not None:
+                    if self.__trace_after is None:
+                        TRACER.sample(self.cam_id, frame.pts, self.trace_stage)
+                    else:
+                        TRACER.stamp(self.cam_id, frame.pts, self.trace_stage, after=self.__trace_after)
+
+            for subscriber in list(self.__subscribers):
+                subscriber.put_frame(frame)
+
+            if frame is None:
+                self.ended = True
+                break
+
+
+class CameraSource:
+    """
+    One RTSP session to a camera shared by every viewer of this camera.
+    In passthrough mode video is read as h264 packets, and frames are decoded
+    only while somebody needs them: all of them for transcoded viewers (video)
+    or keyframes only for classification and snapshots (keyframes).
+    """
+
+    def __init__(self, cam_id, url, player, queue_size, passthrough=False, packet_queue_size=60, renditions=(),
+                 gop_cache_size=300, parameter_sets=None):
+        """
+        :param renditions:
+            heights of camera renditions, None is the camera size, forwarded as is in passthrough mode
+        :param gop_cache_size:
+            max packets since the last keyframe kept for new viewers of packet tracks
+        :param parameter_sets:
+            h264 SPS and PPS of the camera known from its previous source
+        """
+        self.cam_id = cam_id
+        self.url = url
+        self.refs = 0
+        self.player = player
+        # MediaPlayer(decode=False) reads encoded audio, it is sent by the camera codec or not at all
+        self.audio_packet_track = AudioPacketTrack(player.audio) if passthrough and player.audio else None
+        self.audio = SharedTrack(cam_id, self.audio_packet_track or player.audio, queue_size) \
+            if player.audio else None
+        if self.audio is not None:
+            # MediaPlayer queues every audio frame without limit, read them even if nobody listens
+            self.audio.start()
+        if passthrough:
+            self.packet_track = H264PacketTrack(player.video, parameter_sets)
+            self.packets = SharedTrack(cam_id, self.packet_track, packet_queue_size, name='packets',
+                                       keyframe_resync=True, gop_cache_size=gop_cache_size, trace_stage=SOURCE)
+            # read right away to learn the codec profile before the first offer needs it
+            self.packets.start()
+            self.video = SharedTrack(cam_id, lambda: PacketDecoder(self.packets.subscribe()), queue_size,
+                                     kind='video', name='decoded', trace_stage=DECODE, trace_after=SOURCE)
+            self.keyframes = SharedTrack(cam_id, lambda: PacketDecoder(self.packets.subscribe(), keyframes_only=True),
+                                         queue_size, kind='video', name='keyframes', trace_stage=KEYFRAME,
+                                         trace_after=SOURCE)
+        else:
+            self.packet_track = None
+            self.packets = None
+            # MediaPlayer hands frames over decoded, they are traced from decoding on
+            self.video = SharedTrack(cam_id, player.video, queue_size, trace_stage=DECODE) if player.video else None
+            self.keyframes = self.video
+
+        self.renditions = []
+        for height in renditions:
+            name = rendition_name(height)
+            if height is None and self.packets is not None:
+                self.renditions.append(Rendition(name, self.packets))
+            elif self.video is not None:
+                encoder = partial(self.__rendition_encoder, height)
+                self.renditions.append(Rendition(name, SharedTrack(cam_id, encoder, packet_queue_size, kind='video',
+                                                                   name=name, keyframe_resync=True,
+                                                                   gop_cache_size=gop_cache_size,
+                                                                   trace_stage=f'encode {name}', trace_after=DECODE)))
+        self.close_handle = None
+
+    @property
+    def ended(self):
+        tracks = [t for t in (self.audio, self.packets or self.video) if t is not None]
+        return not tracks or all(t.ended for t in tracks)
+
+    async def wait_codec(self, timeout):
+        """
+        :return:
+            h264 profile-level-id of passthrough video or None if it is unknown in timeout seconds
+        """
+        if self.packet_track is None:
+            return None
+        try:
+            await asyncio.wait_for(self.packet_track.codec_ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.packet_track.profile_level_id
+
+    async def wait_audio_codec(self, timeout):
+        """
+        :return:
+            RTCRtpCodecCapability to send passthrough audio by, None if it can not be sent as is
+            or is unknown in timeout seconds
+        """
+        if self.audio_packet_track is None:
+            return None
+        try:
+            await asyncio.wait_for(self.audio_packet_track.codec_ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.audio_packet_track.codec
+
+    async def close(self):
+        if self.close_handle is not None:
+            self.close_handle.cancel()
+            self.close_handle = None
+        # the last stopped MediaPlayer track joins the player thread, which may wait for a stalled camera
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.__stop_player)
+        for track in {self.audio, self.packets, self.video, self.keyframes} - {None}:
+            track.stop()
+        for rendition in self.renditions:
+            rendition.packets.stop()
+
+    def __stop_player(self):
+        for track in (self.player.audio, self.player.video):
+            if track is not None:
+                track.stop()
+
+    def __rendition_encoder(self, height):
+        return RenditionEncoder(self.video.subscribe(), height)
+
+
+class CameraSourceRegistry:
+    """
+    Opens every camera source once and counts who is using it.
+    A source without users is kept open for idle_timeout seconds,
+    so page reloads and quick reconnects do not reopen the rtsp stream.
+    H264 parameter sets of passthrough cameras outlive their sources, a camera opened
+    again is probed briefly and its codec is known before the first keyframe.
+    """
+
+    def __init__(self, idle_timeout=10, queue_size=2, player_options=None, passthrough=False, renditions=(),
+                 gop_cache_size=300):
+        """
+        :param player_options:
+            MediaPlayer keyword arguments, e.g. {'options': {'probesize': '500000'}}
+        :param passthrough:
+            read h264 video without decoding it, see CameraSource
+        :param renditions:
+            heights of rendition ladder of every camera, see CameraSource
+        """
+        self.__renditions = renditions
+        self.__gop_cache_size = gop_cache_size
+        self.__parameter_sets = {}
+        self.__idle_timeout = idle_timeout
+        self.__passthrough = passthrough
+        self.__queue_size = queue_size
+        self.__player_options = player_options or {}
+        self.__sources = {}
+        self.__opening = {}
+        self.__closing = set()
+
+    @property
+    def sources(self):
+        return dict(self.__sources)
+
+    def is_live(self, cam_id):
+        """
+        Whether camera source is open and still streaming
+        """
+        source = self.__sources.get(cam_id)
+        return source is not None and not source.ended
+
+    async def acquire(self, cam_id, url, timeout=None):
+        """
+        :param timeout:
+            seconds to wait for the source to open, it goes on opening for the next users after that
+        :raise CameraSourceError:
+            if the source can not be opened or is not open in timeout seconds
+        """
+        source = self.__sources.get(cam_id)
+        if source is None or source.ended:
+            if cam_id not in self.__opening:
+                self.__opening[cam_id] = asyncio.ensure_future(self.__open(cam_id, url))
+            try:
+                source = await asyncio.wait_for(asyncio.shield(self.__opening[cam_id]), timeout)
+            except asyncio.TimeoutError:
+                raise CameraSourceError(f'Source for camera {cam_id} is not open in {timeout} seconds')
+
+        source.refs += 1
+        if source.close_handle is not None:
+            source.close_handle.cancel()
+            source.close_handle = None
+        return source
+
+    def release(self, source):
+        source.refs -= 1
+        if source.refs > 0:
+            return
+
+        loop = asyncio.get_event_loop()
+        source.close_handle = loop.call_later(self.__idle_timeout, self.__close_idle, source)
+
+    async def close(self):
+        for source in self.__sources.values():
+            self.__close_source(source)
+        self.__sources.clear()
+        await asyncio.gather(*self.__closing)
+
+    async def __open(self, cam_id, url):
+        logger.info(f'Opening source for camera {cam_id}')
+        loop = asyncio.get_event_loop()
+        try:
+            # av.open blocks until the stream is probed, keep it off the event loop
+            player = await loop.run_in_executor(
+                None, partial(MediaPlayer, url, decode=not self.__passthrough, **self.__open_options(cam_id)))
+            passthrough = self.__passthrough and player.video is not None
+            if self.__passthrough and not passthrough:
+                logger.info(f'Camera {cam_id} video can not be passed through, decoding it')
+                player = await loop.run_in_executor(None, partial(MediaPlayer, url, **self.__player_options))
+        except Exception as e:
+            raise CameraSourceError(f'Can not open media source for camera {cam_id}: {e}') from e
+        finally:
+            self.__opening.pop(cam_id, None)
+
+        old_source = self.__sources.get(cam_id)
+        if old_source is not None:
+            self.__close_source(old_source)
+
+        source = CameraSource(cam_id, url, player, self.__queue_size, passthrough=passthrough,
+                              renditions=self.__renditions, gop_cache_size=self.__gop_cache_size,
+                              parameter_sets=self.__parameter_sets.get(cam_id))
+        self.__sources[cam_id] = source
+        # closed as idle unless acquired, users that gave up waiting for it do not release it
+        source.close_handle = loop.call_later(self.__idle_timeout, self.__close_idle, source)
+        return source
+
+    def __close_idle(self, source):
+        source.close_handle = None
+        if source.refs > 0:
+            return
+
+        logger.info(f'Closing idle source for camera {source.cam_id}')
+        self.__close_source(source)
+        if self.__sources.get(source.cam_id) is source:
+            del self.__sources[source.cam_id]
+
+    def __close_source(self, source):
+        if source.packet_track is not None and source.packet_track.parameter_sets is not None:
+            self.__parameter_sets[source.cam_id] = source.packet_track.parameter_sets
+        closing = asyncio.ensure_future(source.close())
+        self.__closing.add(closing)
+        closing.add_done_callback(self.__closing.discard)
+
+    def __open_options(self, cam_id):
+        if not self.__passthrough or cam_id not in self.__parameter_sets:
+            return self.__player_options
+        # stream parameters are not needed to forward packets, and the decoder gets them from SPS
+        options = {**self.__player_options.get('options', {}), **REPROBE_OPTIONS}
+        return {**self.__player_options, 'options': options}
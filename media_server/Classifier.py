@@ -0,0 +1,388 @@
+import logging
+import threading
+from time import time
+
+import av
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# ResNet50 "caffe" preprocessing: BGR channel order, ImageNet mean subtracted, no scaling
+IMAGENET_BGR_MEAN = np.array([103.939, 116.779, 123.68], dtype=np.float32)
+
+
+class PreprocessSpec:
+    """
+    Input a model expects: size, channel order, layout and normalization (pixel - mean) / std
+    """
+
+    def __init__(self, size=(224, 224), bgr=False, mean=(0, 0, 0), std=None, layout='nhwc'):
+        self.size = tuple(size)
+        self.bgr = bgr
+        self.mean = np.array(mean, dtype=np.float32)
+        self.scale = None if std is None else 1 / np.array(std, dtype=np.float32)
+        self.layout = layout
+
+    def resized(self, size):
+        spec = PreprocessSpec(size, self.bgr, self.mean, None, self.layout)
+        spec.scale = self.scale
+        return spec
+
+    def to_json(self):
+        return {
+            'size': self.size,
+            'channels': 'bgr' if self.bgr else 'rgb',
+            'mean': self.mean.tolist(),
+            'std': None if self.scale is None else (1 / self.scale).tolist(),
+            'layout': self.layout,
+        }
+
+
+PREPROCESSING = {
+    # keras resnet50 and vgg
+    'caffe': PreprocessSpec(bgr=True, mean=IMAGENET_BGR_MEAN),
+    # keras mobilenet and most tflite models, pixels scaled to [-1, 1]
+    'tf': PreprocessSpec(mean=(127.5, 127.5, 127.5), std=(127.5, 127.5, 127.5)),
+    # torchvision models exported to onnx, ImageNet mean and std of [0, 1] pixels
+    'torch': PreprocessSpec(mean=(123.675, 116.28, 103.53), std=(58.395, 57.12, 57.375), layout='nchw'),
+}
+
+
+class ModelNotReady(Exception):
+    pass
+
+
+class LazyModel:
+    """
+    Holds a model that is loaded in a background thread,
+    so heavy imports and weight loading never delay the server start.
+    """
+    NOT_LOADED = 'not_loaded'
+    LOADING = 'loading'
+    READY = 'ready'
+    FAILED = 'failed'
+
+    def __init__(self, load, retry_interval=60):
+        """
+        :param load:
+            callable returning loaded model, called in background thread
+        :param retry_interval:
+            seconds to wait before loading again after a failure
+        """
+        self.__load = load
+        self.__retry_interval = retry_interval
+        self.__lock = threading.Lock()
+        self.__model = None
+        self.state = self.NOT_LOADED
+        self.error = None
+        self.load_started = None
+        self.load_seconds = None
+
+    @property
+    def ready(self):
+        return self.state == self.READY
+
+    def ensure_loading(self):
+        with self.__lock:
+            if self.state in (self.LOADING, self.READY):
+                return
+            if self.state == self.FAILED and time() - self.load_started < self.__retry_interval:
+                return
+            self.state = self.LOADING
+            self.load_started = time()
+        threading.Thread(target=self.__run, name='model-loader', daemon=True).start()
+
+    def get(self):
+        if not self.ready:
+            self.ensure_loading()
+            raise ModelNotReady(f'Model is {self.state}')
+        return self.__model
+
+    def status(self):
+        return {
+            'state': self.state,
+            'error': str(self.error) if self.error else None,
+            'load_seconds': self.load_seconds,
+        }
+
+    def __run(self):
+        logger.info('Loading model')
+        try:
+            model = self.__load()
+        except Exception as e:
+            logger.exception('Model loading failed')
+            with self.__lock:
+                self.error = e
+                self.state = self.FAILED
+            return
+
+        with self.__lock:
+            self.__model = model
+            self.error = None
+            self.load_seconds = time() - self.load_started
+            self.state = self.READY
+        logger.info(f'Model loaded in {self.load_seconds:.1f}s')
+
+
+class FramePreprocessor:
+    """
+    Turns decoded frames into a model input batch without intermediate full size images.
+    libav scales and converts every frame straight to a small rgb24 picture, which is
+    written into a preallocated float32 batch buffer and normalized in place.
+    Every thread gets its own buffer, the returned batch is valid until the next call in the same thread.
+    """
+
+    def __init__(self, batch_size, spec=PREPROCESSING['caffe']):
+        self.__batch_size = batch_size
+        self.__spec = spec
+        self.__local = threading.local()
+
+    def __call__(self, frames):
+        """
+        :param frames:
+            list of av.VideoFrame or PIL images
+        :return:
+            float32 array of shape (len(frames), height, width, 3), or (len(frames), 3, height, width)
+            for nchw layout
+        """
+        spec = self.__spec
+        width, height = spec.size
+        buffer = getattr(self.__local, 'buffer', None)
+        if buffer is None or len(buffer) < len(frames):
+            buffer = np.empty((max(self.__batch_size, len(frames)), height, width, 3), dtype=np.float32)
+            self.__local.buffer = buffer
+            if spec.layout == 'nchw':
+                self.__local.nchw_buffer = np.empty((len(buffer), 3, height, width), dtype=np.float32)
+
+        for slot, frame in zip(buffer, frames):
+            if isinstance(frame, Image.Image):
+                frame = av.VideoFrame.from_image(frame)
+            rgb = frame.reformat(width=width, height=height, format='rgb24').to_ndarray()
+            np.copyto(slot, rgb[..., ::-1] if spec.bgr else rgb, casting='unsafe')
+            slot -= spec.mean
+            if spec.scale is not None:
+                slot *= spec.scale
+        if spec.layout == 'nchw':
+            batch = self.__local.nchw_buffer[:len(frames)]
+            np.copyto(batch, buffer[:len(frames)].transpose(0, 3, 1, 2))
+            return batch
+        return buffer[:len(frames)]
+
+
+def read_labels(path):
+    with open(path, encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+class ClassifierBackend:
+    """
+    Image classification model used by the server.
+    load() runs in LazyModel background thread and returns the backend itself,
+    classify() runs in inference threads with frames of one batch.
+    Every backend knows its preprocessing spec and how to turn scores into label names.
+    """
+    name = None
+
+    def __init__(self, batch_size=8):
+        self.batch_size = batch_size
+        self.spec = PREPROCESSING['caffe']
+        self.preprocess = None
+
+    def load(self):
+        self._load()
+        self.preprocess = FramePreprocessor(self.batch_size, self.spec)
+        # warm up before the first real frame
+        self.classify([av.VideoFrame(self.spec.size[0], self.spec.size[1], 'rgb24')])
+        return self
+
+    def classify(self, frames, top=3):
+        """
+        :param frames:
+            list of av.VideoFrame or PIL images
+        :return:
+            list with top most probable class names for every frame
+        """
+        return self.decode(self.predict(self.preprocess(frames)), top)
+
+    def predict(self, batch):
+        """
+        :return:
+            array of class scores of shape (len(batch), classes)
+        """
+        raise NotImplementedError
+
+    def decode(self, scores, top):
+        raise NotImplementedError
+
+    def _load(self):
+        raise NotImplementedError
+
+
+class KerasImageNetClassifier(ClassifierBackend):
+    """
+    Keras application model with ImageNet weights, decoded by keras ImageNet class index
+    """
+    applications = {
+        'resnet50': ('tensorflow.keras.applications.resnet50', 'ResNet50', 'caffe'),
+        'mobilenet_v2': ('tensorflow.keras.applications.mobilenet_v2', 'MobileNetV2', 'tf'),
+    }
+
+    def __init__(self, name='resnet50', batch_size=8):
+        super().__init__(batch_size)
+        self.name = name
+        self.spec = PREPROCESSING[self.applications[name][2]]
+        self.__model = None
+        self.__decode_predictions = None
+
+    def predict(self, batch):
+        return self.__model.predict_on_batch(batch)
+
+    def decode(self, scores, top):
+        return [[label for _, label, _ in best] for best in self.__decode_predictions(np.asarray(scores), top=top)]
+
+    def _load(self):
+        # tensorflow is imported here, so the server starts without waiting for it
+        import importlib
+        module_name, class_name, _ = self.applications[self.name]
+        module = importlib.import_module(module_name)
+        self.__model = getattr(module, class_name)(weights='imagenet')
+        self.__decode_predictions = module.decode_predictions
+
+
+class FileModelClassifier(ClassifierBackend):
+    """
+    Model loaded from a file with labels file, one class name per line in model output order
+    """
+
+    def __init__(self, model_path, labels_path, preprocessing='tf', batch_size=8):
+        super().__init__(batch_size)
+        self.model_path = model_path
+        self.labels_path = labels_path
+        self.spec = PREPROCESSING[preprocessing]
+        self.labels = None
+
+    def decode(self, scores, top):
+        best = np.argsort(-np.asarray(scores), axis=1)[:, :top]
+        return [[self.labels[i] if i < len(self.labels) else str(i) for i in row] for row in best]
+
+    def _load(self):
+        self.labels = read_labels(self.labels_path)
+
+
+class TFLiteClassifier(FileModelClassifier):
+    """
+    TensorFlow Lite model, e.g. int8 quantized MobileNet.
+    Quantized input and output are converted with model quantization parameters.
+    An interpreter is not thread safe, every inference thread gets its own one.
+    """
+    name = 'tflite'
+
+    def __init__(self, model_path, labels_path, preprocessing='tf', batch_size=8, threads=1):
+        super().__init__(model_path, labels_path, preprocessing, batch_size)
+        self.__threads = threads
+        self.__model_content = None
+        self.__interpreter_class = None
+        self.__local = threading.local()
+
+    def predict(self, batch):
+        interpreter = self.__interpreter()
+        input_detail = interpreter.get_input_details()[0]
+        output_detail = interpreter.get_output_details()[0]
+        scale, zero_point = input_detail['quantization']
+        if scale:
+            batch = np.clip(np.round(batch / scale + zero_point), *self.__dtype_range(input_detail['dtype']))
+        batch = batch.astype(input_detail['dtype'])
+
+        # models are usually converted with batch size 1
+        scores = []
+        for item in batch if input_detail['shape'][0] == 1 else [batch]:
+            interpreter.set_tensor(input_detail['index'], item[None] if input_detail['shape'][0] == 1 else item)
+            interpreter.invoke()
+            scores.append(interpreter.get_tensor(output_detail['index']))
+        scores = np.concatenate(scores).astype(np.float32)
+        scale, zero_point = output_detail['quantization']
+        return (scores - zero_point) * scale if scale else scores
+
+    def _load(self):
+        super()._load()
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            from tensorflow.lite import Interpreter
+        self.__interpreter_class = Interpreter
+        with open(self.model_path, 'rb') as f:
+            self.__model_content = f.read()
+        input_detail = self.__interpreter().get_input_details()[0]
+        _, height, width, _ = input_detail['shape']
+        self.spec = self.spec.resized((width, height))
+
+    def __interpreter(self):
+        interpreter = getattr(self.__local, 'interpreter', None)
+        if interpreter is None:
+            interpreter = self.__interpreter_class(model_content=self.__model_content, num_threads=self.__threads)
+            interpreter.allocate_tensors()
+            self.__local.interpreter = interpreter
+        return interpreter
+
+    @staticmethod
+    def __dtype_range(dtype):
+        info = np.iinfo(dtype)
+        return info.min, info.max
+
+
+class ONNXClassifier(FileModelClassifier):
+    """
+    ONNX Runtime model on cpu, e.g. int8 quantized MobileNet or ResNet exported from torchvision
+    """
+    name = 'onnx'
+
+    def __init__(self, model_path, labels_path, preprocessing='torch', batch_size=8, threads=1):
+        super().__init__(model_path, labels_path, preprocessing, batch_size)
+        self.__threads = threads
+        self.__session = None
+        self.__input_name = None
+        self.__batched = True
+
+    def predict(self, batch):
+        if self.__batched:
+            return self.__session.run(None, {self.__input_name: batch})[0]
+        return np.concatenate([self.__session.run(None, {self.__input_name: item[None]})[0] for item in batch])
+
+    def _load(self):
+        super()._load()
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = self.__threads
+        self.__session = onnxruntime.InferenceSession(self.model_path, options, providers=['CPUExecutionProvider'])
+        model_input = self.__session.get_inputs()[0]
+        self.__input_name = model_input.name
+        # a fixed batch dimension of 1 is common in exported models
+        self.__batched = model_input.shape[0] != 1
+        if self.spec.layout == 'nchw':
+            height, width = model_input.shape[2:4]
+        else:
+            height, width = model_input.shape[1:3]
+        if isinstance(width, int) and isinstance(height, int):
+            self.spec = self.spec.resized((width, height))
+
+
+CLASSIFIERS = ('resnet50', 'mobilenet_v2', 'tflite', 'onnx')
+
+
+def create_classifier(name, model_path=None, labels_path=None, preprocessing=None, batch_size=8, threads=1):
+    """
+    :param name:
+        one of CLASSIFIERS
+    :param preprocessing:
+        key of PREPROCESSING for model files, backend default if None
+    """
+    if name in KerasImageNetClassifier.applications:
+        return KerasImageNetClassifier(name, batch_size)
+    if model_path is None or labels_path is None:
+        raise ValueError(f'{name} classifier needs model and labels files')
+    backend = {'tflite': TFLiteClassifier, 'onnx': ONNXClassifier}[name]
+    if preprocessing is None:
+        return backend(model_path, labels_path, batch_size=batch_size, threads=threads)
+    return backend(model_path, labels_path, preprocessing, batch_size=batch_size, threads=threads)
@@ -0,0 +1,180 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from time import monotonic
+
+from aiortc.mediastreams import MediaStreamError
+
+from CameraSourceRegistry import CameraSourceError
+
+logger = logging.getLogger(__name__)
+
+
+class CameraGrabber:
+    """
+    Keeps reading a camera source in background and holds only its latest frame.
+    In passthrough mode only keyframes are decoded, the latest one stays the freshest frame
+    until the next keyframe, so it is used for the observed keyframe interval even if that exceeds max age.
+    """
+
+    def __init__(self, cam_id, sources, source):
+        self.cam_id = cam_id
+        self.frame = None
+        self.frame_time = None
+        self.keyframe_interval = None
+        self.last_used = monotonic()
+        self.__keyframes_only = source.packets is not None
+        self.__sources = sources
+        self.__source = source
+        self.__track = source.keyframes.subscribe()
+        self.__new_frame = asyncio.Event()
+        self.__task = asyncio.ensure_future(self.__run())
+
+    @property
+    def ended(self):
+        return self.__task.done()
+
+    def latest(self, max_age):
+        self.last_used = monotonic()
+        if self.keyframe_interval is not None:
+            max_age = max(max_age, self.keyframe_interval * 1.2)
+        if self.frame is not None and monotonic() - self.frame_time <= max_age:
+            return self.frame
+        return None
+
+    async def wait_frame(self, timeout):
+        self.last_used = monotonic()
+        try:
+            await asyncio.wait_for(self.__new_frame.wait(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        return self.frame
+
+    def close(self):
+        self.__task.cancel()
+        self.__track.stop()
+        self.__sources.release(self.__source)
+
+    async def __run(self):
+        while True:
+            try:
+                frame = await self.__track.recv()
+            except MediaStreamError:
+                logger.info(f'Source of camera {self.cam_id} ended')
+                break
+            now = monotonic()
+            if self.__keyframes_only and self.frame_time is not None:
+                interval = now - self.frame_time
+                self.keyframe_interval = interval if self.keyframe_interval is None \
+                    else 0.8 * self.keyframe_interval + 0.2 * interval
+            self.frame = frame
+            self.frame_time = now
+            self.__new_frame.set()
+            self.__new_frame.clear()
+
+
+class FrameGrabber:
+    """
+    Background grabbers for cameras somebody asked a single frame of.
+    Grabbers share camera sources with viewers through CameraSourceRegistry.
+    Grabbers unused for idle_timeout seconds are closed, and when there are more than
+    max_cameras of them the least recently used one is closed, unless it was used in the last
+    keep_recent seconds: a wall polling more cameras than that would reopen their sources in a cycle.
+    """
+
+    def __init__(self, sources, idle_timeout=120, max_cameras=32, keep_recent=10):
+        self.__sources = sources
+        self.__idle_timeout = idle_timeout
+        self.__max_cameras = max_cameras
+        self.__keep_recent = keep_recent
+        self.__grabbers = OrderedDict()
+        self.__starting = {}
+        self.__sweeper = None
+
+    async def start(self):
+        self.__sweeper = asyncio.ensure_future(self.__sweep())
+
+    async def close(self):
+        if self.__sweeper is not None:
+            self.__sweeper.cancel()
+        for grabber in self.__grabbers.values():
+            grabber.close()
+        self.__grabbers.clear()
+
+    def latest(self, cam_id, max_age):
+        """
+        Non-blocking lookup of a frame not older than max_age seconds.
+        :return:
+            av.VideoFrame or None if camera is not grabbed or its frame is too old
+        """
+        grabber = self.__grabbers.get(cam_id)
+        if grabber is None or grabber.ended:
+            return None
+        self.__grabbers.move_to_end(cam_id)
+        return grabber.latest(max_age)
+
+    async def grab(self, cam_id, url, max_age, timeout):
+        """
+        Starts grabbing the camera if needed and waits up to timeout seconds for a fresh frame.
+        :return:
+            av.VideoFrame or None
+        """
+        frame = self.latest(cam_id, max_age)
+        if frame is not None:
+            return frame
+
+        grabber = await self.__get(cam_id, url)
+        frame = grabber.latest(max_age)
+        if frame is None:
+            frame = await grabber.wait_frame(timeout)
+        return frame
+
+    async def __get(self, cam_id, url):
+        grabber = self.__grabbers.get(cam_id)
+        if grabber is not None and not grabber.ended:
+            return grabber
+
+        if cam_id not in self.__starting:
+            self.__starting[cam_id] = asyncio.ensure_future(self.__start_grabber(cam_id, url))
+        return await asyncio.shield(self.__starting[cam_id])
+
+    async def __start_grabber(self, cam_id, url):
+        try:
+            source = await self.__sources.acquire(cam_id, url)
+        finally:
+            self.__starting.pop(cam_id, None)
+
+        old_grabber = self.__grabbers.pop(cam_id, None)
+        if old_grabber is not None:
+            old_grabber.close()
+
+        if source.keyframes is None:
+            self.__sources.release(source)
+            raise CameraSourceError(f'Camera {cam_id} has no video')
+
+        grabber = CameraGrabber(cam_id, self.__sources, source)
+        self.__grabbers[cam_id] = grabber
+        self.__evict()
+        return grabber
+
+    def __evict(self):
+        now = monotonic()
+        while len(self.__grabbers) > self.__max_cameras:
+            cam_id, evicted = next(iter(self.__grabbers.items()))
+            if now - evicted.last_used <= self.__keep_recent:
+                logger.warning(f'{len(self.__grabbers)} cameras are grabbed, more than {self.__max_cameras}, '
+                               f'but all of them are in use')
+                return
+            del self.__grabbers[cam_id]
+            logger.info(f'Evicting frame grabber of camera {cam_id}')
+            evicted.close()
+
+    async def __sweep(self):
+        while True:
+            await asyncio.sleep(self.__idle_timeout / 2)
+            now = monotonic()
+            for cam_id, grabber in list(self.__grabbers.items()):
+                if grabber.ended or now - grabber.last_used > self.__idle_timeout:
+                    logger.info(f'Closing idle frame grabber of camera {cam_id}')
+                    del self.__grabbers[cam_id]
+                    grabber.close()
@@ -0,0 +1,182 @@
+"""
+Sampled per-frame latency tracing through the media pipeline.
+Every sample_every-th frame of a camera is stamped at each stage it passes: source receipt, decode,
+rendition encoding, viewer track and RTP send, keyed by camera, viewer and frame pts.
+A frame that is not sampled costs one lookup in an empty or small set at every stage.
+"""
+import json
+import logging
+from collections import deque
+from time import perf_counter
+
+SOURCE = 'source'
+DECODE = 'decode'
+KEYFRAME = 'keyframe decode'
+TRANSFORM = 'transform'
+INFERENCE = 'inference'
+SEND = 'send'
+
+logger = logging.getLogger(__name__)
+
+
+class FrameTracer:
+    """
+    Stamps of sampled frames in a ring buffer of capacity stamps, the oldest ones are overwritten.
+    Only max_frames latest sampled frames are stamped, so a frame lost on the way is forgotten.
+    Exported in Chrome trace event format, open it in chrome://tracing or ui.perfetto.dev: a process per camera,
+    a thread per stage shared by viewers and per viewer, and a slice per stamp lasting since the stage it came from.
+    """
+
+    def __init__(self, sample_every=0, capacity=100000, max_frames=1024):
+        """
+        :param sample_every:
+            trace every n-th frame of a camera, 0 disables tracing
+        """
+        self.sample_every = sample_every
+        self.__stamps = deque(maxlen=capacity)
+        self.__traced = set()
+        self.__traced_order = deque()
+        self.__max_frames = max_frames
+        self.__counters = {}
+        self.__sender_unsupported = False
+
+    def configure(self, sample_every, capacity=None):
+        self.sample_every = sample_every
+        if capacity is not None:
+            self.__stamps = deque(self.__stamps, maxlen=capacity)
+
+    @property
+    def enabled(self):
+        return self.sample_every > 0
+
+    def sample(self, cam_id, pts, stage):
+        """
+        Starts tracing every sample_every-th frame of camera at its first stage
+        :return:
+            whether the frame is traced
+        """
+        if not self.sample_every or pts is None:
+            return False
+        count = self.__counters.get(cam_id, 0)
+        self.__counters[cam_id] = count + 1
+        if count % self.sample_every:
+            return False
+
+        key = (cam_id, pts)
+        if key not in self.__traced:
+            if len(self.__traced_order) >= self.__max_frames:
+                self.__traced.discard(self.__traced_order.popleft())
+            self.__traced.add(key)
+            self.__traced_order.append(key)
+        self.__stamps.append((perf_counter(), cam_id, pts, stage, None, None))
+        return True
+
+    def traced(self, cam_id, pts):
+        return bool(self.__traced) and (cam_id, pts) in self.__traced
+
+    def stamp(self, cam_id, pts, stage, peer=None, after=None):
+        """
+        Stamps frame of camera if it is traced
+        :param peer:
+            viewer the frame is handled for, None for stages shared by all viewers of camera
+        :param after:
+            stage the frame comes from, by default the previous stage of the viewer
+            or the first stage of the frame
+        :return:
+            whether the frame is traced
+        """
+        if not self.__traced or (cam_id, pts) not in self.__traced:
+            return False
+        self.__stamps.append((perf_counter(), cam_id, pts, stage, peer, after))
+        return True
+
+    def trace_sender(self, sender, track, cam_id, peer):
+        """
+        Stamps frames of track when RTCRtpSender has them encoded and hands them to RTP.
+        track keeps traced_pts of the frame it returned last, None if that frame is not traced.
+        Wraps private RTCRtpSender._next_encoded_frame, without it in the installed aiortc
+        frames are traced up to the viewer track only.
+        """
+        if not self.enabled:
+            return
+        next_encoded_frame = getattr(sender, '_next_encoded_frame', None)
+        if next_encoded_frame is None:
+            if not self.__sender_unsupported:
+                self.__sender_unsupported = True
+                logger.warning('RTCRtpSender of installed aiortc has no _next_encoded_frame, '
+                               'frames are not traced up to RTP send')
+            return
+
+        async def traced_next_encoded_frame(codec):
+            encoded = await next_encoded_frame(codec)
+            if track.traced_pts is not None:
+                self.stamp(cam_id, track.traced_pts, SEND, peer)
+                track.traced_pts = None
+            return encoded
+
+        sender._next_encoded_frame = traced_next_encoded_frame
+
+    def snapshot(self, cam_id=None, limit=None):
+        """
+        Copies stamps in the thread they are stamped in, to export them elsewhere
+        :param cam_id:
+            camera to copy, all cameras if None
+        :param limit:
+            max latest stamps to copy, all if None
+        """
+        stamps = [stamp for stamp in self.__stamps if cam_id is None or stamp[1] == cam_id]
+        return stamps[-limit:] if limit is not None else stamps
+
+    @staticmethod
+    def chrome_trace(stamps):
+        """
+        :param stamps:
+            stamps of snapshot()
+        :return:
+            dict of Chrome trace event format
+        """
+        pids, tids, events = {}, {}, []
+        # (camera, pts) -> time of the first stamp, {(stage, peer): time} and {peer: time of its last stamp}
+        frames = {}
+        for at, cam, pts, stage, peer, after in stamps:
+            if cam not in pids:
+                pids[cam] = len(pids) + 1
+                events.append({'ph': 'M', 'name': 'process_name', 'pid': pids[cam], 'tid': 0,
+                               'args': {'name': f'camera {cam}'}})
+            # slices of a thread have to nest, stages shared by viewers overlap each other
+            lane = (cam, 'viewer', peer) if peer is not None else (cam, 'stage', stage)
+            if lane not in tids:
+                tids[lane] = len(tids) + 1
+                events.append({'ph': 'M', 'name': 'thread_name', 'pid': pids[cam], 'tid': tids[lane],
+                               'args': {'name': f'viewer {peer}' if peer is not None else stage}})
+
+            event = {'name': stage, 'pid': pids[cam], 'tid': tids[lane], 'args': {'pts': pts}}
+            frame = frames.get((cam, pts))
+            if frame is None:
+                # the oldest stamps of the frame may be overwritten already, start where the buffer does
+                frames[(cam, pts)] = (at, {(stage, peer): at}, {})
+                event.update(ph='i', s='t', ts=at * 1e6)
+                events.append(event)
+                continue
+
+            first, stamps, last_of_peer = frame
+            since = None
+            if after is not None:
+                since = stamps.get((after, peer), stamps.get((after, None)))
+            if since is None and peer is not None:
+                since = last_of_peer.get(peer)
+            if since is None:
+                since = first
+            event.update(ph='X', ts=since * 1e6, dur=(at - since) * 1e6)
+            events.append(event)
+            stamps[(stage, peer)] = at
+            if peer is not None:
+                last_of_peer[peer] = at
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def dump(self, path, cam_id=None):
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(self.snapshot(cam_id)), f)
+
+
+TRACER = FrameTracer()
@@ -0,0 +1,345 @@
+"""
+Forwarding camera h264 and audio packets to browsers without decoding and encoding them again.
+"""
+import asyncio
+import logging
+from collections import deque
+
+import av
+from aiortc import MediaStreamTrack, RTCRtpCodecCapability, RTCRtpCodecParameters
+from aiortc.codecs import CODECS, get_capabilities
+from aiortc.rtcrtpparameters import RTCRtcpFeedback
+from aiortc import sdp
+
+logger = logging.getLogger(__name__)
+
+NAL_SLICE = 1
+NAL_IDR_SLICE = 5
+NAL_SPS = 7
+NAL_PPS = 8
+
+
+def iter_annexb(data):
+    """
+    :return:
+        iterator over NAL units of Annex B byte stream without start codes
+    """
+    start = data.find(b'\x00\x00\x01')
+    while start != -1:
+        start += 3
+        end = data.find(b'\x00\x00\x01', start)
+        yield data[start:] if end == -1 else data[start:end].rstrip(b'\x00')
+        start = end
+
+
+def profile_level_id(data):
+    """
+    profile-level-id of SDP (profile_idc, constraint flags and level_idc of SPS)
+    :param data:
+        avcC extradata or Annex B extradata or packet
+    :return:
+        hex string like '4d401f' or None if there is no SPS
+    """
+    if data and data[0] == 1 and len(data) >= 4:
+        return data[1:4].hex()
+    for unit in iter_annexb(data or b''):
+        if len(unit) >= 4 and unit[0] & 0x1f == NAL_SPS:
+            return unit[1:4].hex()
+    return None
+
+
+def parameter_sets(data):
+    """
+    :return:
+        SPS and PPS units of Annex B packet or extradata with start codes, None if there is no SPS
+    """
+    units = []
+    for unit in iter_annexb(data):
+        nal_type = unit[0] & 0x1f if unit else None
+        if nal_type in (NAL_SPS, NAL_PPS):
+            units.append(b'\x00\x00\x00\x01' + unit)
+        elif nal_type in (NAL_SLICE, NAL_IDR_SLICE):
+            # parameter sets precede slices, do not copy the picture
+            break
+    if not any(unit[4] & 0x1f == NAL_SPS for unit in units):
+        return None
+    return b''.join(units)
+
+
+def copy_packet(packet, data=None):
+    """
+    Copy of av.Packet with the same timing, packets read by several consumers are not changed in place
+    """
+    result = av.Packet(bytes(packet) if data is None else data)
+    result.pts, result.dts, result.time_base = packet.pts, packet.dts, packet.time_base
+    result.is_keyframe = packet.is_keyframe
+    return result
+
+
+def h264_profile(profile_level_id):
+    try:
+        return sdp.parse_h264_profile_level_id(profile_level_id)
+    except ValueError:
+        return None, None
+
+
+# profile-level-ids of profiles aiortc does not offer, level 5.1 covers every camera resolution
+PASSTHROUGH_PROFILE_LEVEL_IDS = ('4d0033', '640c33', '640033')
+# capabilities of the profiles register_h264_profiles() added
+PASSTHROUGH_CODECS = []
+
+
+def register_h264_profiles():
+    """
+    aiortc only offers baseline and constrained baseline h264, as that is what its encoder produces.
+    Forwarded camera streams are often main or high profile, add them to aiortc codecs once at startup,
+    so negotiation picks the browser payload type of the same profile.
+    Every RTCPeerConnection offers them from then on, transcoded viewers keep aiortc codecs
+    with transcoded_video_codecs().
+    """
+    codecs = CODECS['video']
+    for profile_level_id in PASSTHROUGH_PROFILE_LEVEL_IDS:
+        if h264_codec(profile_level_id) is not None:
+            continue
+        payload_type = max(c.payloadType for c in codecs) + 1
+        codec = RTCRtpCodecParameters(
+            mimeType='video/H264', clockRate=90000, payloadType=payload_type,
+            rtcpFeedback=[RTCRtcpFeedback(type='nack'), RTCRtcpFeedback(type='nack', parameter='pli'),
+                          RTCRtcpFeedback(type='goog-remb')],
+            parameters={'level-asymmetry-allowed': '1', 'packetization-mode': '1',
+                        'profile-level-id': profile_level_id})
+        codecs += [codec, RTCRtpCodecParameters(mimeType='video/rtx', clockRate=90000,
+                                                payloadType=payload_type + 1, parameters={'apt': payload_type})]
+        PASSTHROUGH_CODECS.append(capability(codec))
+        logger.info(f'Registered h264 profile-level-id {profile_level_id} for passthrough')
+
+
+def h264_codec(profile_level_id):
+    """
+    :return:
+        RTCRtpCodecCapability of aiortc h264 codec of the same profile for RTCRtpTransceiver.setCodecPreferences,
+        None if aiortc does not offer that profile
+    """
+    profile, _ = h264_profile(profile_level_id)
+    for codec in CODECS['video']:
+        if codec.mimeType.lower() == 'video/h264' and codec.parameters.get('packetization-mode') == '1' \
+                and h264_profile(str(codec.parameters.get('profile-level-id')))[0] == profile:
+            return capability(codec)
+    return None
+
+
+def transcoded_video_codecs():
+    """
+    :return:
+        RTCRtpCodecCapability list of video codecs aiortc encodes itself, None if no profile is registered
+    """
+    if not PASSTHROUGH_CODECS:
+        return None
+    return [codec for codec in get_capabilities('video').codecs if codec not in PASSTHROUGH_CODECS]
+
+
+def capability(codec):
+    return RTCRtpCodecCapability(mimeType=codec.mimeType, clockRate=codec.clockRate, channels=codec.channels,
+                                 parameters=codec.parameters)
+
+
+def offer_accepts_h264(offer_sdp, profile_level_id):
+    """
+    Whether the first video of browser offer can receive h264 of profile_level_id as is
+    """
+    profile, level = h264_profile(profile_level_id)
+    if profile is None:
+        return False
+
+    description = sdp.SessionDescription.parse(offer_sdp)
+    video = next((media for media in description.media if media.kind == 'video'), None)
+    if video is None:
+        return False
+    for codec in video.rtp.codecs:
+        if codec.mimeType.lower() != 'video/h264' or str(codec.parameters.get('packetization-mode')) != '1':
+            continue
+        offered_profile, offered_level = h264_profile(str(codec.parameters.get('profile-level-id', '42e01f')))
+        if offered_profile == profile and (str(codec.parameters.get('level-asymmetry-allowed')) == '1'
+                                           or offered_level >= level):
+            return True
+    return False
+
+
+# camera audio MediaPlayer(decode=False) reads and the codec browsers receive it as
+AUDIO_PASSTHROUGH_CODECS = {'pcm_alaw': 'audio/PCMA', 'pcm_mulaw': 'audio/PCMU', 'opus': 'audio/opus'}
+
+
+def audio_codec(stream):
+    """
+    :return:
+        RTCRtpCodecCapability of aiortc codec sending packets of audio stream as is, None if there is no such codec
+    """
+    mime_type = AUDIO_PASSTHROUGH_CODECS.get(stream.codec_context.name)
+    for codec in get_capabilities('audio').codecs:
+        # rtp clock of opus is 48000 whatever its sampling rate is
+        if codec.mimeType == mime_type and (mime_type == 'audio/opus' or codec.clockRate == stream.sample_rate):
+            return codec
+    return None
+
+
+def offer_kinds(offer_sdp):
+    return {media.kind for media in sdp.SessionDescription.parse(offer_sdp).media}
+
+
+def offer_accepts_codec(offer_sdp, codec):
+    """
+    Whether the first media of codec kind in browser offer can receive codec
+    """
+    kind = codec.mimeType.split('/')[0]
+    description = sdp.SessionDescription.parse(offer_sdp)
+    media = next((media for media in description.media if media.kind == kind), None)
+    return media is not None and any(offered.mimeType.lower() == codec.mimeType.lower()
+                                     and offered.clockRate == codec.clockRate for offered in media.rtp.codecs)
+
+
+class AudioPacketTrack(MediaStreamTrack):
+    """
+    Camera audio packets as they are, aiortc packs them into RTP without encoding,
+    so they have to be sent by the codec the camera encoded them with.
+    Reads MediaPlayer(decode=False) audio track, which has only opus and G.711 audio.
+    """
+    kind = 'audio'
+
+    def __init__(self, track):
+        super().__init__()
+        self.__track = track
+        self.codec = None
+        self.codec_ready = asyncio.Event()
+
+    async def recv(self):
+        packet = await self.__track.recv()
+        if not self.codec_ready.is_set():
+            self.codec = audio_codec(packet.stream)
+            if self.codec is None:
+                logger.info(f'Camera audio {packet.stream.codec_context.name} {packet.stream.sample_rate} Hz '
+                            f'can not be passed through')
+            self.codec_ready.set()
+        return packet
+
+    def stop(self):
+        super().stop()
+        self.__track.stop()
+
+
+class H264PacketTrack(MediaStreamTrack):
+    """
+    Camera h264 packets in Annex B format with SPS and PPS before every keyframe,
+    so a browser can start decoding at any keyframe.
+    Reads MediaPlayer(decode=False) video track.
+    """
+    kind = 'video'
+
+    def __init__(self, track, parameter_sets=None):
+        """
+        :param parameter_sets:
+            SPS and PPS the camera had last time, codec is known before the first keyframe arrives
+        """
+        super().__init__()
+        self.__track = track
+        self.__filter = None
+        self.__parameter_sets = None
+        self.__started = False
+        self.__pending = deque()
+        self.profile_level_id = None
+        self.codec_ready = asyncio.Event()
+        if parameter_sets:
+            self.__update_parameter_sets(parameter_sets)
+
+    @property
+    def parameter_sets(self):
+        return self.__parameter_sets
+
+    async def recv(self):
+        while not self.__pending:
+            packet = await self.__track.recv()
+            if not self.__started:
+                self.__start(packet.stream)
+            for packet in self.__filter.filter(packet) if self.__filter is not None else [packet]:
+                if packet.is_keyframe:
+                    packet = self.__with_parameter_sets(packet)
+                self.__pending.append(packet)
+        return self.__pending.popleft()
+
+    def stop(self):
+        super().stop()
+        self.__track.stop()
+
+    def __start(self, stream):
+        self.__started = True
+        extradata = stream.codec_context.extradata
+        if extradata and extradata[0] == 1:
+            # mp4 and alike store avcC, browsers need start codes and in-band parameter sets
+            self.__filter = av.bitstream.BitStreamFilterContext('h264_mp4toannexb', stream)
+        elif extradata and parameter_sets(extradata):
+            # rtsp gets parameter sets from SDP, cameras do not always repeat them in-band
+            self.__update_parameter_sets(parameter_sets(extradata))
+
+    def __with_parameter_sets(self, packet):
+        data = bytes(packet)
+        in_band = parameter_sets(data)
+        if in_band is None:
+            if self.__parameter_sets is None:
+                return packet
+            return copy_packet(packet, self.__parameter_sets + data)
+        if in_band != self.__parameter_sets:
+            self.__update_parameter_sets(in_band)
+        return packet
+
+    def __update_parameter_sets(self, data):
+        self.__parameter_sets = data
+        self.profile_level_id = profile_level_id(data)
+        if self.profile_level_id is not None:
+            self.codec_ready.set()
+
+
+class PacketDecoder(MediaStreamTrack):
+    """
+    Decodes h264 packets of a camera for consumers that need frames.
+    With keyframes_only only keyframes are decoded, which is enough for classification and snapshots.
+    """
+    kind = 'video'
+
+    def __init__(self, packets, keyframes_only=False):
+        """
+        :param packets:
+            track of Annex B h264 packets
+        """
+        super().__init__()
+        self.__packets = packets
+        self.__keyframes_only = keyframes_only
+        self.__codec = av.CodecContext.create('h264', 'r')
+        self.__frames = deque()
+
+    async def recv(self):
+        loop = asyncio.get_event_loop()
+        while not self.__frames:
+            packet = await self.__packets.recv()
+            if self.__keyframes_only and not packet.is_keyframe:
+                continue
+            try:
+                frames = await loop.run_in_executor(None, self.__decode, packet)
+            except av.FFmpegError as e:
+                logger.debug(f'Can not decode packet: {e}')
+                continue
+            for frame in frames:
+                if frame.time_base is None:
+                    frame.time_base = packet.time_base
+            self.__frames.extend(frames)
+        return self.__frames.popleft()
+
+    def stop(self):
+        super().stop()
+        self.__packets.stop()
+
+    def __decode(self, packet):
+        frames = self.__codec.decode(packet)
+        if self.__keyframes_only and not frames:
+            # reordering delay would hold a keyframe until the next one, drain decoder instead
+            frames = self.__codec.decode(None)
+            self.__codec.flush_buffers()
+        return frames
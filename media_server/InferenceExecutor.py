@@ -0,0 +1,142 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+
+from Metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+INFERENCE_LATENCY = Histogram('inference_latency_seconds', 'Time from submitting a frame to its classification result')
+INFERENCE_BATCH_SECONDS = Histogram('inference_batch_seconds', 'Model call duration for one batch')
+INFERENCE_BATCH_SIZE = Histogram('inference_batch_size', 'Frames classified in one model call',
+                                 buckets=(1, 2, 4, 8, 16, 32, 64))
+INFERENCE_DROPPED = Counter('inference_dropped_total', 'Frames dropped from full inference queue')
+
+
+class InferenceDropped(Exception):
+    pass
+
+
+class InferenceExecutor:
+    """
+    Runs blocking model inference in dedicated threads.
+    Callers get an asyncio future right away and never wait for a free slot:
+    when the queue is full the oldest pending item is dropped,
+    so the model always works on the most recent frames.
+    Items submitted by all cameras are collected into batches. A batch is run
+    when it has batch_size items or max_delay seconds after its first item arrived.
+    """
+
+    def __init__(self, predict, max_queue=32, workers=1, batch_size=8, max_delay=0.05):
+        """
+        :param predict:
+            callable taking a list of items and returning a list of results in the same order
+        """
+        self.__predict = predict
+        self.__max_queue = max_queue
+        self.__workers = workers
+        self.__batch_size = batch_size
+        self.__max_delay = max_delay
+        self.__pool = None
+        self.__queue = None
+        self.__item_added = None
+        self.__tasks = []
+        self.__busy_seconds = 0
+
+    @property
+    def queue_depth(self):
+        return self.__queue.qsize() if self.__queue is not None else 0
+
+    @property
+    def workers(self):
+        return self.__workers
+
+    @property
+    def busy_seconds(self):
+        """
+        Total time spent in model calls by all workers
+        """
+        return self.__busy_seconds
+
+    async def start(self):
+        self.__pool = ThreadPoolExecutor(max_workers=self.__workers, thread_name_prefix='inference')
+        self.__queue = asyncio.Queue(maxsize=self.__max_queue)
+        self.__item_added = asyncio.Event()
+        self.__tasks = [asyncio.ensure_future(self.__work()) for _ in range(self.__workers)]
+
+    async def close(self):
+        for task in self.__tasks:
+            task.cancel()
+        await asyncio.gather(*self.__tasks, return_exceptions=True)
+        self.__tasks = []
+        while self.__queue is not None and not self.__queue.empty():
+            _, future, _ = self.__queue.get_nowait()
+            if not future.done():
+                future.set_exception(InferenceDropped('Inference executor is closed'))
+        if self.__pool is not None:
+            self.__pool.shutdown(wait=False)
+
+    def submit(self, item):
+        future = asyncio.get_event_loop().create_future()
+        if self.__queue is None:
+            future.set_exception(InferenceDropped('Inference executor is not started'))
+            return future
+
+        if self.__queue.full():
+            _, stale_future, _ = self.__queue.get_nowait()
+            INFERENCE_DROPPED.inc()
+            if not stale_future.done():
+                stale_future.set_exception(InferenceDropped('Dropped in favour of a newer item'))
+        self.__queue.put_nowait((item, future, monotonic()))
+        self.__item_added.set()
+        return future
+
+    async def __next_batch(self):
+        loop = asyncio.get_event_loop()
+        batch = [await self.__queue.get()]
+        deadline = loop.time() + self.__max_delay
+        while len(batch) < self.__batch_size:
+            while len(batch) < self.__batch_size and not self.__queue.empty():
+                batch.append(self.__queue.get_nowait())
+
+            timeout = deadline - loop.time()
+            if len(batch) >= self.__batch_size or timeout <= 0:
+                break
+            self.__item_added.clear()
+            try:
+                await asyncio.wait_for(self.__item_added.wait(), timeout)
+            except asyncio.TimeoutError:
+                break
+        return [entry for entry in batch if not entry[1].done()]
+
+    async def __work(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = await self.__next_batch()
+            if not batch:
+                continue
+
+            items = [item for item, _, _ in batch]
+            started = monotonic()
+            try:
+                results = await loop.run_in_executor(self.__pool, self.__predict, items)
+            except Exception as e:
+                logger.exception('Inference failed')
+                results = [e] * len(batch)
+                failed = True
+            else:
+                failed = False
+            finished = monotonic()
+            self.__busy_seconds += finished - started
+            INFERENCE_BATCH_SECONDS.observe(finished - started)
+            INFERENCE_BATCH_SIZE.observe(len(batch))
+
+            for (_, future, submitted), result in zip(batch, results):
+                INFERENCE_LATENCY.observe(finished - submitted)
+                if future.done():
+                    continue
+                if failed:
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
@@ -0,0 +1,120 @@
+import logging
+from time import monotonic
+
+import numpy as np
+
+from Metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+INFERENCE_SKIPPED_STATIC = Counter('inference_skipped_static_total',
+                                   'Frames due for classification skipped because the scene did not change',
+                                   ['camera'])
+
+MOTION_SIZE = (32, 24)
+
+
+def motion_signature(frame):
+    """
+    Tiny grayscale copy of frame compared between classifications
+    :param frame:
+        av.VideoFrame
+    """
+    return frame.reformat(width=MOTION_SIZE[0], height=MOTION_SIZE[1], format='gray').to_ndarray().astype(np.int16)
+
+
+class CameraInferenceState:
+    __slots__ = ('last_check', 'last_submit', 'signature', 'pending')
+
+    def __init__(self):
+        self.last_check = 0
+        self.last_submit = 0
+        self.signature = None
+        self.pending = None
+
+
+class InferencePolicy:
+    """
+    Decides which frames are classified, shared by all viewer tracks of all cameras.
+    Every camera is checked at most fps times per second whatever number of viewers it has.
+    A checked frame is classified only if it differs from the last classified one
+    by more than motion_threshold mean gray levels, or refresh_interval seconds passed since then.
+    When model calls take more than cpu_budget of inference workers time,
+    the rate of all cameras is lowered, and raised back when the load drops.
+    """
+
+    def __init__(self, inference, fps=1, motion_threshold=2, refresh_interval=30, cpu_budget=0.8,
+                 min_scale=0.05, load_interval=2):
+        """
+        :param inference:
+            InferenceExecutor
+        :param motion_threshold:
+            mean absolute difference of downscaled gray frames in range [0, 255], 0 disables motion gating
+        """
+        self.__inference = inference
+        self.__interval = 1 / fps
+        self.__motion_threshold = motion_threshold
+        self.__refresh_interval = refresh_interval
+        self.__cpu_budget = cpu_budget
+        self.__min_scale = min_scale
+        self.__load_interval = load_interval
+        self.__cameras = {}
+        self.__load_time = monotonic()
+        self.__load_busy = inference.busy_seconds
+        self.load = 0
+        self.scale = 1
+
+    def submit(self, cam_id, frame):
+        """
+        Called with every frame of every viewer track.
+        :return:
+            future of inference result if frame is classified or None
+        """
+        now = monotonic()
+        if now - self.__load_time >= self.__load_interval:
+            self.__update_load(now)
+
+        state = self.__cameras.get(cam_id)
+        if state is None:
+            state = self.__cameras[cam_id] = CameraInferenceState()
+        if now - state.last_check < self.__interval / self.scale:
+            return None
+        if state.pending is not None and not state.pending.done():
+            return None
+        state.last_check = now
+
+        signature = None
+        if self.__motion_threshold > 0:
+            signature = motion_signature(frame)
+            if state.signature is not None and now - state.last_submit < self.__refresh_interval \
+                    and np.abs(signature - state.signature).mean() < self.__motion_threshold:
+                INFERENCE_SKIPPED_STATIC.labels(cam_id).inc()
+                return None
+
+        state.signature = signature
+        state.last_submit = now
+        state.pending = self.__inference.submit(frame)
+        state.pending.add_done_callback(lambda future: self.__on_done(state, future))
+        return state.pending
+
+    @staticmethod
+    def __on_done(state, future):
+        # a dropped or failed frame must not hide the scene from the next check
+        if future is state.pending and (future.cancelled() or future.exception() is not None):
+            state.signature = None
+
+    def __update_load(self, now):
+        busy = self.__inference.busy_seconds
+        self.load = (busy - self.__load_busy) / ((now - self.__load_time) * self.__inference.workers)
+        self.__load_time = now
+        self.__load_busy = busy
+
+        if self.load > self.__cpu_budget:
+            scale = max(self.__min_scale, self.scale * self.__cpu_budget / self.load)
+        elif self.load < self.__cpu_budget * 0.8:
+            scale = min(1, self.scale * 1.25)
+        else:
+            scale = self.scale
+        if scale != self.scale:
+            logger.debug(f'Inference load {self.load:.2f}, rate scale {self.scale:.2f} -> {scale:.2f}')
+        self.scale = scale
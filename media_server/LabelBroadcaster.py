@@ -0,0 +1,56 @@
+import asyncio
+import json
+
+
+class LabelBroadcaster:
+    """
+    Keeps the latest classification labels of every camera
+    and pushes changes to everybody subscribed to that camera.
+    A message is serialized once per change and every subscriber
+    holds only the newest one, so slow clients just skip old labels.
+    """
+
+    def __init__(self):
+        self.__labels = {}
+        self.__messages = {}
+        self.__subscribers = {}
+
+    def get(self, cam_id):
+        return self.__labels.get(cam_id)
+
+    def publish(self, cam_id, labels):
+        if self.__labels.get(cam_id) == labels:
+            return
+
+        self.__labels[cam_id] = labels
+        self.__messages[cam_id] = json.dumps({'camera': cam_id, 'labels': labels})
+        for queue in self.__subscribers.get(cam_id, ()):
+            self.__put(queue, self.__messages[cam_id])
+
+    def subscribe(self, cam_id):
+        """
+        :return:
+            asyncio.Queue with json messages, the current labels are already in it
+        """
+        queue = asyncio.Queue(maxsize=1)
+        if cam_id in self.__messages:
+            queue.put_nowait(self.__messages[cam_id])
+        self.__subscribers.setdefault(cam_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, cam_id, queue):
+        subscribers = self.__subscribers.get(cam_id)
+        if subscribers is None:
+            return
+        subscribers.discard(queue)
+        if not subscribers:
+            del self.__subscribers[cam_id]
+
+    def subscribers(self, cam_id):
+        return len(self.__subscribers.get(cam_id, ()))
+
+    @staticmethod
+    def __put(queue, message):
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait(message)
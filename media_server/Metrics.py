@@ -0,0 +1,159 @@
+"""
+Minimal Prometheus text format metrics.
+Values are plain attributes updated from the event loop thread,
+so counting on hot paths costs one attribute increment and no locks.
+"""
+import asyncio
+from bisect import bisect_left
+
+
+class MetricValue:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class HistogramValue:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), function=None, registry=None):
+        """
+        :param function:
+            callable evaluated on every scrape instead of stored values,
+            returns a number or a dict {label values tuple: number}
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.function = function
+        self._values = {}
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def labels(self, *labelvalues):
+        key = tuple(str(v) for v in labelvalues)
+        value = self._values.get(key)
+        if value is None:
+            value = self._values[key] = self._new_value()
+        return value
+
+    def remove(self, *labelvalues):
+        self._values.pop(tuple(str(v) for v in labelvalues), None)
+
+    def _new_value(self):
+        return MetricValue()
+
+    def _samples(self):
+        if self.function is not None:
+            values = self.function()
+            if not isinstance(values, dict):
+                values = {(): values}
+            for labelvalues, value in values.items():
+                yield self.name, self.labelnames, labelvalues, value
+        else:
+            for labelvalues, value in list(self._values.items()):
+                yield self.name, self.labelnames, labelvalues, value.value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for name, labelnames, labelvalues, value in self._samples():
+            lines.append(f'{name}{format_labels(labelnames, labelvalues)} {float(value)!r}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+    DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames, registry=registry)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def _new_value(self):
+        return HistogramValue(self.buckets)
+
+    def _samples(self):
+        bucket_labelnames = self.labelnames + ('le',)
+        for labelvalues, value in list(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), value.counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(float(bound))
+                yield f'{self.name}_bucket', bucket_labelnames, labelvalues + (le,), cumulative
+            yield f'{self.name}_sum', self.labelnames, labelvalues, value.sum
+            yield f'{self.name}_count', self.labelnames, labelvalues, value.count
+
+
+class Registry:
+    def __init__(self):
+        self.__metrics = []
+
+    def register(self, metric):
+        self.__metrics.append(metric)
+
+    def render(self):
+        return '\n'.join(metric.render() for metric in self.__metrics) + '\n'
+
+
+def format_labels(labelnames, labelvalues):
+    if not labelnames:
+        return ''
+    pairs = []
+    for name, value in zip(labelnames, labelvalues):
+        value = str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+REGISTRY = Registry()
+
+EVENT_LOOP_LAG = Histogram('event_loop_lag_seconds', 'Delay of event loop wake ups over requested sleep')
+
+
+async def monitor_event_loop_lag(interval=0.5):
+    loop = asyncio.get_event_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(0, loop.time() - started - interval))
@@ -2,7 +2,16 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+import asyncio
+import copy
+import threading
+from time import monotonic
 import zeep
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPDigestAuth
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from onvif import ONVIFCamera, ONVIFError
 from datetime import timedelta
 
@@ -18,12 +27,42 @@ zeep.xsd.simple.AnySimpleType.pythonvalue = zeep_pythonvalue
 ONVIFCameraControlError = ONVIFError
 
 
+def make_pooled_transport(pool_size=4, timeout=10):
+    """
+    zeep transport keeping up to pool_size open connections to one camera
+    """
+    session = requests.Session()
+    session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+    session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+    return zeep.Transport(session=session, timeout=timeout, operation_timeout=timeout)
+
+
 class ONVIFCameraControl:
-    def __init__(self, addr, login, password):
+    IMAGING_FIELDS = {
+        'brightness': 'Brightness',
+        'color_saturation': 'ColorSaturation',
+        'contrast': 'Contrast',
+        'sharpness': 'Sharpness',
+    }
+
+    def __init__(self, addr, login, password, transport=None, settings_ttl=2, camera_factory=ONVIFCamera):
+        """
+        :param settings_ttl:
+            seconds imaging settings are cached, changes made through this object update the cache
+        :param camera_factory:
+            callable creating onvif.ONVIFCamera, e.g. ONVIFFleet.CachedONVIFCamera
+        """
         self.__check_addr(addr)
         logger.info(f'Initializing camera {addr}')
 
-        self.__cam = ONVIFCamera(addr[0], addr[1], login, password)
+        self.__settings_ttl = settings_ttl
+        self.__settings_lock = threading.RLock()
+        self.__imaging_settings = None
+        self.__imaging_settings_time = 0
+        self.__move_options = None
+        self.__options = None
+
+        self.__cam = camera_factory(addr[0], addr[1], login, password, transport=transport)
 
         self.__media_service = self.__cam.create_media_service()
         self.__ptz_service = self.__cam.create_ptz_service()
@@ -59,9 +98,7 @@ class ONVIFCameraControl:
             float in range [0, 100]
         """
         logger.info(f'Settings brightness')
-        imaging_settings = self.__get_imaging_settings()
-        imaging_settings.Brightness = brightness
-        self.__set_imaging_settings(imaging_settings)
+        self.update_imaging(brightness=brightness)
 
     def set_color_saturation(self, color_saturation):
         """
@@ -69,9 +106,7 @@ class ONVIFCameraControl:
             float in range [0, 100]
         """
         logger.info(f'Settings color_saturation')
-        imaging_settings = self.__get_imaging_settings()
-        imaging_settings.ColorSaturation = color_saturation
-        self.__set_imaging_settings(imaging_settings)
+        self.update_imaging(color_saturation=color_saturation)
 
     def set_contrast(self, contrast):
         """
@@ -79,9 +114,7 @@ class ONVIFCameraControl:
             float in range [0, 100]
         """
         logger.info(f'Settings contrast')
-        imaging_settings = self.__get_imaging_settings()
-        imaging_settings.Contrast = contrast
-        self.__set_imaging_settings(imaging_settings)
+        self.update_imaging(contrast=contrast)
 
     def set_sharpness(self, sharpness):
         """
@@ -89,9 +122,7 @@ class ONVIFCameraControl:
             float in range [0, 100]
         """
         logger.info(f'Settings sharpness')
-        imaging_settings = self.__get_imaging_settings()
-        imaging_settings.Sharpness = sharpness
-        self.__set_imaging_settings(imaging_settings)
+        self.update_imaging(sharpness=sharpness)
 
     def set_focus_mode(self, mode='AUTO'):
         """
@@ -99,9 +130,30 @@ class ONVIFCameraControl:
             string, can be either 'AUTO' or 'MANUAL'
         """
         logger.info(f'Settings focus mode')
-        imaging_settings = self.__get_imaging_settings()
-        imaging_settings.Focus.AutoFocusMode = mode
-        self.__set_imaging_settings(imaging_settings)
+        self.update_imaging(focus_mode=mode)
+
+    def update_imaging(self, **fields):
+        """
+        Applies several imaging settings with one SetImagingSettings call
+        :param fields:
+            any of brightness, color_saturation, contrast, sharpness (float in range [0, 100])
+            and focus_mode ('AUTO' or 'MANUAL')
+        """
+        unknown = set(fields) - set(self.IMAGING_FIELDS) - {'focus_mode'}
+        if unknown:
+            raise TypeError(f'Unknown imaging settings {sorted(unknown)}')
+
+        logger.info(f'Updating imaging settings {fields}')
+        with self.__settings_lock:
+            imaging_settings = copy.deepcopy(self.__get_imaging_settings())
+            for name, value in fields.items():
+                if name == 'focus_mode':
+                    imaging_settings.Focus.AutoFocusMode = value
+                else:
+                    setattr(imaging_settings, self.IMAGING_FIELDS[name], value)
+            self.__set_imaging_settings(imaging_settings)
+            self.__imaging_settings = imaging_settings
+            self.__imaging_settings_time = monotonic()
 
     def move_focus_continuous(self, speed):
         """
@@ -111,7 +163,7 @@ class ONVIFCameraControl:
         logger.info(f'Doing move focus continuous')
         request = self.__imaging_service.create_type('Move')
         request.VideoSourceToken = self.__video_source.token
-        request.Focus = self.__get_move_options()
+        request.Focus = copy.deepcopy(self.__get_move_options())
         request.Focus.Continuous.Speed = speed
         self.__imaging_service.Move(request)
 
@@ -125,7 +177,7 @@ class ONVIFCameraControl:
         logger.info(f'Doing move focus absolute')
         request = self.__imaging_service.create_type('Move')
         request.VideoSourceToken = self.__video_source.token
-        request.Focus = self.__get_move_options()
+        request.Focus = copy.deepcopy(self.__get_move_options())
         request.Focus.Absolute.Position = position
         request.Focus.Absolute.Speed = speed
         self.__imaging_service.Move(request)
@@ -251,15 +303,20 @@ class ONVIFCameraControl:
         return self.__media_service.GetSnapshotUri({'ProfileToken': self.__profile.token})["Uri"]
 
     def __get_move_options(self):
-        request = self.__imaging_service.create_type('GetMoveOptions')
-        request.VideoSourceToken = self.__video_source.token
-        return self.__imaging_service.GetMoveOptions(request)
+        # move options of a video source do not change, ask camera once
+        if self.__move_options is None:
+            request = self.__imaging_service.create_type('GetMoveOptions')
+            request.VideoSourceToken = self.__video_source.token
+            self.__move_options = self.__imaging_service.GetMoveOptions(request)
+        return self.__move_options
 
     def __get_options(self):
-        logger.debug(f'Getting options')
-        request = self.__imaging_service.create_type('GetOptions')
-        request.VideoSourceToken = self.__video_source.token
-        return self.__imaging_service.GetOptions(request)
+        if self.__options is None:
+            logger.debug(f'Getting options')
+            request = self.__imaging_service.create_type('GetOptions')
+            request.VideoSourceToken = self.__video_source.token
+            self.__options = self.__imaging_service.GetOptions(request)
+        return self.__options
 
     def __get_video_sources(self):
         logger.debug(f'Getting video source configurations')
@@ -291,10 +348,101 @@ class ONVIFCameraControl:
         return self.__imaging_service.SetImagingSettings(request)
 
     def __get_imaging_settings(self):
-        request = self.__imaging_service.create_type('GetImagingSettings')
-        request.VideoSourceToken = self.__video_source.token
-        return self.__imaging_service.GetImagingSettings(request)
+        with self.__settings_lock:
+            if self.__imaging_settings is None or monotonic() - self.__imaging_settings_time > self.__settings_ttl:
+                request = self.__imaging_service.create_type('GetImagingSettings')
+                request.VideoSourceToken = self.__video_source.token
+                self.__imaging_settings = self.__imaging_service.GetImagingSettings(request)
+                self.__imaging_settings_time = monotonic()
+            return self.__imaging_settings
 
     def __check_addr(self, addr):
         if not isinstance(addr, tuple) or not isinstance(addr[0], str) or not isinstance(addr[1], int):
-            raise TypeError(f'addr must be of type tuple(str, int)')
\ No newline at end of file
+            raise TypeError(f'addr must be of type tuple(str, int)')
+
+
+class AsyncONVIFCameraControl:
+    """
+    asyncio version of ONVIFCameraControl.
+    Every public method of ONVIFCameraControl is available as a coroutine.
+    SOAP calls of a camera run in its own small thread pool over one pooled HTTP transport,
+    so calls to one camera run concurrently and never block the event loop.
+    """
+
+    def __init__(self, control, executor, transport, auth, debounce=0.2):
+        """
+        :param debounce:
+            seconds imaging updates are collected before being sent to camera
+        """
+        self.__control = control
+        self.__executor = executor
+        self.__transport = transport
+        self.__auth = auth
+        self.__debounce = debounce
+        self.__pending_imaging = {}
+        self.__imaging_flush = None
+
+    @classmethod
+    async def create(cls, addr, login, password, concurrency=4, debounce=0.2, camera_factory=ONVIFCamera):
+        executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix=f'onvif-{addr[0]}')
+        transport = make_pooled_transport(pool_size=concurrency)
+        loop = asyncio.get_event_loop()
+        try:
+            control = await loop.run_in_executor(
+                executor, partial(ONVIFCameraControl, addr, login, password, transport=transport,
+                                  camera_factory=camera_factory))
+        except BaseException:
+            executor.shutdown(wait=False)
+            transport.session.close()
+            raise
+        return cls(control, executor, transport, HTTPDigestAuth(login, password), debounce=debounce)
+
+    async def update_imaging(self, **fields):
+        """
+        Debounced ONVIFCameraControl.update_imaging.
+        Updates arriving within debounce seconds are merged, the latest value of every field wins,
+        and all callers wait for the single SetImagingSettings that applies them.
+        """
+        unknown = set(fields) - set(ONVIFCameraControl.IMAGING_FIELDS) - {'focus_mode'}
+        if unknown:
+            raise TypeError(f'Unknown imaging settings {sorted(unknown)}')
+
+        self.__pending_imaging.update(fields)
+        if self.__imaging_flush is None:
+            self.__imaging_flush = asyncio.ensure_future(self.__flush_imaging())
+        await asyncio.shield(self.__imaging_flush)
+
+    async def fetch(self, url, timeout=5):
+        """
+        Downloads url from the camera (e.g. snapshot uri) over the pooled session
+        :return:
+            response body bytes
+        """
+        def get():
+            response = self.__transport.session.get(url, auth=self.__auth, timeout=timeout)
+            response.raise_for_status()
+            return response.content
+        return await self.__run(get)
+
+    def close(self):
+        self.__executor.shutdown(wait=False)
+        self.__transport.session.close()
+
+    def __getattr__(self, name):
+        method = getattr(self.__control, name) if not name.startswith('_') else None
+        if not callable(method):
+            raise AttributeError(name)
+
+        async def call(*args, **kwargs):
+            return await self.__run(partial(method, *args, **kwargs))
+        return call
+
+    async def __flush_imaging(self):
+        await asyncio.sleep(self.__debounce)
+        fields, self.__pending_imaging = self.__pending_imaging, {}
+        self.__imaging_flush = None
+        await self.__run(partial(self.__control.update_imaging, **fields))
+
+    async def __run(self, func):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.__executor, func)
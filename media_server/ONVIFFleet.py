@@ -0,0 +1,186 @@
+import asyncio
+import logging
+import threading
+from functools import partial
+from time import monotonic
+from urllib.parse import urlparse
+
+import zeep
+from zeep.cache import SqliteCache
+from zeep.client import Settings
+from zeep.wsdl import Document
+from onvif import ONVIFCamera
+from onvif.client import ONVIFService, UsernameDigestTokenDtDiff
+from onvif.definition import SERVICES
+
+from ONVIFCameraControl import AsyncONVIFCameraControl, ONVIFCameraControlError
+
+logger = logging.getLogger(__name__)
+
+
+class WSDLCache:
+    """
+    ONVIF WSDL documents parsed once per process and shared by clients of all cameras.
+    Parsing every WSDL again for every camera is what makes camera initialization slow.
+    Parsed documents can not be pickled, cache_path keeps schemas fetched over network
+    (imports of WSDL files) on disk between runs.
+    """
+
+    def __init__(self, cache_path=None):
+        self.__transport = zeep.Transport(cache=SqliteCache(path=cache_path) if cache_path else None)
+        self.__settings = Settings(strict=False, xml_huge_tree=True)
+        self.__documents = {}
+        self.__lock = threading.Lock()
+
+    def client(self, wsdl_file, wsse, transport):
+        """
+        :return:
+            zeep.Client of wsdl_file with its own wsse and transport
+        """
+        with self.__lock:
+            document = self.__documents.get(wsdl_file)
+            if document is None:
+                started = monotonic()
+                document = Document(wsdl_file, self.__transport, settings=self.__settings)
+                self.__documents[wsdl_file] = document
+                logger.debug(f'Parsed {wsdl_file} in {monotonic() - started:.2f}s')
+        return zeep.Client(wsdl=document, wsse=wsse, transport=transport or zeep.Transport(),
+                           settings=self.__settings)
+
+
+class CachedONVIFCamera(ONVIFCamera):
+    """
+    ONVIFCamera creating its services from WSDLCache.
+    It does not subscribe to events on connect, nothing here uses them.
+    """
+
+    def __init__(self, *args, wsdl_cache, **kwargs):
+        self.__wsdl_cache = wsdl_cache
+        super().__init__(*args, **kwargs)
+
+    def update_xaddrs(self):
+        self.dt_diff = None
+        self.devicemgmt = self.create_devicemgmt_service()
+        self.xaddrs = {}
+        capabilities = self.devicemgmt.GetCapabilities({'Category': 'All'})
+        for name in capabilities:
+            capability = capabilities[name]
+            if name.lower() in SERVICES and capability is not None:
+                self.xaddrs[SERVICES[name.lower()]['ns']] = capability['XAddr']
+
+    def create_onvif_service(self, name, from_template=True, portType=None):
+        name = name.lower()
+        xaddr, wsdl_file, binding_name = self.get_definition(name, portType)
+        wsse = UsernameDigestTokenDtDiff(self.user, self.passwd, dt_diff=self.dt_diff, use_digest=self.encrypt)
+        client = self.__wsdl_cache.client(wsdl_file, wsse, self.transport)
+
+        with self.services_lock:
+            service = ONVIFService(xaddr, self.user, self.passwd, wsdl_file, self.encrypt, self.daemon,
+                                   zeep_client=client, portType=portType, dt_diff=self.dt_diff,
+                                   binding_name=binding_name, transport=self.transport)
+            self.services[name] = service
+            setattr(self, name, service)
+        return service
+
+
+class ONVIFFleet:
+    """
+    ONVIF controls of all cameras.
+    A camera connects on first use, at most concurrency cameras connect at once
+    and every connection is limited by timeout seconds, so a dead camera never holds up the others.
+    A camera that failed to connect is not tried again for retry_interval seconds.
+    """
+
+    def __init__(self, port=80, login=None, password=None, concurrency=8, timeout=15, retry_interval=30,
+                 wsdl_cache=None):
+        """
+        :param login, password:
+            credentials of all cameras, if not set rtsp url credentials are used
+        :param wsdl_cache:
+            path of sqlite file caching fetched WSDL schemas between runs or None
+        """
+        self.__port = port
+        self.__login = login
+        self.__password = password
+        self.__concurrency = concurrency
+        self.__timeout = timeout
+        self.__retry_interval = retry_interval
+        self.__wsdl_cache = WSDLCache(wsdl_cache)
+        self.__semaphore = None
+        self.__controls = {}
+        self.__connecting = {}
+        self.__failures = {}
+
+    def credentials(self, play_from):
+        """
+        :return:
+            (host, login, password) of camera with rtsp url play_from
+        """
+        url = urlparse(play_from)
+        return url.hostname, self.__login or url.username, self.__password or url.password
+
+    def states(self):
+        return {('connected',): len(self.__controls), ('connecting',): len(self.__connecting),
+                ('failed',): len(self.__failures)}
+
+    async def get(self, cam_id, play_from):
+        """
+        :return:
+            AsyncONVIFCameraControl of camera
+        :raise ONVIFCameraControlError:
+            if camera can not be connected now
+        """
+        control = self.__controls.get(cam_id)
+        if control is not None:
+            return control
+
+        failure = self.__failures.get(cam_id)
+        if failure is not None and monotonic() < failure[0]:
+            raise ONVIFCameraControlError(failure[1])
+
+        if cam_id not in self.__connecting:
+            self.__connecting[cam_id] = asyncio.ensure_future(self.__connect(cam_id, play_from))
+        return await asyncio.shield(self.__connecting[cam_id])
+
+    async def warm_up(self, cams):
+        """
+        Connects cameras in background, failures are only logged
+        :param cams:
+            list of cameras from CameraDirectory
+        """
+        started = monotonic()
+        results = await asyncio.gather(*(self.get(cam['id'], cam['rtsp']) for cam in cams if cam.get('rtsp')),
+                                       return_exceptions=True)
+        connected = sum(1 for result in results if not isinstance(result, BaseException))
+        logger.info(f'Connected {connected} of {len(results)} ONVIF cameras in {monotonic() - started:.1f}s')
+
+    def close(self):
+        for future in self.__connecting.values():
+            future.cancel()
+        for control in self.__controls.values():
+            control.close()
+        self.__controls.clear()
+
+    async def __connect(self, cam_id, play_from):
+        host, login, password = self.credentials(play_from)
+        if self.__semaphore is None:
+            self.__semaphore = asyncio.Semaphore(self.__concurrency)
+        try:
+            async with self.__semaphore:
+                control = await asyncio.wait_for(
+                    AsyncONVIFCameraControl.create((host, self.__port), login, password,
+                                                   camera_factory=partial(CachedONVIFCamera,
+                                                                          wsdl_cache=self.__wsdl_cache)),
+                    self.__timeout)
+        except Exception as e:
+            error = f'no answer in {self.__timeout}s' if isinstance(e, asyncio.TimeoutError) else str(e)
+            error = f'Can not connect to ONVIF camera {cam_id}: {error}'
+            logger.warning(error)
+            self.__failures[cam_id] = (monotonic() + self.__retry_interval, error)
+            raise ONVIFCameraControlError(error) from e
+        finally:
+            self.__connecting.pop(cam_id, None)
+
+        self.__failures.pop(cam_id, None)
+        self.__controls[cam_id] = control
+        return control
@@ -0,0 +1,112 @@
+import asyncio
+import logging
+from collections import deque
+
+from Metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+PTZ_COMMAND_LATENCY = Histogram('ptz_command_latency_seconds', 'Time from PTZ command arrival to camera reply',
+                                ['action'])
+
+
+class PTZCommand:
+    __slots__ = ('action', 'kwargs', 'futures', 'enqueued')
+
+    def __init__(self, action, kwargs, future, enqueued):
+        self.action = action
+        self.kwargs = kwargs
+        self.futures = [future]
+        self.enqueued = enqueued
+
+
+class PTZCommandQueue:
+    """
+    Sends PTZ commands to one camera no faster than max_rate commands per second.
+    While a command waits, a newer command of the same kind replaces it
+    (relative moves are summed up instead), so the camera always follows the latest input.
+    stop is never merged or dropped, it discards moves queued before it
+    and is sent as soon as the camera replied to the previous command.
+    """
+    REPLACEABLE = {'move_continuous', 'move_absolute', 'goto_preset', 'go_home'}
+    MOVES = REPLACEABLE | {'move_relative'}
+
+    def __init__(self, control, max_rate=5):
+        """
+        :param control:
+            AsyncONVIFCameraControl
+        """
+        self.__control = control
+        self.__min_interval = 1 / max_rate
+        self.__pending = deque()
+        self.__last_sent = 0
+        self.__task = None
+        self.__stop_arrived = None
+
+    @property
+    def control(self):
+        return self.__control
+
+    async def submit(self, action, **kwargs):
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        if self.__stop_arrived is None:
+            self.__stop_arrived = asyncio.Event()
+        self.__enqueue(PTZCommand(action, kwargs, future, loop.time()))
+        if self.__task is None:
+            self.__task = asyncio.ensure_future(self.__run())
+        return await future
+
+    def __enqueue(self, command):
+        last = self.__pending[-1] if self.__pending else None
+        if command.action == 'stop':
+            for pending in [p for p in self.__pending if p.action in self.MOVES]:
+                self.__pending.remove(pending)
+                self.__resolve(pending, None)
+            self.__stop_arrived.set()
+        elif last is not None and last.action == command.action:
+            if command.action in self.REPLACEABLE:
+                last.kwargs = command.kwargs
+                last.futures.extend(command.futures)
+                return
+            if command.action == 'move_relative':
+                position = [a + b for a, b in zip(last.kwargs['ptz_position'], command.kwargs['ptz_position'])]
+                last.kwargs = {**command.kwargs, 'ptz_position': position}
+                last.futures.extend(command.futures)
+                return
+        self.__pending.append(command)
+
+    async def __run(self):
+        loop = asyncio.get_event_loop()
+        try:
+            while self.__pending:
+                wait = self.__last_sent + self.__min_interval - loop.time()
+                if wait > 0 and self.__pending[0].action != 'stop':
+                    # commands arriving meanwhile are merged into the queued ones
+                    self.__stop_arrived.clear()
+                    try:
+                        await asyncio.wait_for(self.__stop_arrived.wait(), wait)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                command = self.__pending.popleft()
+                self.__last_sent = loop.time()
+                try:
+                    result = await getattr(self.__control, command.action)(**command.kwargs)
+                except Exception as e:
+                    logger.warning(f'PTZ command {command.action} failed: {e}')
+                    for future in command.futures:
+                        if not future.done():
+                            future.set_exception(e)
+                else:
+                    self.__resolve(command, result)
+                PTZ_COMMAND_LATENCY.labels(command.action).observe(loop.time() - command.enqueued)
+        finally:
+            self.__task = None
+
+    @staticmethod
+    def __resolve(command, result):
+        for future in command.futures:
+            if not future.done():
+                future.set_result(result)
@@ -0,0 +1,150 @@
+import asyncio
+import itertools
+import logging
+from time import monotonic
+
+from Metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+PEERS_REJECTED = Counter('webrtc_peers_rejected_total', 'Offers rejected by admission control', ['reason'])
+PEERS_REAPED = Counter('webrtc_peers_reaped_total', 'Peer connections closed by the reaper', ['reason'])
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Peer:
+    __slots__ = ('id', 'cam_id', 'pc', 'created', 'negotiating', 'disconnected_since', 'on_close', 'closed')
+
+    __ids = itertools.count(1)
+
+    def __init__(self, cam_id):
+        self.id = next(Peer.__ids)
+        self.cam_id = cam_id
+        self.pc = None
+        self.created = monotonic()
+        self.negotiating = True
+        self.disconnected_since = None
+        self.on_close = None
+        self.closed = False
+
+
+class PeerRegistry:
+    """
+    Peer connections of all viewers with admission control.
+    An offer is rejected right away when there are max_peers viewers, max_camera_peers viewers of the camera
+    or max_negotiating offers being negotiated, so a reload storm can not exhaust the server.
+    A reaper closes peers that did not connect in connect_timeout seconds,
+    stayed disconnected for disconnected_timeout seconds, or failed or closed without telling us.
+    """
+
+    def __init__(self, max_peers=200, max_camera_peers=50, max_negotiating=20, connect_timeout=30,
+                 disconnected_timeout=15, reap_interval=5):
+        self.__max_peers = max_peers
+        self.__max_camera_peers = max_camera_peers
+        self.__max_negotiating = max_negotiating
+        self.__connect_timeout = connect_timeout
+        self.__disconnected_timeout = disconnected_timeout
+        self.__reap_interval = reap_interval
+        self.__peers = set()
+        self.__cameras = {}
+        self.__negotiating = 0
+        self.__reaper = None
+
+    def __len__(self):
+        return len(self.__peers)
+
+    def status(self):
+        return {
+            'peers': len(self.__peers),
+            'negotiating': self.__negotiating,
+            'max_peers': self.__max_peers,
+            'max_camera_peers': self.__max_camera_peers,
+            'cameras': {cam_id: len(peers) for cam_id, peers in self.__cameras.items()},
+        }
+
+    async def start(self):
+        self.__reaper = asyncio.ensure_future(self.__reap())
+
+    async def close(self):
+        if self.__reaper is not None:
+            self.__reaper.cancel()
+        await asyncio.gather(*(self.close_peer(peer) for peer in list(self.__peers)))
+
+    def admit(self, cam_id):
+        """
+        Reserves a viewer slot of camera for a new offer
+        :raise AdmissionRejected:
+            if a limit is reached
+        """
+        if len(self.__peers) >= self.__max_peers:
+            reason, retry_after = 'max_peers', 30
+        elif len(self.__cameras.get(cam_id, ())) >= self.__max_camera_peers:
+            reason, retry_after = 'max_camera_peers', 30
+        elif self.__negotiating >= self.__max_negotiating:
+            reason, retry_after = 'max_negotiating', 2
+        else:
+            peer = Peer(cam_id)
+            self.__peers.add(peer)
+            self.__cameras.setdefault(cam_id, set()).add(peer)
+            self.__negotiating += 1
+            return peer
+        PEERS_REJECTED.labels(reason).inc()
+        raise AdmissionRejected(f'Too many viewers ({reason}), try again later', retry_after)
+
+    def negotiated(self, peer):
+        if peer.negotiating:
+            peer.negotiating = False
+            self.__negotiating -= 1
+
+    async def close_peer(self, peer):
+        """
+        Closes peer connection and calls its on_close once
+        """
+        if peer.closed:
+            return
+        peer.closed = True
+        self.negotiated(peer)
+        self.__peers.discard(peer)
+        camera_peers = self.__cameras.get(peer.cam_id)
+        if camera_peers is not None:
+            camera_peers.discard(peer)
+            if not camera_peers:
+                del self.__cameras[peer.cam_id]
+        if peer.on_close is not None:
+            peer.on_close()
+        if peer.pc is not None:
+            await peer.pc.close()
+
+    async def __reap(self):
+        while True:
+            await asyncio.sleep(self.__reap_interval)
+            now = monotonic()
+            for peer in list(self.__peers):
+                reason = self.__reap_reason(peer, now)
+                if reason is not None:
+                    logger.info(f'Closing {reason} peer of camera {peer.cam_id}')
+                    PEERS_REAPED.labels(reason).inc()
+                    await self.close_peer(peer)
+
+    def __reap_reason(self, peer, now):
+        if peer.pc is None:
+            return 'half-open' if now - peer.created > self.__connect_timeout else None
+
+        state = peer.pc.connectionState
+        if state in ('closed', 'failed'):
+            return state
+        if state == 'disconnected' or peer.pc.iceConnectionState == 'disconnected':
+            if peer.disconnected_since is None:
+                peer.disconnected_since = now
+            elif now - peer.disconnected_since > self.__disconnected_timeout:
+                return 'disconnected'
+            return None
+        peer.disconnected_since = None
+        if state != 'connected' and now - peer.created > self.__connect_timeout:
+            return 'half-open'
+        return None
@@ -0,0 +1,309 @@
+"""
+Camera video scaled and encoded once per rendition size and shared by all viewers of that size.
+Every viewer moves up and down the ladder of its camera depending on its link quality.
+"""
+import asyncio
+import logging
+from collections import deque
+from time import monotonic
+
+import av
+from aiortc import MediaStreamTrack
+from aiortc.mediastreams import MediaStreamError
+from av.video.frame import PictureType
+
+from H264Passthrough import copy_packet
+from Metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+RENDITION_SWITCHES = Counter('rendition_switches_total', 'Viewers moved to another rendition', ['camera', 'direction'])
+
+# constrained baseline, what every WebRTC browser decodes
+BASELINE_PROFILE_LEVEL_ID = '42e01f'
+# encoder bitrate per pixel of a rendition, about 0.12 bit per pixel at 25 fps
+BITRATE_PER_PIXEL = 3
+MIN_BITRATE = 150000
+
+
+def parse_renditions(text):
+    """
+    :param text:
+        comma separated heights like 'full,720,240', full is the camera resolution
+    :return:
+        list of heights from the largest one, None for full
+    """
+    heights = set()
+    for item in text.split(','):
+        item = item.strip().lower().rstrip('p')
+        if item:
+            heights.add(None if item == 'full' else int(item))
+    return sorted(heights, key=lambda height: float('-inf') if height is None else -height)
+
+
+def rendition_name(height):
+    return 'full' if height is None else f'{height}p'
+
+
+class RenditionEncoder(MediaStreamTrack):
+    """
+    Scales decoded camera frames to height and encodes them to constrained baseline h264 packets.
+    Packets keep frame timestamps, so renditions of a camera can replace each other at a keyframe.
+    """
+    kind = 'video'
+
+    def __init__(self, frames, height=None, gop=50):
+        """
+        :param frames:
+            track of decoded camera frames
+        :param height:
+            rendition height, None or a height above the camera one keeps the camera size
+        """
+        super().__init__()
+        self.__frames = frames
+        self.__height = height
+        self.__gop = gop
+        self.__codec = None
+        self.__force_keyframe = False
+        self.__packets = deque()
+
+    def request_keyframe(self):
+        """
+        Makes the next packet a keyframe, so a viewer switching to this rendition does not wait for a GOP
+        """
+        self.__force_keyframe = True
+
+    async def recv(self):
+        loop = asyncio.get_event_loop()
+        while not self.__packets:
+            frame = await self.__frames.recv()
+            force_keyframe, self.__force_keyframe = self.__force_keyframe, False
+            try:
+                packets = await loop.run_in_executor(None, self.__encode, frame, force_keyframe)
+            except av.FFmpegError as e:
+                logger.warning(f'Can not encode {rendition_name(self.__height)} rendition: {e}')
+                self.__codec = None
+                continue
+            self.__packets.extend(packets)
+        return self.__packets.popleft()
+
+    def stop(self):
+        super().stop()
+        self.__frames.stop()
+
+    def __size(self, frame):
+        if self.__height is None or self.__height >= frame.height:
+            width, height = frame.width, frame.height
+        else:
+            width, height = round(frame.width * self.__height / frame.height), self.__height
+        # yuv420p needs even dimensions
+        return width // 2 * 2, height // 2 * 2
+
+    def __encode(self, frame, force_keyframe):
+        width, height = self.__size(frame)
+        if self.__codec is None or (self.__codec.width, self.__codec.height) != (width, height):
+            self.__codec = self.__create_codec(width, height, frame.time_base)
+            force_keyframe = False
+
+        pts = frame.pts
+        frame = frame.reformat(width=width, height=height, format='yuv420p')
+        frame.pts, frame.time_base = pts, self.__codec.time_base
+        frame.pict_type = PictureType.I if force_keyframe else PictureType.NONE
+        packets = self.__codec.encode(frame)
+        for packet in packets:
+            packet.time_base = self.__codec.time_base
+        return packets
+
+    def __create_codec(self, width, height, time_base):
+        codec = av.CodecContext.create('libx264', 'w')
+        codec.width, codec.height = width, height
+        codec.pix_fmt = 'yuv420p'
+        codec.time_base = time_base
+        codec.bit_rate = max(MIN_BITRATE, width * height * BITRATE_PER_PIXEL)
+        codec.profile = 'Baseline'
+        # without global header x264 repeats SPS and PPS before every keyframe as browsers need
+        codec.options = {'preset': 'veryfast', 'tune': 'zerolatency', 'keyint': str(self.__gop)}
+        logger.info(f'Encoding {rendition_name(self.__height)} rendition at {width}x{height}')
+        return codec
+
+
+class Rendition:
+    """
+    Step of a camera ladder, packets is SharedTrack of h264 packets,
+    encoded by RenditionEncoder or forwarded from the camera as they are.
+    """
+    __slots__ = ('name', 'packets')
+
+    def __init__(self, name, packets):
+        self.name = name
+        self.packets = packets
+
+    def request_keyframe(self):
+        encoder = self.packets.track
+        if isinstance(encoder, RenditionEncoder):
+            encoder.request_keyframe()
+
+
+class AdaptiveRenditionTrack(MediaStreamTrack):
+    """
+    H264 packets of one viewer taken from one rendition of camera ladder at a time.
+    adapt() watches receiver reports of the viewer: on packet loss above max_loss or round trip
+    time above max_rtt the viewer moves a step down, after upgrade_after seconds of a good link a step up.
+    A switch takes effect at the first keyframe of the new rendition, timestamps are kept increasing.
+    """
+    kind = 'video'
+
+    def __init__(self, cam_id, renditions, max_loss=0.05, max_rtt=0.5, upgrade_after=10):
+        """
+        :param renditions:
+            list of Rendition from the largest one
+        """
+        super().__init__()
+        self.cam_id = cam_id
+        self.__renditions = renditions
+        self.__max_loss = max_loss
+        self.__max_rtt = max_rtt
+        self.__upgrade_after = upgrade_after
+        self.__index = 0
+        self.__current = renditions[0].packets.subscribe()
+        self.__current_next = None
+        self.__pending = None
+        self.__pending_index = None
+        self.__pending_next = None
+        self.__pts_offset = 0
+        self.__last_pts = None
+        self.__last_step = 0
+        self.__adapting = None
+
+    @property
+    def rendition(self):
+        return self.__renditions[self.__index].name
+
+    @property
+    def trace_stage(self):
+        """
+        FrameTracer stage of packets of the current rendition
+        """
+        return self.__renditions[self.__index].packets.trace_stage
+
+    @property
+    def pts_offset(self):
+        """
+        Difference of returned packets pts from the rendition ones
+        """
+        return self.__pts_offset
+
+    def adapt(self, sender, interval=2):
+        """
+        Starts following link quality of RTCRtpSender sending this track
+        """
+        if len(self.__renditions) > 1 and self.__adapting is None:
+            self.__adapting = asyncio.ensure_future(self.__adapt(sender, interval))
+
+    def switch(self, index):
+        index = max(0, min(index, len(self.__renditions) - 1))
+        if index == (self.__index if self.__pending is None else self.__pending_index):
+            return
+        self.__drop_pending()
+        if index == self.__index:
+            return
+        RENDITION_SWITCHES.labels(self.cam_id, 'down' if index > self.__index else 'up').inc()
+        logger.debug(f'Switching viewer of camera {self.cam_id} from {self.rendition} '
+                     f'to {self.__renditions[index].name}')
+        self.__pending_index = index
+        # cached GOP of the new rendition is older than packets already sent, start at a fresh keyframe
+        self.__pending = self.__renditions[index].packets.subscribe(prime=False)
+        self.__renditions[index].request_keyframe()
+
+    async def recv(self):
+        if self.readyState != 'live':
+            raise MediaStreamError
+        return self.__retime(await self.__next_packet())
+
+    def stop(self):
+        super().stop()
+        if self.__adapting is not None:
+            self.__adapting.cancel()
+        self.__drop_pending()
+        if self.__current_next is not None:
+            self.__current_next.cancel()
+        self.__current.stop()
+
+    async def __next_packet(self):
+        while True:
+            if self.__pending is None:
+                if self.__current_next is not None:
+                    task, self.__current_next = self.__current_next, None
+                    return await task
+                return await self.__current.recv()
+
+            if self.__current_next is None:
+                self.__current_next = asyncio.ensure_future(self.__current.recv())
+            if self.__pending_next is None:
+                self.__pending_next = asyncio.ensure_future(self.__pending.recv())
+            await asyncio.wait([self.__current_next, self.__pending_next], return_when=asyncio.FIRST_COMPLETED)
+
+            if self.__pending_next.done():
+                task, self.__pending_next = self.__pending_next, None
+                try:
+                    packet = task.result()
+                except MediaStreamError:
+                    self.__drop_pending()
+                    continue
+                if packet.is_keyframe:
+                    self.__finish_switch()
+                    return packet
+            else:
+                task, self.__current_next = self.__current_next, None
+                return task.result()
+
+    def __finish_switch(self):
+        if self.__current_next is not None:
+            self.__current_next.cancel()
+            self.__current_next = None
+        self.__current.stop()
+        self.__current, self.__index = self.__pending, self.__pending_index
+        self.__pending = self.__pending_index = None
+
+    def __drop_pending(self):
+        if self.__pending_next is not None:
+            self.__pending_next.cancel()
+            self.__pending_next = None
+        if self.__pending is not None:
+            self.__pending.stop()
+            self.__pending = self.__pending_index = None
+
+    def __retime(self, packet):
+        pts = packet.pts + self.__pts_offset
+        if self.__last_pts is not None and pts <= self.__last_pts:
+            # renditions share camera timestamps, but an encoded one is late by its encoding delay
+            self.__pts_offset += self.__last_pts + max(1, self.__last_step) - pts
+            pts = packet.pts + self.__pts_offset
+        if self.__last_pts is not None:
+            self.__last_step = pts - self.__last_pts
+        self.__last_pts = pts
+        if pts != packet.pts:
+            # packets are shared with other viewers, retime a copy
+            packet = copy_packet(packet)
+            packet.pts = packet.dts = pts
+        return packet
+
+    async def __adapt(self, sender, interval):
+        good_since = monotonic()
+        while True:
+            await asyncio.sleep(interval)
+            stats = await sender.getStats()
+            report = next((s for s in stats.values() if s.type == 'remote-inbound-rtp'), None)
+            if report is None:
+                continue
+
+            # fraction lost of a receiver report is 8 bit fixed point
+            loss = report.fractionLost / 256
+            rtt = report.roundTripTime
+            now = monotonic()
+            if loss > self.__max_loss or (rtt is not None and rtt > self.__max_rtt):
+                good_since = now
+                self.switch(self.__index + 1)
+            elif now - good_since >= self.__upgrade_after:
+                good_since = now
+                self.switch(self.__index - 1)
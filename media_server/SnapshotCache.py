@@ -0,0 +1,92 @@
+import asyncio
+import hashlib
+import io
+import logging
+from collections import OrderedDict, namedtuple
+from time import monotonic
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+Snapshot = namedtuple('Snapshot', ['jpeg', 'etag', 'created'])
+
+
+def encode_jpeg(image, width, quality):
+    """
+    Runs in executor.
+    :param image:
+        av.VideoFrame or jpeg bytes
+    :param width:
+        width of the result keeping aspect ratio or None for original size
+    """
+    if isinstance(image, bytes):
+        if width is None:
+            return image
+        im = Image.open(io.BytesIO(image)).convert('RGB')
+        im = im.resize((width, max(1, round(im.height * width / im.width))))
+    else:
+        if width is None:
+            im = image.to_image()
+        else:
+            height = max(2, round(image.height * width / image.width / 2) * 2)
+            im = image.reformat(width=width, height=height, format='rgb24').to_image()
+
+    buf = io.BytesIO()
+    im.save(buf, 'JPEG', quality=quality)
+    return buf.getvalue()
+
+
+class SnapshotCache:
+    """
+    JPEG snapshots of cameras encoded at most once per interval for every camera and width.
+    Concurrent requests of the same snapshot wait for a single encode.
+    The least recently used snapshots are dropped above max_entries.
+    """
+
+    def __init__(self, interval=1, max_entries=256, quality=80):
+        self.interval = interval
+        self.__max_entries = max_entries
+        self.__quality = quality
+        self.__entries = OrderedDict()
+        self.__encoding = {}
+
+    async def get(self, cam_id, width, get_image):
+        """
+        :param get_image:
+            coroutine function returning av.VideoFrame, jpeg bytes or None
+        :return:
+            Snapshot or None if there is no image and nothing cached
+        """
+        key = (cam_id, width)
+        entry = self.__entries.get(key)
+        if entry is not None:
+            self.__entries.move_to_end(key)
+            if monotonic() - entry.created < self.interval:
+                return entry
+
+        if key not in self.__encoding:
+            self.__encoding[key] = asyncio.ensure_future(self.__encode(key, get_image))
+        snapshot = await asyncio.shield(self.__encoding[key])
+        return snapshot if snapshot is not None else entry
+
+    async def __encode(self, key, get_image):
+        _, width = key
+        loop = asyncio.get_event_loop()
+        try:
+            image = await get_image()
+            if image is None:
+                return None
+            jpeg = await loop.run_in_executor(None, encode_jpeg, image, width, self.__quality)
+        except Exception:
+            logger.exception(f'Can not make snapshot of camera {key[0]}')
+            return None
+        finally:
+            self.__encoding.pop(key, None)
+
+        snapshot = Snapshot(jpeg, '"%s"' % hashlib.sha1(jpeg).hexdigest()[:20], monotonic())
+        self.__entries[key] = snapshot
+        self.__entries.move_to_end(key)
+        while len(self.__entries) > self.__max_entries:
+            self.__entries.popitem(last=False)
+        return snapshot
@@ -4,38 +4,86 @@ import asyncio
 import json
 import ssl
 import os
+import sys
 from urllib.parse import urlparse
 
-from aiohttp import web, ClientSession
+from aiohttp import web
 from aiortc import RTCPeerConnection, RTCSessionDescription, MediaStreamTrack
-from aiortc.contrib.media import MediaPlayer
+from aiortc.mediastreams import MediaStreamError
 import aiohttp_jinja2 as aiojinja2
 import jinja2
 
 # nn
-from tensorflow.keras.applications.resnet50 import ResNet50
-from tensorflow.keras.preprocessing import image
-from tensorflow.keras.applications.resnet50 import preprocess_input, decode_predictions
-from tensorflow.keras.utils import get_file
-import numpy as np
 from datetime import datetime
-import keras
 from PIL import ImageDraw, Image, ImageFile
 from urllib.parse import urlparse
 from time import time
-import rtsp
 import io
-
-model = ResNet50(weights='imagenet')
-
-cam_class = {}
-cam_onvif = {}
-cam_rtsp = {}
+from datetime import timedelta
+from zeep.helpers import serialize_object
+from zeep.exceptions import Error as ZeepError
+
+from CameraSourceRegistry import CameraSourceRegistry, CameraSourceError
+from H264Passthrough import (h264_codec, offer_accepts_codec, offer_accepts_h264, offer_kinds,
+                             register_h264_profiles, transcoded_video_codecs)
+from RenditionLadder import AdaptiveRenditionTrack, Rendition, BASELINE_PROFILE_LEVEL_ID, parse_renditions
+from CameraDirectory import CameraDirectory, CameraDirectoryError
+from CameraHealthMonitor import CameraHealthMonitor
+from InferenceExecutor import InferenceExecutor, InferenceDropped
+from InferencePolicy import InferencePolicy
+from Classifier import LazyModel, ModelNotReady, CLASSIFIERS, PREPROCESSING, create_classifier
+from LabelBroadcaster import LabelBroadcaster
+from FrameGrabber import FrameGrabber
+from SnapshotCache import SnapshotCache
+from ONVIFCameraControl import ONVIFCameraControlError
+from ONVIFFleet import ONVIFFleet
+from PTZCommandQueue import PTZCommandQueue
+from PeerRegistry import PeerRegistry, AdmissionRejected
+from WorkerDispatcher import WorkerDispatcher, HashRing
+from Metrics import REGISTRY, Counter, Gauge, monitor_event_loop_lag
+from FrameTracer import TRACER, DECODE, TRANSFORM, INFERENCE
+
+
+cam_labels = LabelBroadcaster()
+cam_ptz = {}
 # nn
 
 
+# the image copies the server to /, keep templates and static next to the script
+ROOT = os.path.dirname(os.path.abspath(__file__))
+# latest frame stamps /trace responds with unless ?limit= is set
+TRACE_RESPONSE_LIMIT = 20000
+
 args = None
-pcs = set()
+model = None
+peers = None
+sources = None
+grabber = None
+snapshots = None
+cam_directory = None
+camera_health = None
+inference = None
+inference_policy = None
+onvif = None
+worker_ring = None
+
+background_tasks = []
+
+PEER_CONNECTIONS = Gauge('webrtc_peer_connections', 'Live peer connections', function=lambda: len(peers))
+SOURCES_OPEN = Gauge('camera_sources_open', 'Open camera sources', function=lambda: len(sources.sources))
+SOURCE_VIEWERS = Gauge('camera_source_users', 'Viewers and grabbers using a camera source', ['camera'],
+                       function=lambda: {(cam_id,): source.refs for cam_id, source in sources.sources.items()})
+INFERENCE_QUEUE_DEPTH = Gauge('inference_queue_depth', 'Frames waiting for inference',
+                              function=lambda: inference.queue_depth)
+INFERENCE_RATE_SCALE = Gauge('inference_rate_scale', 'Fraction of configured inference fps allowed by cpu budget',
+                             function=lambda: inference_policy.scale)
+TRACK_FRAMES_RECEIVED = Counter('track_frames_received_total', 'Frames received by viewer video tracks', ['camera'])
+TRACK_FRAMES_FORWARDED = Counter('track_frames_forwarded_total', 'Frames forwarded by viewer video tracks to encoder',
+                                 ['camera'])
+ONVIF_CAMERAS = Gauge('onvif_cameras', 'ONVIF cameras by connection state', ['state'],
+                      function=lambda: onvif.states())
+CAMERA_HEALTH = Gauge('camera_health', 'Cameras by state of the last RTSP probe', ['state'],
+                      function=lambda: camera_health.states())
 
 cors_headers = {
     'Access-Control-Allow-Origin': '*',
@@ -51,6 +99,125 @@ def get_arguments():
     parser.add_argument("--host", default="0.0.0.0", help="Host for server (default: 0.0.0.0)")
     parser.add_argument("--port", type=int, default=8181, help="Server port (default: 8181)")
     parser.add_argument("--nvr-token", help="NVR api token", required=True)
+    parser.add_argument("--nvr-url", default="https://nvr.miem.hse.ru/api/sources/",
+                        help="NVR camera list url (default: https://nvr.miem.hse.ru/api/sources/)")
+    parser.add_argument("--nvr-cache-ttl", type=float, default=60,
+                        help="Seconds to use cached NVR camera list before revalidating it (default: 60)")
+    parser.add_argument("--nvr-cache-max-stale", type=float, default=3600,
+                        help="Max age in seconds of cached NVR camera list served without waiting for NVR (default: 3600)")
+    parser.add_argument("--health-interval", type=float, default=30,
+                        help="Seconds between RTSP DESCRIBE probes of every NVR camera (default: 30)")
+    parser.add_argument("--health-concurrency", type=int, default=16,
+                        help="Max cameras probed at once (default: 16)")
+    parser.add_argument("--health-timeout", type=float, default=5,
+                        help="Seconds to wait for a camera RTSP DESCRIBE response (default: 5)")
+    parser.add_argument("--source-idle-timeout", type=float, default=10,
+                        help="Seconds to keep a camera source open after its last viewer left (default: 10)")
+    parser.add_argument("--source-open-timeout", type=float, default=10,
+                        help="Seconds to wait for a camera stream to open, also the timeout of its rtsp socket reads, "
+                             "so a stalled camera ends its source (default: 10)")
+    parser.add_argument("--probe-size", type=int,
+                        help="Max bytes read to probe a camera stream when its source is opened (default: ffmpeg one)")
+    parser.add_argument("--analyze-duration", type=float,
+                        help="Max seconds of a camera stream analyzed when its source is opened (default: ffmpeg one)")
+    parser.add_argument("--gop-cache-size", type=int, default=300,
+                        help="Max h264 packets since the last keyframe kept for new viewers of a camera, "
+                             "0 disables the cache (default: 300)")
+    parser.add_argument("--passthrough", action="store_true",
+                        help="Forward camera h264 to browsers without re-encoding, decode keyframes only "
+                             "for classification, transcode only for browsers without the camera h264 profile, "
+                             "audio is forwarded as is for G.711 and opus cameras only")
+    parser.add_argument("--passthrough-codec-timeout", type=float, default=5,
+                        help="Seconds to wait for the first keyframe to learn camera h264 profile (default: 5)")
+    parser.add_argument("--renditions", type=parse_renditions, default=[],
+                        help="Heights of video renditions encoded once per camera and shared by viewers, "
+                             "viewers move between them by link quality, e.g. full,720,240 (default: none)")
+    parser.add_argument("--rendition-max-loss", type=float, default=0.05,
+                        help="Packet loss fraction reported by a viewer that moves it a rendition down (default: 0.05)")
+    parser.add_argument("--rendition-max-rtt", type=float, default=0.5,
+                        help="Round trip seconds of a viewer that move it a rendition down (default: 0.5)")
+    parser.add_argument("--rendition-upgrade-after", type=float, default=10,
+                        help="Seconds of a good link before a viewer moves a rendition up (default: 10)")
+    parser.add_argument("--grabber-idle-timeout", type=float, default=120,
+                        help="Seconds to keep grabbing frames of a camera after the last /classify of it (default: 120)")
+    parser.add_argument("--grabber-max-cameras", type=int, default=32,
+                        help="Max cameras grabbed for /classify and snapshots at once, least recently used "
+                             "is dropped unless it was used in the last seconds (default: 32)")
+    parser.add_argument("--grabber-max-age", type=float, default=1000,
+                        help="Max age in milliseconds of a grabbed frame used by /classify and snapshots, "
+                             "in passthrough mode at least the camera keyframe interval (default: 1000)")
+    parser.add_argument("--snapshot-interval", type=float, default=1,
+                        help="Seconds a camera snapshot is cached before encoding a new one (default: 1)")
+    parser.add_argument("--snapshot-cache-size", type=int, default=256,
+                        help="Max cached snapshots of all cameras and sizes (default: 256)")
+    parser.add_argument("--max-viewers", type=int, default=200,
+                        help="Max WebRTC viewers of all cameras, more offers get 503 (default: 200)")
+    parser.add_argument("--max-camera-viewers", type=int, default=50,
+                        help="Max WebRTC viewers of one camera, more offers get 503 (default: 50)")
+    parser.add_argument("--max-negotiating", type=int, default=20,
+                        help="Max offers negotiated at once, more offers get 503 (default: 20)")
+    parser.add_argument("--negotiation-timeout", type=float, default=15,
+                        help="Seconds to create an answer including ice gathering (default: 15)")
+    parser.add_argument("--connect-timeout", type=float, default=30,
+                        help="Seconds a peer may stay not connected before it is closed (default: 30)")
+    parser.add_argument("--disconnected-timeout", type=float, default=15,
+                        help="Seconds a disconnected peer is kept waiting for reconnect (default: 15)")
+    parser.add_argument("--onvif-port", type=int, default=80, help="Cameras ONVIF port (default: 80)")
+    parser.add_argument("--onvif-login", help="Cameras ONVIF login, if not set rtsp url credentials are used")
+    parser.add_argument("--onvif-password", help="Cameras ONVIF password, if not set rtsp url credentials are used")
+    parser.add_argument("--onvif-concurrency", type=int, default=8,
+                        help="Max cameras connecting to ONVIF at once (default: 8)")
+    parser.add_argument("--onvif-timeout", type=float, default=15,
+                        help="Seconds to wait for a camera ONVIF connection (default: 15)")
+    parser.add_argument("--onvif-retry-interval", type=float, default=30,
+                        help="Seconds before connecting again to a camera whose ONVIF connection failed (default: 30)")
+    parser.add_argument("--onvif-wsdl-cache", help="Sqlite file caching fetched WSDL schemas between runs")
+    parser.add_argument("--onvif-warm-up", action="store_true",
+                        help="Connect ONVIF of all NVR cameras in background at startup")
+    parser.add_argument("--ptz-max-rate", type=float, default=5,
+                        help="Max PTZ commands per second sent to one camera, newer commands replace queued ones (default: 5)")
+    parser.add_argument("--inference-workers", type=int, default=1,
+                        help="Number of inference threads (default: 1)")
+    parser.add_argument("--inference-queue-size", type=int, default=32,
+                        help="Max frames waiting for inference, older frames are dropped (default: 32)")
+    parser.add_argument("--inference-batch-size", type=int, default=8,
+                        help="Max frames from all cameras classified in one model call (default: 8)")
+    parser.add_argument("--inference-max-delay", type=float, default=50,
+                        help="Max milliseconds a frame waits for its batch to fill up (default: 50)")
+    parser.add_argument("--inference-fps", type=float, default=1,
+                        help="Max frames of one camera classified per second, shared by all its viewers (default: 1)")
+    parser.add_argument("--motion-threshold", type=float, default=2,
+                        help="Min mean gray level difference in range [0, 255] from the last classified frame "
+                             "to classify a frame again, 0 classifies every frame (default: 2)")
+    parser.add_argument("--motion-refresh", type=float, default=30,
+                        help="Seconds after which a camera is classified again even without motion (default: 30)")
+    parser.add_argument("--inference-cpu-budget", type=float, default=0.8,
+                        help="Fraction of inference workers time above which inference fps of all cameras "
+                             "is lowered (default: 0.8)")
+    parser.add_argument("--model-load", choices=["startup", "first-use"], default="startup",
+                        help="When to start loading classifier model in background (default: startup)")
+    parser.add_argument("--classifier", choices=CLASSIFIERS, default="resnet50",
+                        help="Classifier backend, tflite and onnx load --classifier-model, e.g. int8 quantized "
+                             "MobileNet (default: resnet50)")
+    parser.add_argument("--classifier-model", help="Model file of tflite and onnx classifiers")
+    parser.add_argument("--classifier-labels",
+                        help="Class names of tflite and onnx classifiers, one per line in model output order")
+    parser.add_argument("--classifier-preprocessing", choices=sorted(PREPROCESSING),
+                        help="Input normalization of tflite and onnx classifiers (default: tf for tflite, "
+                             "torch for onnx)")
+    parser.add_argument("--classifier-threads", type=int, default=1,
+                        help="Threads of one tflite or onnx model call (default: 1)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of media server processes, cameras are split between them (default: 1)")
+    parser.add_argument("--worker-base-port", type=int,
+                        help="Internal port of the first worker, next workers use next ports (default: port + 1)")
+    parser.add_argument("--worker-index", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--trace-sample-every", type=int, default=0,
+                        help="Trace latency of every n-th frame of a camera through the pipeline, "
+                             "see /trace, 0 disables tracing (default: 0)")
+    parser.add_argument("--trace-buffer-size", type=int, default=100000,
+                        help="Max frame stamps kept for /trace, older ones are overwritten (default: 100000)")
+    parser.add_argument("--trace-file", help="Chrome trace json file the frame trace is saved to on shutdown")
     parser.add_argument("--verbose", "-v", action="count")
     return parser.parse_args()
 
@@ -58,70 +225,227 @@ def get_arguments():
 class VideoTransformTrack(MediaStreamTrack):
     kind = "video"
 
-    def __init__(self, track, cam_id):
+    def __init__(self, track, cam_id, peer_id=None):
         super().__init__()
         self.track = track
-        self.timestamp_sec = -1
         self.last_text = ''
         self.cam_id = cam_id
+        self.peer_id = peer_id
+        # pts of the last returned frame if it is traced, FrameTracer stamps it when it is sent
+        self.traced_pts = None
+        self.frames_received = TRACK_FRAMES_RECEIVED.labels(cam_id)
+        self.frames_forwarded = TRACK_FRAMES_FORWARDED.labels(cam_id)
 
     async def recv(self):
-        global cam_class
         frame = await self.track.recv()
-        if datetime.now().second != self.timestamp_sec:
-            im = frame.to_image()
-            im = im.resize((224, 224))
-            x = image.img_to_array(im)
-            x = np.expand_dims(x, axis=0)
-            x = preprocess_input(x)
-            preds = model.predict(x)
-            self.timestamp_sec = datetime.now().second
-            self.last_text = '   '.join((i[1] for i in decode_predictions(preds, top=3)[0]))
-            cam_class[self.cam_id] = self.last_text
+        self.frames_received.inc()
+        self.classify(frame)
         # frame = frame.reformat(width=320, height=240)
+        self.frames_forwarded.inc()
+        if TRACER.stamp(self.cam_id, frame.pts, TRANSFORM, self.peer_id, after=DECODE):
+            self.traced_pts = frame.pts
         return frame
 
+    def classify(self, frame):
+        if not model.ready:
+            model.ensure_loading()
+        else:
+            pending = inference_policy.submit(self.cam_id, frame)
+            if pending is not None:
+                pending.add_done_callback(self.on_classified)
+                if TRACER.traced(self.cam_id, frame.pts):
+                    pending.add_done_callback(lambda _, pts=frame.pts: TRACER.stamp(self.cam_id, pts, INFERENCE))
+
+    def on_classified(self, future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        self.last_text = '   '.join(future.result())
+        cam_labels.publish(self.cam_id, future.result())
+
+
+class PassthroughTrack(VideoTransformTrack):
+    """
+    Forwards camera h264 packets as they are, aiortc packetizes them without encoding.
+    Keyframes decoded once per camera are classified instead of the forwarded frames.
+    """
+
+    def __init__(self, track, keyframes, cam_id, peer_id=None):
+        """
+        :param track:
+            AdaptiveRenditionTrack
+        """
+        super().__init__(track, cam_id, peer_id)
+        self.keyframes = keyframes
+        self.classifying = asyncio.ensure_future(self.classify_keyframes())
+
+    async def classify_keyframes(self):
+        while True:
+            try:
+                frame = await self.keyframes.recv()
+            except MediaStreamError:
+                return
+            self.classify(frame)
+
+    async def recv(self):
+        packet = await self.track.recv()
+        self.frames_received.inc()
+        self.frames_forwarded.inc()
+        # stamp the camera packet this one is retimed from
+        pts = packet.pts - self.track.pts_offset
+        if TRACER.stamp(self.cam_id, pts, TRANSFORM, self.peer_id, after=self.track.trace_stage):
+            self.traced_pts = pts
+        return packet
+
+    def stop(self):
+        super().stop()
+        self.classifying.cancel()
+        self.track.stop()
+        self.keyframes.stop()
+
+
+def predict_top3(frames):
+    """
+    Runs in inference thread.
+    :param frames:
+        list of av.VideoFrame or PIL images
+    :return:
+        list with 3 most probable class names for every frame
+    """
+    return model.get().classify(frames, top=3)
+
 
 async def offer(request):
     request_url = request.match_info['stream']
-    streams = await get_streams(args.nvr_token)
+    cam = await get_cam(request_url)
 
-    if request_url not in streams:
+    if cam is None:
         raise web.HTTPNotFound(text='No rtsp source related to this url')
 
-    play_from = streams[request_url]
+    play_from = cam['rtsp']
     if not play_from:
         raise web.HTTPBadGateway(text='NVR response with cam rtsp link is empty. Contact NVR admins to fix it')
 
-    url = urlparse(play_from)
-    if url.scheme == 'rtsp':
-        await check_rtsp_availability(play_from, timeout=10)
+    try:
+        peer = peers.admit(request_url)
+    except AdmissionRejected as e:
+        raise web.HTTPServiceUnavailable(headers={**cors_headers, 'Retry-After': str(e.retry_after)}, text=str(e))
+
+    subscribed_tracks = []
 
-    params = await request.json()
-    offer = RTCSessionDescription(sdp=params["sdp"], type=params["type"])
+    def release_source():
+        for subscribed_track in subscribed_tracks:
+            subscribed_track.stop()
+        sources.release(source)
+
+    try:
+        url = urlparse(play_from)
+        # a camera streaming to other viewers is available whatever its last probe said
+        if url.scheme == 'rtsp' and not sources.is_live(request_url):
+            health = await camera_health.ensure(request_url, play_from)
+            if not health.available:
+                raise web.HTTPBadGateway(text=health.error)
+
+        params = await request.json()
+        ensure_open(peer)
+        offer = RTCSessionDescription(sdp=params["sdp"], type=params["type"])
+
+        try:
+            source = await sources.acquire(request_url, play_from, timeout=args.source_open_timeout)
+        except CameraSourceError:
+            camera_health.forget(request_url)
+            raise web.HTTPBadGateway(text='Can not open rtsp media source')
+        if peer.closed:
+            sources.release(source)
+        ensure_open(peer)
+        peer.on_close = release_source
+
+        # h264 packets go to the browser without encoding them for this viewer: camera packets in passthrough mode
+        # and renditions encoded once per camera, the rest is transcoded by aiortc for every viewer
+        packets_codec, ladder = None, []
+        if source.packets is not None:
+            profile_level_id = await source.wait_codec(timeout=args.passthrough_codec_timeout)
+            ensure_open(peer)
+            if profile_level_id is not None and offer_accepts_h264(offer.sdp, profile_level_id):
+                packets_codec = h264_codec(profile_level_id)
+                if packets_codec is not None:
+                    ladder = source.renditions or [Rendition('full', source.packets)]
+        if not ladder and source.renditions and offer_accepts_h264(offer.sdp, BASELINE_PROFILE_LEVEL_ID):
+            ladder = [r for r in source.renditions if r.packets is not source.packets]
+            packets_codec = h264_codec(BASELINE_PROFILE_LEVEL_ID)
+        if not ladder and (source.packets is not None or source.renditions):
+            print(f"Browser can not play h264 of camera {request_url} as is, transcoding it")
+        # aiortc encodes video of the rest itself, keep them off the h264 profiles registered for passthrough
+        transcoded_codecs = transcoded_video_codecs() \
+            if not ladder and source.video and 'video' in offer_kinds(offer.sdp) else None
+
+        # camera audio in passthrough mode is sent by its own codec, aiortc would label it as the negotiated one
+        audio_codec = None
+        if source.audio_packet_track is not None:
+            audio_codec = await source.wait_audio_codec(timeout=args.passthrough_codec_timeout)
+            ensure_open(peer)
+            if audio_codec is not None and not offer_accepts_codec(offer.sdp, audio_codec):
+                audio_codec = None
+            if audio_codec is None:
+                print(f"Browser can not play audio of camera {request_url} as is, sending video only")
+    except BaseException:
+        await peers.close_peer(peer)
+        raise
 
     pc = RTCPeerConnection()
-    pcs.add(pc)
+    peer.pc = pc
 
     @pc.on("iceconnectionstatechange")
     async def on_iceconnectionstatechange():
         print("ICE connection state is %s" % pc.iceConnectionState)
-        if pc.iceConnectionState == "failed":
-            await pc.close()
-            pcs.discard(pc)
-
-    player = MediaPlayer(play_from)
-
-    await pc.setRemoteDescription(offer)
-    for t in pc.getTransceivers():
-        if t.kind == "audio" and player.audio:
-            pc.addTrack(player.audio)
-        elif t.kind == "video" and player.video:
-            track = VideoTransformTrack(player.video, request_url)
-            pc.addTrack(track)
+        if pc.iceConnectionState in ("failed", "closed"):
+            await peers.close_peer(peer)
+
+    async def negotiate():
+        if ladder:
+            # the offer takes codec preferences of a transceiver that exists before it is applied
+            renditions = AdaptiveRenditionTrack(request_url, ladder, max_loss=args.rendition_max_loss,
+                                                max_rtt=args.rendition_max_rtt,
+                                                upgrade_after=args.rendition_upgrade_after)
+            track = PassthroughTrack(renditions, source.keyframes.subscribe(), request_url, peer.id)
+            subscribed_tracks.append(track)
+            transceiver = pc.addTransceiver(track, direction="sendonly")
+            transceiver.setCodecPreferences([packets_codec])
+            renditions.adapt(transceiver.sender)
+            TRACER.trace_sender(transceiver.sender, track, request_url, peer.id)
+        elif transcoded_codecs is not None:
+            pc.addTransceiver("video", direction="sendonly").setCodecPreferences(transcoded_codecs)
+        if audio_codec is not None:
+            subscribed_tracks.append(source.audio.subscribe())
+            pc.addTransceiver(subscribed_tracks[-1], direction="sendonly").setCodecPreferences([audio_codec])
+        await pc.setRemoteDescription(offer)
+        for t in pc.getTransceivers():
+            if t.kind == "audio" and source.audio and source.audio_packet_track is None:
+                subscribed_tracks.append(source.audio.subscribe())
+                pc.addTrack(subscribed_tracks[-1])
+            elif t.kind == "video" and t.sender.track is None and source.video:
+                subscribed_tracks.append(source.video.subscribe())
+                track = VideoTransformTrack(subscribed_tracks[-1], request_url, peer.id)
+                TRACER.trace_sender(pc.addTrack(track), track, request_url, peer.id)
+
+        answer = await pc.createAnswer()
+        # gathers ice candidates, that may take long
+        await pc.setLocalDescription(answer)
 
-    answer = await pc.createAnswer()
-    await pc.setLocalDescription(answer)
+    try:
+        await asyncio.wait_for(negotiate(), args.negotiation_timeout)
+    except asyncio.TimeoutError:
+        await peers.close_peer(peer)
+        raise web.HTTPGatewayTimeout(headers=cors_headers, text='WebRTC negotiation timed out')
+    except BaseException as e:
+        # negotiation fails on RTCPeerConnection closed by the reaper meanwhile
+        reaped = peer.closed and isinstance(e, Exception)
+        await peers.close_peer(peer)
+        if reaped:
+            ensure_open(peer)
+        raise
+    # closed meanwhile along with its RTCPeerConnection, the answer is of no use
+    ensure_open(peer)
+    peers.negotiated(peer)
 
     return web.Response(
         content_type="application/json",
@@ -133,122 +457,321 @@ async def offer(request):
     )
 
 
+def ensure_open(peer):
+    """
+    :raise web.HTTPServiceUnavailable:
+        if the reaper or shutdown closed peer while its offer was waiting
+    """
+    if peer.closed:
+        raise web.HTTPServiceUnavailable(headers={**cors_headers, 'Retry-After': '2'},
+                                         text='Viewer was closed before its offer was answered, try again')
+
+
 async def js_cors_preflight(request):
     headers = cors_headers
     return web.Response(headers=headers, text="ok")
 
 
-async def get_cams(nvr_token):
-    headers = {"key": nvr_token}
+async def get_cam(cam_id):
+    try:
+        return await cam_directory.get_cam(cam_id)
+    except CameraDirectoryError:
+        raise web.HTTPBadGateway(text='Can not get camera list from NVR')
 
-    async with ClientSession() as session:
-        async with session.get('https://nvr.miem.hse.ru/api/sources/',
-                               headers=headers) as resp:
-            text = await resp.text()
-            cams = json.loads(text)
-    return cams
 
+async def get_cams():
+    try:
+        return await cam_directory.get_cams()
+    except CameraDirectoryError:
+        raise web.HTTPBadGateway(text='Can not get camera list from NVR')
 
-async def get_streams(nvr_token):
-    cams = await get_cams(nvr_token)
-    streams = {
-        str(cam['id']): cam['rtsp']
-        for cam in cams
-    }
-    return streams
 
-async def check_rtsp_availability(rtsp_link, timeout):
-    """
-    This function needed because some rtsp links requires
-    to authenticate and pyav lib may freeze in such cases.
-    If some rtsp link require authentication contact NVR admins to replace it with working link.
-    """
-    url = urlparse(rtsp_link)
-    ip = url.hostname
-    port = url.port if url.port else 554
-    reader = None
-    writer = None
+async def on_startup(app):
+    await inference.start()
+    await grabber.start()
+    await peers.start()
+    await camera_health.start()
+    background_tasks.append(asyncio.ensure_future(monitor_event_loop_lag()))
+    if args.model_load == "startup":
+        model.ensure_loading()
+    if args.onvif_warm_up:
+        background_tasks.append(asyncio.ensure_future(warm_up_onvif()))
+
 
+async def warm_up_onvif():
     try:
-        reader, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), timeout=timeout)
-        is_available = bool(reader) and bool(writer)
-    except asyncio.TimeoutError:
-        raise web.HTTPBadGateway(text='Can not establish connection with rtsp media source')
-    except OSError:
-        raise web.HTTPBadGateway(text='Can not establish connection with rtsp media source')
-    finally:
-        if writer:
-            writer.close()
-            await writer.wait_closed()
-
-    if not is_available:
-        raise web.HTTPBadGateway(text='Can not establish connection with rtsp media source')
-
-    # message = f'DESCRIBE {rtsp_link} RTSP/1.0\nCSeq: 1\n\n'
-    # writer.write(message.encode())
-    # await writer.drain()
-    #
-    # data = await reader.read(1000)
-    # writer.close()
-    # await writer.wait_closed()
-    #
-    # describe_reply = data.decode().split()
-    # if describe_reply[1] == '401':
-    #     raise web.HTTPBadGateway(text='rtsp stream require authentication')
+        cams = await get_cams()
+    except web.HTTPException:
+        return
+    await onvif.warm_up([cam for cam in cams if owns_camera(cam['id'])])
+
+
+def owns_camera(cam_id):
+    # every worker serves only cameras dispatcher routes to it
+    return worker_ring is None or worker_ring.get(cam_id) == args.worker_index
 
 
 async def on_shutdown(app):
-    coros = [pc.close() for pc in pcs]
-    await asyncio.gather(*coros)
-    pcs.clear()
+    for task in background_tasks:
+        task.cancel()
+    await peers.close()
+    await camera_health.close()
+    onvif.close()
+    await grabber.close()
+    await sources.close()
+    await cam_directory.close()
+    await inference.close()
+    if args.trace_file and TRACER.enabled:
+        # every worker saves its own cameras
+        path = args.trace_file if args.worker_index is None else f'{args.trace_file}.{args.worker_index}'
+        TRACER.dump(path)
+        print(f'Frame trace saved to {path}')
 
 
 @aiojinja2.template('index.html')
 async def index(request):
-    cams = await get_cams(args.nvr_token)
-    return {'cams': cams}
+    cams = await get_cams()
+    return {'cams': cams, 'health': camera_health.table}
 
 
 async def classify(request):
     cam_id = request.match_info['stream']
-    cams = await get_cams(args.nvr_token)
-    cam_info = [cam for cam in cams if str(cam['id']) == cam_id]
-    if not cam_info:
+    if not model.ready:
+        model.ensure_loading()
+        raise web.HTTPServiceUnavailable(headers={**cors_headers, 'Retry-After': '5'},
+                                         text=f'Classifier model is {model.state}, try again later')
+
+    cam_info = await get_cam(cam_id)
+    if cam_info is None:
         raise web.HTTPNotFound(text='No rtsp source related to this url')
-    cam_info = cam_info[0]
     play_from = cam_info['rtsp']
 
-    if cam_id not in cam_rtsp:
-        cam_rtsp[cam_id] = {}
-        cam_rtsp[cam_id]['client'] = rtsp.Client(play_from)
-        cam_rtsp[cam_id]['time'] = time()
-
-    if (time() - cam_rtsp[cam_id]['time']) > 120:
-        cam_rtsp[cam_id]['client'].close()
-        cam_rtsp[cam_id]['client'] = rtsp.Client(play_from)
-        cam_rtsp[cam_id]['time'] = time()
-
-    im = cam_rtsp[cam_id]['client'].read()
-    if im:
-        im = im.resize((224, 224))
-        x = image.img_to_array(im)
-        x = np.expand_dims(x, axis=0)
-        x = preprocess_input(x)
-        preds = model.predict(x)
-        text = str([i[1] for i in decode_predictions(preds, top=3)[0]])
+    try:
+        frame = await grabber.grab(cam_id, play_from, max_age=args.grabber_max_age / 1000, timeout=5)
+    except CameraSourceError:
+        raise web.HTTPBadGateway(text='Can not open rtsp media source')
+
+    if frame is not None:
+        try:
+            labels = await inference.submit(frame)
+            cam_labels.publish(cam_id, labels)
+            text = str(labels)
+        except (InferenceDropped, ModelNotReady):
+            raise web.HTTPServiceUnavailable(headers={**cors_headers, 'Retry-After': '1'},
+                                             text='Classifier is not available, try again later')
     else:
         text = ''
     return web.Response(headers=cors_headers, text=text)
 
 
+async def fetch_onvif_snapshot(cam_id, play_from):
+    control = await onvif.get(cam_id, play_from)
+    return await control.fetch(await control.get_snapshot_uri())
+
+
+async def snapshot_image(cam_id, play_from):
+    max_age = args.grabber_max_age / 1000
+    frame = grabber.latest(cam_id, max_age)
+    if frame is not None:
+        return frame
+
+    # frames of streamed cameras are decoded anyway, otherwise ask camera itself before opening rtsp
+    if cam_id not in sources.sources and onvif.credentials(play_from)[1]:
+        try:
+            return await fetch_onvif_snapshot(cam_id, play_from)
+        except Exception as e:
+            print(f'Can not get ONVIF snapshot of camera {cam_id}: {e}')
+
+    return await grabber.grab(cam_id, play_from, max_age=max_age, timeout=5)
+
+
+async def snapshot(request):
+    cam_id = request.match_info['stream']
+    width = request.query.get('width')
+    if width is not None:
+        if not width.isdigit() or not 16 <= int(width) <= 3840:
+            raise web.HTTPBadRequest(text='width must be an integer in range [16, 3840]')
+        width = int(width)
+
+    cam = await get_cam(cam_id)
+    if cam is None:
+        raise web.HTTPNotFound(text='No rtsp source related to this url')
+    if not cam['rtsp']:
+        raise web.HTTPBadGateway(text='NVR response with cam rtsp link is empty. Contact NVR admins to fix it')
+
+    snap = await snapshots.get(cam_id, width, lambda: snapshot_image(cam_id, cam['rtsp']))
+    if snap is None:
+        raise web.HTTPBadGateway(text='Can not get snapshot of camera')
+
+    headers = {**cors_headers, 'ETag': snap.etag, 'Cache-Control': f'max-age={int(snapshots.interval)}'}
+    if_none_match = request.headers.get('If-None-Match', '')
+    if if_none_match.strip() == '*' or snap.etag in (tag.strip() for tag in if_none_match.split(',')):
+        return web.Response(status=304, headers=headers)
+    return web.Response(body=snap.jpeg, content_type='image/jpeg', headers=headers)
+
+
+PTZ_ACTIONS = {'move_continuous', 'move_relative', 'move_absolute', 'stop', 'go_home',
+               'goto_preset', 'set_preset'}
+# checked before queueing, PTZCommandQueue merges commands by these params
+PTZ_REQUIRED = {'move_continuous': ('ptz_velocity',), 'move_relative': ('ptz_position',),
+                'move_absolute': ('ptz_position',), 'goto_preset': ('preset_token',)}
+PTZ_VECTORS = ('ptz_position', 'ptz_velocity')
+FOCUS_ACTIONS = {'move_focus_continuous', 'move_focus_absolute', 'stop_focus', 'set_focus_mode'}
+IMAGING_SETTINGS = ('brightness', 'contrast', 'sharpness', 'color_saturation')
+
+
+async def get_camera_control(request):
+    cam_id = request.match_info['stream']
+    cam = await get_cam(cam_id)
+    if cam is None:
+        raise web.HTTPNotFound(text='No rtsp source related to this url')
+    if not cam['rtsp']:
+        raise web.HTTPBadGateway(text='NVR response with cam rtsp link is empty. Contact NVR admins to fix it')
+    try:
+        return await onvif.get(cam_id, cam['rtsp'])
+    except Exception as e:
+        raise web.HTTPBadGateway(text=f'Can not connect to camera ONVIF service: {e}')
+
+
+async def call_camera(coro):
+    try:
+        return await coro
+    except TypeError as e:
+        raise web.HTTPBadRequest(text=str(e))
+    except (ONVIFCameraControlError, ZeepError) as e:
+        raise web.HTTPBadGateway(text=f'Camera ONVIF call failed: {e}')
+
+
+def camera_json_response(data):
+    return web.json_response(serialize_object(data), headers=cors_headers,
+                             dumps=lambda obj: json.dumps(obj, default=str))
+
+
+async def ptz(request):
+    """
+    GET returns presets, POST runs one of PTZ_ACTIONS:
+    {"action": "move_continuous", "ptz_velocity": [0.5, 0, 0]}
+    """
+    control = await get_camera_control(request)
+    if request.method == 'GET':
+        return camera_json_response(await call_camera(control.get_presets()))
+
+    params = await request.json()
+    action = params.pop('action', None)
+    if action not in PTZ_ACTIONS:
+        raise web.HTTPBadRequest(text=f'action must be one of {sorted(PTZ_ACTIONS)}')
+    for name in PTZ_REQUIRED.get(action, ()):
+        if name not in params:
+            raise web.HTTPBadRequest(text=f'{action} requires {name}')
+    for name in PTZ_VECTORS:
+        vector = params.get(name)
+        if vector is not None and not (isinstance(vector, list) and len(vector) == 3
+                                       and all(isinstance(v, (int, float)) for v in vector)):
+            raise web.HTTPBadRequest(text=f'{name} must be a list of 3 numbers: pan, tilt, zoom')
+    if 'timeout' in params:
+        if not isinstance(params['timeout'], (int, float)):
+            raise web.HTTPBadRequest(text='timeout must be a number of seconds')
+        params['timeout'] = timedelta(seconds=params['timeout'])
+
+    cam_id = request.match_info['stream']
+    queue = cam_ptz.get(cam_id)
+    if queue is None or queue.control is not control:
+        queue = cam_ptz[cam_id] = PTZCommandQueue(control, max_rate=args.ptz_max_rate)
+
+    loop = asyncio.get_event_loop()
+    started = loop.time()
+    result = await call_camera(queue.submit(action, **params))
+    response = camera_json_response(result)
+    response.headers['Server-Timing'] = f'ptz;dur={(loop.time() - started) * 1000:.1f}'
+    return response
+
+
+async def imaging(request):
+    """
+    GET returns imaging settings, POST changes settings and/or runs one of FOCUS_ACTIONS:
+    {"brightness": 60, "contrast": 40}
+    {"action": "move_focus_continuous", "speed": 0.5}
+    """
+    control = await get_camera_control(request)
+    if request.method == 'POST':
+        params = await request.json()
+        action = params.pop('action', None)
+        settings = {name: params.pop(name) for name in IMAGING_SETTINGS + ('focus_mode',) if name in params}
+        if action is not None and action not in FOCUS_ACTIONS:
+            raise web.HTTPBadRequest(text=f'action must be one of {sorted(FOCUS_ACTIONS)}')
+        if action is None and params:
+            raise web.HTTPBadRequest(text=f'Unknown settings {sorted(params)}')
+
+        if settings:
+            await call_camera(control.update_imaging(**settings))
+        if action is not None:
+            await call_camera(getattr(control, action)(**params))
+
+    values = await call_camera(asyncio.gather(*(getattr(control, f'get_{name}')() for name in IMAGING_SETTINGS)))
+    return camera_json_response(dict(zip(IMAGING_SETTINGS, values)))
+
+
+async def labels(request):
+    cam_id = request.match_info['stream']
+    if await get_cam(cam_id) is None:
+        raise web.HTTPNotFound(text='No rtsp source related to this url')
+
+    ws = web.WebSocketResponse(heartbeat=30)
+    await ws.prepare(request)
+
+    async def send_labels(queue):
+        try:
+            while True:
+                await ws.send_str(await queue.get())
+        except ConnectionError:
+            # client is gone without a close frame, stop waiting for its messages too
+            await ws.close()
+
+    queue = cam_labels.subscribe(cam_id)
+    sender = asyncio.ensure_future(send_labels(queue))
+    try:
+        # messages from client are not expected, just wait until it disconnects
+        async for _ in ws:
+            pass
+    finally:
+        sender.cancel()
+        cam_labels.unsubscribe(cam_id, queue)
+        # retrieve whatever the sender ended with, it is not interesting once the client left
+        await asyncio.gather(sender, return_exceptions=True)
+    return ws
+
+
+async def metrics(request):
+    return web.Response(text=REGISTRY.render(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+async def trace(request):
+    if not TRACER.enabled:
+        raise web.HTTPNotFound(headers=cors_headers, text='Frame tracing is off, see --trace-sample-every')
+    limit = request.query.get('limit', str(TRACE_RESPONSE_LIMIT))
+    if not limit.isdigit() or int(limit) < 1:
+        raise web.HTTPBadRequest(headers=cors_headers, text='limit must be a positive integer')
+
+    stamps = TRACER.snapshot(request.match_info.get('stream'), int(limit))
+    # up to a buffer of events to build and encode, keep the loop streaming meanwhile
+    body = await asyncio.get_event_loop().run_in_executor(None, lambda: json.dumps(TRACER.chrome_trace(stamps)))
+    return web.Response(text=body, content_type='application/json', headers=cors_headers)
+
+
+async def ready(request):
+    cameras = {cam_id: health.to_json() for cam_id, health in camera_health.table.items()}
+    return web.json_response({'model': dict(model.status(), classifier=args.classifier), 'peers': peers.status(),
+                              'cameras': cameras}, headers=cors_headers)
+
+
 async def get_link(request):
     request_url = request.match_info['stream']
-    streams = await get_streams(args.nvr_token)
+    cam = await get_cam(request_url)
 
-    if request_url not in streams:
+    if cam is None:
         raise web.HTTPNotFound(text='No rtsp source related to this url')
 
-    play_from = streams[request_url]
+    play_from = cam['rtsp']
     if not play_from:
         raise web.HTTPBadGateway(text='NVR response with cam rtsp link is empty. Contact NVR admins to fix it')
 
@@ -269,9 +792,55 @@ if __name__ == "__main__":
     else:
         ssl_context = None
 
-    # media = web.Application()
-    # media.router.add_post("/{stream}", offer)
-    # media.router.add_options("/{stream}", js_cors_preflight)
+    if args.workers > 1 and args.worker_index is None:
+        # workers serve plain http on localhost, tls is terminated here
+        dispatcher = WorkerDispatcher(sys.argv[0], sys.argv[1:], args.workers, args.worker_base_port or args.port + 1)
+        web.run_app(dispatcher.create_app(), host=args.host, port=args.port, ssl_context=ssl_context)
+        sys.exit()
+
+    # ffmpeg rtsp socket i/o timeout in microseconds, without it opening or reading a stalled camera never ends
+    probe_options = {'timeout': str(int(args.source_open_timeout * 1000000))}
+    if args.probe_size is not None:
+        probe_options['probesize'] = str(args.probe_size)
+    if args.analyze_duration is not None:
+        probe_options['analyzeduration'] = str(int(args.analyze_duration * 1000000))
+    if args.passthrough:
+        register_h264_profiles()
+    sources = CameraSourceRegistry(idle_timeout=args.source_idle_timeout, passthrough=args.passthrough,
+                                   renditions=args.renditions, gop_cache_size=args.gop_cache_size,
+                                   player_options={'options': probe_options})
+    # a camera polled for snapshots asks for a frame once a snapshot interval
+    grabber = FrameGrabber(sources, idle_timeout=args.grabber_idle_timeout, max_cameras=args.grabber_max_cameras,
+                           keep_recent=max(10, 3 * args.snapshot_interval))
+    snapshots = SnapshotCache(interval=args.snapshot_interval, max_entries=args.snapshot_cache_size)
+    cam_directory = CameraDirectory(args.nvr_url, args.nvr_token,
+                                    ttl=args.nvr_cache_ttl, max_stale=args.nvr_cache_max_stale)
+    if args.worker_index is not None:
+        worker_ring = HashRing(range(args.workers))
+    camera_health = CameraHealthMonitor(cam_directory, interval=args.health_interval,
+                                        concurrency=args.health_concurrency, timeout=args.health_timeout,
+                                        owns=owns_camera)
+    try:
+        model = LazyModel(create_classifier(args.classifier, args.classifier_model, args.classifier_labels,
+                                            args.classifier_preprocessing, batch_size=args.inference_batch_size,
+                                            threads=args.classifier_threads).load)
+    except ValueError as e:
+        sys.exit(str(e))
+    inference = InferenceExecutor(predict_top3, max_queue=args.inference_queue_size, workers=args.inference_workers,
+                                  batch_size=args.inference_batch_size, max_delay=args.inference_max_delay / 1000)
+    TRACER.configure(args.trace_sample_every, capacity=args.trace_buffer_size)
+    inference_policy = InferencePolicy(inference, fps=args.inference_fps, motion_threshold=args.motion_threshold,
+                                       refresh_interval=args.motion_refresh, cpu_budget=args.inference_cpu_budget)
+    peers = PeerRegistry(max_peers=args.max_viewers, max_camera_peers=args.max_camera_viewers,
+                         max_negotiating=args.max_negotiating, connect_timeout=args.connect_timeout,
+                         disconnected_timeout=args.disconnected_timeout)
+    onvif = ONVIFFleet(port=args.onvif_port, login=args.onvif_login, password=args.onvif_password,
+                       concurrency=args.onvif_concurrency, timeout=args.onvif_timeout,
+                       retry_interval=args.onvif_retry_interval, wsdl_cache=args.onvif_wsdl_cache)
+
+    media = web.Application()
+    media.router.add_post("/{stream}", offer)
+    media.router.add_options("/{stream}", js_cors_preflight)
 
     classifier = web.Application()
     classifier.router.add_post("/{stream}", classify)
@@ -282,13 +851,26 @@ if __name__ == "__main__":
     link_getter.router.add_options("/{stream}", js_cors_preflight)
 
     app = web.Application()
-    # app.add_subapp("/media/", media)
+    app.add_subapp("/media/", media)
     app.add_subapp("/classify/", classifier)
     app.add_subapp("/link/", link_getter)
+    app.on_startup.append(on_startup)
     app.on_shutdown.append(on_shutdown)
 
-    aiojinja2.setup(app, loader=jinja2.FileSystemLoader('/templates/'))
+    aiojinja2.setup(app, loader=jinja2.FileSystemLoader(os.path.join(ROOT, 'templates')))
     app.router.add_get('/', index)
-    app.router.add_static('/static/', path='/static')
+    app.router.add_get('/ready', ready)
+    app.router.add_get('/metrics', metrics)
+    app.router.add_get('/trace', trace)
+    app.router.add_get('/trace/{stream}', trace)
+    app.router.add_get('/labels/{stream}', labels)
+    app.router.add_get('/snapshot/{stream}', snapshot)
+    app.router.add_route('GET', '/ptz/{stream}', ptz)
+    app.router.add_route('POST', '/ptz/{stream}', ptz)
+    app.router.add_options('/ptz/{stream}', js_cors_preflight)
+    app.router.add_route('GET', '/imaging/{stream}', imaging)
+    app.router.add_route('POST', '/imaging/{stream}', imaging)
+    app.router.add_options('/imaging/{stream}', js_cors_preflight)
+    app.router.add_static('/static/', path=os.path.join(ROOT, 'static'))
 
     web.run_app(app, host=args.host, port=args.port, ssl_context=ssl_context)
@@ -0,0 +1,365 @@
+import asyncio
+import hashlib
+import logging
+import sys
+from bisect import bisect
+from collections import OrderedDict
+from time import monotonic
+
+import aiohttp
+from aiohttp import web
+from multidict import CIMultiDict
+
+from Metrics import Registry, Counter, Gauge, format_labels
+
+logger = logging.getLogger(__name__)
+
+# first path segment of requests about a single camera, the second one is camera id
+CAMERA_ROUTES = {'media', 'classify', 'link', 'labels', 'snapshot', 'ptz', 'imaging', 'trace'}
+HOP_BY_HOP_HEADERS = {'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te', 'trailers',
+                      'transfer-encoding', 'upgrade', 'host', 'content-length'}
+# options of the dispatcher command line replaced in worker command lines
+DISPATCHER_OPTIONS = {'--host', '--port', '--cert-file', '--key-file', '--workers', '--worker-base-port',
+                      '--worker-index'}
+
+
+def hash_key(key):
+    # builtin hash() differs between processes
+    return int(hashlib.md5(str(key).encode()).hexdigest()[:16], 16)
+
+
+class HashRing:
+    """
+    Consistent hashing of cameras to workers.
+    A camera moves to another worker only while its own worker is down.
+    """
+
+    def __init__(self, nodes, replicas=64):
+        self.__ring = sorted((hash_key(f'{node}:{i}'), node) for node in nodes for i in range(replicas))
+        self.__hashes = [h for h, _ in self.__ring]
+
+    def get(self, key, alive=None):
+        """
+        :param alive:
+            callable telling whether a node can be used, first usable node clockwise is returned
+        :return:
+            node or None if no node is alive
+        """
+        start = bisect(self.__hashes, hash_key(key))
+        for i in range(len(self.__ring)):
+            node = self.__ring[(start + i) % len(self.__ring)][1]
+            if alive is None or alive(node):
+                return node
+        return None
+
+
+def worker_argv(argv, index, count, port):
+    """
+    Command line of a worker made of the dispatcher command line
+    """
+    result = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg in DISPATCHER_OPTIONS:
+            skip = True
+        elif arg.split('=', 1)[0] not in DISPATCHER_OPTIONS:
+            result.append(arg)
+    return result + ['--host', '127.0.0.1', '--port', str(port),
+                     '--worker-index', str(index), '--workers', str(count)]
+
+
+def merge_metrics(texts):
+    """
+    Joins Prometheus text format of workers, every sample gets worker label
+    :param texts:
+        dict {worker index: metrics text}
+    """
+    families = OrderedDict()
+    for index, text in texts.items():
+        family = None
+        for line in text.splitlines():
+            if line.startswith('# HELP '):
+                family = families.setdefault(line.split(' ', 3)[2], [line, None, []])
+            elif line.startswith('# TYPE '):
+                family = families.setdefault(line.split(' ', 3)[2], [None, line, []])
+                family[1] = line
+            elif line and family is not None:
+                name, _, rest = line.partition(' ')
+                if '{' in name:
+                    name = name.replace('{', '{worker="%s",' % index, 1)
+                else:
+                    name += format_labels(('worker',), (index,))
+                family[2].append(f'{name} {rest}')
+
+    lines = []
+    for help_line, type_line, samples in families.values():
+        lines.extend(line for line in (help_line, type_line) if line is not None)
+        lines.extend(samples)
+    return '\n'.join(lines) + '\n'
+
+
+class WorkerProcess:
+    """
+    Media server subprocess restarted with exponential backoff when it dies.
+    A started worker is ready once its own /ready answers, until then it is not listening yet.
+    """
+
+    def __init__(self, index, port, argv, restarts_metric, min_backoff=1, max_backoff=60, ready_poll_interval=0.2):
+        self.index = index
+        self.port = port
+        self.process = None
+        self.started = None
+        self.__argv = argv
+        self.__ready_poll_interval = ready_poll_interval
+        self.__ready = None
+        self.__session = None
+        self.__restarts = restarts_metric.labels(index)
+        self.__min_backoff = min_backoff
+        self.__max_backoff = max_backoff
+        self.__task = None
+        self.__closing = False
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.returncode is None
+
+    @property
+    def ready(self):
+        return self.alive and self.__ready is not None and self.__ready.is_set()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.port}'
+
+    def start(self, session):
+        self.__session = session
+        self.__task = asyncio.ensure_future(self.__run())
+
+    async def wait_ready(self, timeout):
+        """
+        :return:
+            whether the worker became ready in timeout seconds
+        """
+        if self.ready:
+            return True
+        if self.__ready is None:
+            self.__ready = asyncio.Event()
+        try:
+            await asyncio.wait_for(self.__ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return self.alive
+
+    async def close(self, timeout=10):
+        self.__closing = True
+        if self.__task is not None:
+            self.__task.cancel()
+        if self.alive:
+            self.process.terminate()
+            try:
+                await asyncio.wait_for(self.process.wait(), timeout)
+            except asyncio.TimeoutError:
+                self.process.kill()
+                await self.process.wait()
+
+    async def __run(self):
+        backoff = self.__min_backoff
+        while not self.__closing:
+            if self.__ready is None:
+                self.__ready = asyncio.Event()
+            self.__ready.clear()
+            self.process = await asyncio.create_subprocess_exec(sys.executable, *self.__argv)
+            self.started = monotonic()
+            logger.info(f'Started worker {self.index} on port {self.port}, pid {self.process.pid}')
+            polling = asyncio.ensure_future(self.__poll_ready())
+            try:
+                code = await self.process.wait()
+            finally:
+                polling.cancel()
+            self.__ready.clear()
+            if self.__closing:
+                break
+
+            # a worker that ran for a while is restarted right away, a crashing one less and less often
+            if monotonic() - self.started > self.__max_backoff:
+                backoff = self.__min_backoff
+            logger.warning(f'Worker {self.index} exited with code {code}, restarting in {backoff}s')
+            self.__restarts.inc()
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, self.__max_backoff)
+
+    async def __poll_ready(self):
+        while self.alive:
+            try:
+                async with self.__session.get(self.url + '/ready', timeout=aiohttp.ClientTimeout(total=5)) as r:
+                    if r.status == 200:
+                        logger.info(f'Worker {self.index} is ready in {monotonic() - self.started:.1f}s')
+                        self.__ready.set()
+                        return
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                pass
+            await asyncio.sleep(self.__ready_poll_interval)
+
+
+class WorkerDispatcher:
+    """
+    Front server of worker mode.
+    Runs workers media servers on internal ports and proxies requests to them.
+    Requests about a camera go to the worker owning the camera by consistent hashing,
+    so every camera source and its fan-out live in exactly one process.
+    Other requests are spread over workers round robin, /metrics and /ready of all workers are merged.
+    A request to a worker that is starting waits up to ready_timeout seconds until it listens.
+    """
+
+    def __init__(self, script, argv, workers, base_port, ready_timeout=30):
+        self.__registry = Registry()
+        restarts = Counter('worker_restarts_total', 'Worker processes restarted after exit', ['worker'],
+                           registry=self.__registry)
+        Gauge('workers_alive', 'Running worker processes', registry=self.__registry,
+              function=lambda: sum(1 for w in self.__workers if w.alive))
+        Gauge('workers_ready', 'Worker processes answering requests', registry=self.__registry,
+              function=lambda: sum(1 for w in self.__workers if w.ready))
+        self.__ready_timeout = ready_timeout
+        self.__workers = [WorkerProcess(i, base_port + i, [script] + worker_argv(argv, i, workers, base_port + i),
+                                        restarts)
+                          for i in range(workers)]
+        self.__ring = HashRing(range(workers))
+        self.__next = 0
+        self.__session = None
+
+    def create_app(self):
+        app = web.Application()
+        app.router.add_get('/metrics', self.metrics)
+        app.router.add_get('/ready', self.ready)
+        app.router.add_route('*', '/{path:.*}', self.proxy)
+        app.on_startup.append(self.on_startup)
+        app.on_shutdown.append(self.on_shutdown)
+        return app
+
+    async def on_startup(self, app):
+        self.__session = aiohttp.ClientSession(auto_decompress=False,
+                                               timeout=aiohttp.ClientTimeout(total=None, sock_connect=5))
+        for worker in self.__workers:
+            worker.start(self.__session)
+
+    async def on_shutdown(self, app):
+        await asyncio.gather(*(worker.close() for worker in self.__workers))
+        await self.__session.close()
+
+    def worker_for(self, path):
+        """
+        :return:
+            WorkerProcess serving request path or None if all workers are down
+        """
+        segments = path.strip('/').split('/')
+        if len(segments) >= 2 and segments[0] in CAMERA_ROUTES:
+            index = self.__ring.get(segments[1], alive=lambda i: self.__workers[i].alive)
+            return self.__workers[index] if index is not None else None
+
+        # a worker that is starting is used only when no worker is ready
+        for usable in (lambda w: w.ready, lambda w: w.alive):
+            for _ in range(len(self.__workers)):
+                worker = self.__workers[self.__next]
+                self.__next = (self.__next + 1) % len(self.__workers)
+                if usable(worker):
+                    return worker
+        return None
+
+    async def proxy(self, request):
+        worker = self.worker_for(request.path)
+        if worker is None:
+            raise web.HTTPServiceUnavailable(headers={'Retry-After': '5'}, text='No media server worker is running')
+
+        if not await worker.wait_ready(self.__ready_timeout):
+            raise web.HTTPServiceUnavailable(headers={'Retry-After': '5'}, text=f'Worker {worker.index} is not ready')
+
+        url = worker.url + request.path_qs
+        if request.headers.get('Upgrade', '').lower() == 'websocket':
+            return await self.__proxy_websocket(request, url)
+
+        headers = CIMultiDict((k, v) for k, v in request.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS)
+        headers['X-Forwarded-For'] = request.remote or ''
+        data = await request.read()
+        deadline = monotonic() + self.__ready_timeout
+        backoff = 0.1
+        while True:
+            try:
+                async with self.__session.request(request.method, url, headers=headers, data=data) as response:
+                    body = await response.read()
+                break
+            except aiohttp.ClientConnectorError as e:
+                # nothing was sent, the worker is restarting or not listening yet
+                if monotonic() + backoff > deadline:
+                    raise web.HTTPServiceUnavailable(headers={'Retry-After': '1'},
+                                                     text=f'Worker {worker.index} failed: {e}')
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 1)
+                await worker.wait_ready(max(0, deadline - monotonic()))
+            except aiohttp.ClientError as e:
+                raise web.HTTPServiceUnavailable(headers={'Retry-After': '1'},
+                                                 text=f'Worker {worker.index} failed: {e}')
+
+        headers = CIMultiDict((k, v) for k, v in response.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS)
+        return web.Response(status=response.status, body=body, headers=headers)
+
+    async def metrics(self, request):
+        workers = [worker for worker in self.__workers if worker.ready]
+        responses = await asyncio.gather(*(self.__get_text(worker.url + '/metrics') for worker in workers),
+                                         return_exceptions=True)
+        texts = {worker.index: text for worker, text in zip(workers, responses) if isinstance(text, str)}
+        return web.Response(text=self.__registry.render() + merge_metrics(texts),
+                            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+    async def ready(self, request):
+        async def worker_status(worker):
+            status = {'worker': worker.index, 'pid': worker.process.pid if worker.process else None,
+                      'alive': worker.alive, 'ready': worker.ready}
+            if worker.ready:
+                try:
+                    async with self.__session.get(worker.url + '/ready', timeout=aiohttp.ClientTimeout(total=5)) as r:
+                        status.update(await r.json())
+                except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+                    status['ready'] = False
+            return status
+
+        statuses = await asyncio.gather(*(worker_status(worker) for worker in self.__workers))
+        # the server is ready when every camera can be served
+        return web.json_response({'workers': statuses}, status=200 if all(s['ready'] for s in statuses) else 503,
+                                 headers={'Access-Control-Allow-Origin': '*'})
+
+    async def __get_text(self, url):
+        async with self.__session.get(url, timeout=aiohttp.ClientTimeout(total=5)) as response:
+            return await response.text()
+
+    async def __proxy_websocket(self, request, url):
+        # connect to worker first, so its refusal (e.g. unknown camera) reaches the client as is
+        try:
+            upstream = await self.__session.ws_connect(url)
+        except aiohttp.WSServerHandshakeError as e:
+            return web.Response(status=e.status, text=e.message)
+        except aiohttp.ClientError as e:
+            raise web.HTTPServiceUnavailable(headers={'Retry-After': '1'}, text=f'Can not connect to worker: {e}')
+
+        ws = web.WebSocketResponse(heartbeat=30)
+        await ws.prepare(request)
+
+        async def forward(source, destination):
+            async for message in source:
+                if message.type == aiohttp.WSMsgType.TEXT:
+                    await destination.send_str(message.data)
+                elif message.type == aiohttp.WSMsgType.BINARY:
+                    await destination.send_bytes(message.data)
+                else:
+                    break
+
+        tasks = [asyncio.ensure_future(forward(ws, upstream)), asyncio.ensure_future(forward(upstream, ws))]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await upstream.close()
+            await ws.close()
+        return ws
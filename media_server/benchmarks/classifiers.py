@@ -0,0 +1,195 @@
+"""
+Compares classifier backends on a fixed local image set.
+
+Every backend runs in its own process, so its memory and cpu are measured alone.
+Reports model load time, single frame latency, batch throughput, cpu milliseconds per image,
+peak resident memory and, with --ground-truth, top-1 and top-3 accuracy.
+
+    $ python benchmarks/classifiers.py --images ~/imagenet-sample --ground-truth ~/imagenet-sample/labels.csv \
+        --backend resnet50 --backend mobilenet_v2 \
+        --backend tflite=mobilenet_v2_int8.tflite --backend onnx=mobilenet_v2_int8.onnx --labels imagenet.txt
+
+Ground truth is a csv of "file name,class name" lines, class names as the backends report them.
+"""
+import argparse
+import csv
+import json
+import os
+import resource
+import subprocess
+import sys
+from datetime import datetime
+from time import perf_counter, process_time
+
+import av
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Classifier import CLASSIFIERS, PREPROCESSING, create_classifier
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description="Classifier backends benchmark")
+    parser.add_argument("--backend", action="append",
+                        help="Backend to measure as name or name=model file, may be repeated, "
+                             f"names: {', '.join(CLASSIFIERS)} (default: resnet50)")
+    parser.add_argument("--labels", help="Class names of tflite and onnx models, one per line")
+    parser.add_argument("--preprocessing", choices=sorted(PREPROCESSING),
+                        help="Input normalization of tflite and onnx models (default: backend default)")
+    parser.add_argument("--images", help="Directory of images, synthetic camera frames if not set")
+    parser.add_argument("--ground-truth", help="Csv of image file name and expected class name")
+    parser.add_argument("--synthetic-images", type=int, default=32,
+                        help="Number of synthetic frames without --images (default: 32)")
+    parser.add_argument("--batch-size", type=int, default=8, help="Frames of one model call (default: 8)")
+    parser.add_argument("--threads", type=int, default=1, help="Threads of tflite and onnx model (default: 1)")
+    parser.add_argument("--iterations", type=int, default=3, help="Passes over the image set (default: 3)")
+    parser.add_argument("--warmup", type=int, default=5,
+                        help="Untimed single frame calls before measuring (default: 5)")
+    parser.add_argument("--output", default="classifiers.json", help="Results file (default: classifiers.json)")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def load_images(directory, count):
+    """
+    :return:
+        list of (name, av.VideoFrame) in yuv420p like decoded camera frames
+    """
+    if directory is None:
+        # the same frames on every run and in every backend process
+        rng = np.random.default_rng(0)
+        frames = []
+        for i in range(count):
+            rgb = rng.integers(0, 256, (720, 1280, 3), dtype=np.uint8)
+            frame = av.VideoFrame.from_ndarray(rgb, format='rgb24').reformat(format='yuv420p')
+            frames.append((f'synthetic{i}', frame))
+        return frames
+
+    frames = []
+    for name in sorted(os.listdir(directory)):
+        if name.lower().endswith(IMAGE_EXTENSIONS):
+            with av.open(os.path.join(directory, name)) as container:
+                frame = next(container.decode(video=0))
+            frames.append((name, frame.reformat(format='yuv420p')))
+    if not frames:
+        raise SystemExit(f'No images in {directory}')
+    return frames
+
+
+def read_ground_truth(path):
+    with open(path, newline='', encoding='utf-8') as f:
+        return {row[0]: row[1].strip() for row in csv.reader(f) if len(row) >= 2}
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+
+def measure(args, backend):
+    """
+    Runs in a worker process
+    """
+    name, _, model_path = backend.partition('=')
+    images = load_images(args.images, args.synthetic_images)
+    frames = [frame for _, frame in images]
+
+    started = perf_counter()
+    classifier = create_classifier(name, model_path or None, args.labels, args.preprocessing,
+                                   batch_size=args.batch_size, threads=args.threads).load()
+    load_seconds = perf_counter() - started
+
+    # graph building and allocator growth of the first calls are not what a running server sees
+    for frame in frames[:args.warmup]:
+        classifier.classify([frame])
+    classifier.classify(frames[:args.batch_size])
+
+    latencies = []
+    for frame in frames:
+        started = perf_counter()
+        classifier.classify([frame])
+        latencies.append((perf_counter() - started) * 1000)
+
+    predictions = []
+    started, cpu_started = perf_counter(), process_time()
+    for i in range(args.iterations):
+        for offset in range(0, len(frames), args.batch_size):
+            top = classifier.classify(frames[offset:offset + args.batch_size], top=3)
+            if i == 0:
+                predictions += top
+    elapsed, cpu = perf_counter() - started, process_time() - cpu_started
+    classified = args.iterations * len(frames)
+
+    result = {
+        'backend': backend,
+        'input': classifier.spec.to_json(),
+        'load_seconds': load_seconds,
+        'latency_ms': {'p50': percentile(latencies, 50), 'p95': percentile(latencies, 95)},
+        'images_per_second': classified / elapsed,
+        'cpu_ms_per_image': cpu / classified * 1000,
+        # kilobytes on linux
+        'max_rss_mib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+    if args.ground_truth:
+        truth = read_ground_truth(args.ground_truth)
+        scored = [(truth[image], top) for (image, _), top in zip(images, predictions) if image in truth]
+        if scored:
+            result['accuracy'] = {
+                'images': len(scored),
+                'top1': sum(top[:1] == [label] for label, top in scored) / len(scored),
+                'top3': sum(label in top for label, top in scored) / len(scored),
+            }
+    return result
+
+
+def run_worker(args, backend):
+    """
+    :return:
+        result of backend measured in a new process, or dict with error
+    """
+    argv = [sys.executable, os.path.abspath(__file__), '--worker', backend]
+    for option in ('labels', 'preprocessing', 'images', 'ground_truth'):
+        if getattr(args, option) is not None:
+            argv += [f'--{option.replace("_", "-")}', getattr(args, option)]
+    argv += ['--synthetic-images', str(args.synthetic_images), '--batch-size', str(args.batch_size),
+             '--threads', str(args.threads), '--iterations', str(args.iterations), '--warmup', str(args.warmup)]
+    process = subprocess.run(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if process.returncode != 0:
+        lines = process.stderr.strip().splitlines()
+        return {'backend': backend, 'error': lines[-1] if lines else f'exit code {process.returncode}'}
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def main():
+    args = get_arguments()
+    if args.worker is not None:
+        print(json.dumps(measure(args, args.worker)))
+        return
+
+    results = []
+    print(f'{"backend":>24} {"load s":>8} {"p50 ms":>8} {"p95 ms":>8} {"img/s":>8} {"cpu ms":>8} '
+          f'{"MiB":>8} {"top1":>6}')
+    for backend in args.backend or ['resnet50']:
+        result = run_worker(args, backend)
+        results.append(result)
+        if 'error' in result:
+            print(f'{backend:>24} failed: {result["error"]}')
+            continue
+        top1 = result.get('accuracy', {}).get('top1')
+        print(f'{backend:>24} {result["load_seconds"]:>8.1f} {result["latency_ms"]["p50"]:>8.1f} '
+              f'{result["latency_ms"]["p95"]:>8.1f} {result["images_per_second"]:>8.1f} '
+              f'{result["cpu_ms_per_image"]:>8.1f} {result["max_rss_mib"]:>8.0f} '
+              f'{"-" if top1 is None else f"{top1:.3f}":>6}')
+
+    with open(args.output, 'w') as f:
+        json.dump({'date': datetime.now().isoformat(timespec='seconds'),
+                   'config': {k: v for k, v in vars(args).items() if k not in ('output', 'worker')},
+                   'results': results}, f, indent=2)
+    print(f'Results saved to {args.output}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+"""
+Load test of the media server without network access.
+
+Generates a synthetic video file, serves it to the server through a stub NVR camera list,
+runs WebRTCStreamingServer.py and connects headless aiortc viewers through /media/{id}.
+Viewers decode video in this process, keep that in mind when reading server cpu.
+
+    $ python benchmarks/load_test.py --viewers 20 --cameras 4 --duration 30 --output load_test.json
+    $ python benchmarks/load_test.py --source rtsp://127.0.0.1:8554/test --server-arg=--workers=2
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+from datetime import datetime
+from time import monotonic, perf_counter
+
+import aiohttp
+import av
+import numpy as np
+from aiohttp import web
+from aiortc import RTCPeerConnection, RTCSessionDescription
+from aiortc.mediastreams import MediaStreamError
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER = os.path.join(SERVER_DIR, 'WebRTCStreamingServer.py')
+# ffmpeg message printed when the server can not keep up with rtsp sources
+RTP_LATE_MESSAGE = 'dropping old packet received too late'
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description="Media server load test")
+    parser.add_argument("--viewers", type=int, default=10, help="Number of WebRTC viewers (default: 10)")
+    parser.add_argument("--cameras", type=int, default=2, help="Number of cameras viewers are spread over (default: 2)")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds of measurement (default: 30)")
+    parser.add_argument("--warmup", type=float, default=5,
+                        help="Seconds between the last viewer connected and measurement start (default: 5)")
+    parser.add_argument("--connect-interval", type=float, default=0.1,
+                        help="Seconds between viewer connections (default: 0.1)")
+    parser.add_argument("--width", type=int, default=1280, help="Synthetic video width (default: 1280)")
+    parser.add_argument("--height", type=int, default=720, help="Synthetic video height (default: 720)")
+    parser.add_argument("--fps", type=int, default=25, help="Synthetic video fps (default: 25)")
+    parser.add_argument("--source", help="Url of cameras instead of synthetic video, e.g. local rtsp server")
+    parser.add_argument("--port", type=int, default=8190,
+                        help="Server port, in worker mode workers use the next ports (default: 8190)")
+    parser.add_argument("--nvr-port", type=int, default=8189, help="Stub NVR port (default: 8189)")
+    parser.add_argument("--server-arg", action="append", default=[],
+                        help="Extra server argument, may be repeated, e.g. --server-arg=--model-load=first-use")
+    parser.add_argument("--output", default="load_test.json", help="Results file (default: load_test.json)")
+    return parser.parse_args()
+
+
+def make_video(path, width, height, fps, seconds):
+    """
+    Moving color bars, h264 with a keyframe every 2 seconds like cameras send
+    """
+    container = av.open(path, 'w')
+    stream = container.add_stream('libx264', rate=fps)
+    stream.width, stream.height, stream.pix_fmt = width, height, 'yuv420p'
+    stream.options = {'preset': 'ultrafast', 'g': str(2 * fps)}
+    bars = np.zeros((height, width, 3), dtype=np.uint8)
+    bars[:] = (np.arange(width) * 255 // width)[None, :, None]
+    bars[:, :, 1] = np.arange(height)[:, None] * 255 // height
+    for i in range(int(seconds * fps)):
+        frame = av.VideoFrame.from_ndarray(np.roll(bars, i * 8, axis=1), format='rgb24')
+        for packet in stream.encode(frame):
+            container.mux(packet)
+    for packet in stream.encode():
+        container.mux(packet)
+    container.close()
+
+
+async def start_nvr(port, cams):
+    async def sources(request):
+        return web.json_response(cams)
+
+    app = web.Application()
+    app.router.add_get('/api/sources/', sources)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+    return runner
+
+
+def process_cpu_seconds(pid):
+    """
+    :return:
+        user + system cpu seconds of process and its children workers, None if /proc is not available
+    """
+    pids = [pid]
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            pids += [int(p) for p in f.read().split()]
+    except OSError:
+        pass
+
+    total = 0
+    for p in pids:
+        try:
+            with open(f'/proc/{p}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            if p == pid:
+                return None
+            continue
+        total += int(fields[11]) + int(fields[12])
+    return total / os.sysconf('SC_CLK_TCK')
+
+
+def metric_total(text, name):
+    """
+    Sum of all samples of a Prometheus text format metric
+    """
+    total = 0
+    for line in text.splitlines():
+        sample, _, value = line.rpartition(' ')
+        if sample == name or sample.startswith(name + '{'):
+            total += float(value)
+    return total
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+
+class Viewer:
+    def __init__(self, cam_id):
+        self.cam_id = cam_id
+        self.pc = None
+        self.offer_ms = None
+        self.first_frame_ms = None
+        self.frames = 0
+        # how far the stream timeline ran ahead of the wall clock, a browser plays out that much behind live
+        self.playout_lag_ms = None
+        self.error = None
+        self.__first_frame = asyncio.get_event_loop().create_future()
+
+    async def connect(self, session, url, timeout=30):
+        started = perf_counter()
+        self.pc = RTCPeerConnection()
+        self.pc.addTransceiver('video', direction='recvonly')
+        self.pc.on('track', lambda track: asyncio.ensure_future(self.__read(track, started)))
+        try:
+            await self.pc.setLocalDescription(await self.pc.createOffer())
+            async with session.post(url, json={'sdp': self.pc.localDescription.sdp,
+                                               'type': self.pc.localDescription.type}) as response:
+                if response.status != 200:
+                    raise RuntimeError(f'offer failed with {response.status}: {await response.text()}')
+                answer = await response.json()
+            self.offer_ms = (perf_counter() - started) * 1000
+            await self.pc.setRemoteDescription(RTCSessionDescription(sdp=answer['sdp'], type=answer['type']))
+            await asyncio.wait_for(self.__first_frame, timeout)
+        except Exception as e:
+            self.error = str(e) or type(e).__name__
+
+    async def close(self):
+        if self.pc is not None:
+            await self.pc.close()
+
+    async def __read(self, track, started):
+        first = None
+        while True:
+            try:
+                frame = await track.recv()
+            except MediaStreamError:
+                return
+            now = perf_counter()
+            if not self.__first_frame.done():
+                self.first_frame_ms = (now - started) * 1000
+                self.__first_frame.set_result(None)
+            self.frames += 1
+
+            # frame pts is the RTP timestamp of the sender
+            if first is None:
+                first = (now, frame.pts)
+            else:
+                lag = (float((frame.pts - first[1]) * frame.time_base) - (now - first[0])) * 1000
+                self.playout_lag_ms = max(lag, self.playout_lag_ms or 0)
+
+
+async def wait_ready(session, url, process, timeout=60):
+    """
+    Waits until the server, and in worker mode every worker, answers /ready
+    """
+    deadline = monotonic() + timeout
+    while monotonic() < deadline:
+        if process.returncode is not None:
+            raise RuntimeError(f'Server exited with code {process.returncode}')
+        try:
+            async with session.get(url) as response:
+                if response.status == 200:
+                    status = await response.json()
+                    if all(worker.get('ready') for worker in status.get('workers', ())):
+                        return
+        except (aiohttp.ClientError, ValueError):
+            pass
+        await asyncio.sleep(0.5)
+    raise RuntimeError('Server did not start')
+
+
+async def run(args, workdir):
+    seconds = args.warmup + args.duration + args.viewers * args.connect_interval + 30
+    source = args.source
+    if source is None:
+        source = os.path.join(workdir, 'synthetic.mp4')
+        print(f'Generating {seconds:.0f}s of {args.width}x{args.height}@{args.fps} video')
+        make_video(source, args.width, args.height, args.fps, seconds)
+
+    cams = [{'id': f'load{i}', 'name': f'load test {i}', 'rtsp': source} for i in range(args.cameras)]
+    nvr = await start_nvr(args.nvr_port, cams)
+    log_path = os.path.join(workdir, 'server.log')
+    log = open(log_path, 'w')
+    server = await asyncio.create_subprocess_exec(
+        sys.executable, SERVER, '--host', '127.0.0.1', '--port', str(args.port), '--nvr-token', 'load-test',
+        '--nvr-url', f'http://127.0.0.1:{args.nvr_port}/api/sources/', *args.server_arg,
+        cwd=SERVER_DIR, stdout=log, stderr=log)
+    base_url = f'http://127.0.0.1:{args.port}'
+    viewers = []
+    try:
+        async with aiohttp.ClientSession() as session:
+            await wait_ready(session, base_url + '/ready', server)
+
+            print(f'Connecting {args.viewers} viewers to {args.cameras} cameras')
+            connecting = []
+            for i in range(args.viewers):
+                viewer = Viewer(cams[i % len(cams)]['id'])
+                viewers.append(viewer)
+                connecting.append(asyncio.ensure_future(viewer.connect(session, f'{base_url}/media/{viewer.cam_id}')))
+                await asyncio.sleep(args.connect_interval)
+            await asyncio.gather(*connecting)
+            await asyncio.sleep(args.warmup)
+
+            print(f'Measuring for {args.duration}s')
+            async with session.get(base_url + '/metrics') as response:
+                metrics_before = await response.text()
+            cpu_before = process_cpu_seconds(server.pid)
+            frames_before = [viewer.frames for viewer in viewers]
+            started = monotonic()
+            await asyncio.sleep(args.duration)
+            elapsed = monotonic() - started
+            frames = [viewer.frames - before for viewer, before in zip(viewers, frames_before)]
+            cpu_after = process_cpu_seconds(server.pid)
+            async with session.get(base_url + '/metrics') as response:
+                metrics_after = await response.text()
+    finally:
+        await asyncio.gather(*(viewer.close() for viewer in viewers))
+        if server.returncode is None:
+            server.terminate()
+            await server.wait()
+        log.close()
+        await nvr.cleanup()
+
+    connected = [viewer for viewer in viewers if viewer.error is None]
+    fps = [f / elapsed for viewer, f in zip(viewers, frames) if viewer.error is None]
+    first_frame = [viewer.first_frame_ms for viewer in connected]
+    playout_lag = [viewer.playout_lag_ms for viewer in connected if viewer.playout_lag_ms is not None]
+    cpu_cores = (cpu_after - cpu_before) / elapsed if cpu_before is not None and cpu_after is not None else None
+
+    def delta(name):
+        return (metric_total(metrics_after, name) - metric_total(metrics_before, name)) / elapsed
+
+    with open(log_path) as f:
+        rtp_late = sum(line.count(RTP_LATE_MESSAGE) for line in f)
+
+    return {
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'config': {k: v for k, v in vars(args).items() if k != 'output'},
+        'viewers': {
+            'connected': len(connected),
+            'failed': len(viewers) - len(connected),
+            'errors': sorted({viewer.error for viewer in viewers if viewer.error is not None}),
+            'offer_ms': {'p50': percentile([v.offer_ms for v in connected], 50),
+                         'p95': percentile([v.offer_ms for v in connected], 95)},
+            'offer_to_first_frame_ms': {'p50': percentile(first_frame, 50), 'p95': percentile(first_frame, 95),
+                                        'max': max(first_frame, default=None)},
+            'fps': {'mean': sum(fps) / len(fps) if fps else None, 'p5': percentile(fps, 5),
+                    'min': min(fps, default=None)},
+            # about a GOP means new viewers were primed with old timestamps and play behind live
+            'playout_lag_ms': {'p50': percentile(playout_lag, 50), 'max': max(playout_lag, default=None)},
+        },
+        'server': {
+            'cpu_cores': cpu_cores,
+            'cpu_cores_per_viewer': cpu_cores / len(connected) if cpu_cores is not None and connected else None,
+            'source_fps': delta('camera_source_frames_total'),
+            'frames_dropped_per_second': delta('viewer_frames_dropped_total'),
+            'rtp_late_packets': rtp_late,
+            'event_loop_lag_seconds_mean': (
+                (metric_total(metrics_after, 'event_loop_lag_seconds_sum')
+                 - metric_total(metrics_before, 'event_loop_lag_seconds_sum'))
+                / max(1, metric_total(metrics_after, 'event_loop_lag_seconds_count')
+                      - metric_total(metrics_before, 'event_loop_lag_seconds_count'))),
+        },
+        'inference': {
+            'frames_per_second': delta('inference_batch_size_sum'),
+            'batches_per_second': delta('inference_batch_size_count'),
+            'dropped_per_second': delta('inference_dropped_total'),
+        },
+    }
+
+
+def main():
+    args = get_arguments()
+    with tempfile.TemporaryDirectory(prefix='load_test') as workdir:
+        results = asyncio.run(run(args, workdir))
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps({k: results[k] for k in ('viewers', 'server', 'inference')}, indent=2))
+    print(f'Results saved to {args.output}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+Compares classification preprocessing paths on synthetic camera frames.
+Every path runs in its own process, memory is the growth of its peak resident set,
+which includes libav buffers tracemalloc does not see.
+
+    $ python benchmarks/preprocess.py --iterations 50
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+from time import perf_counter
+
+import av
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Classifier import FramePreprocessor, IMAGENET_BGR_MEAN
+
+RESOLUTIONS = {
+    '1080p': (1920, 1080),
+    '4K': (3840, 2160),
+}
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description="Classification preprocessing benchmark")
+    parser.add_argument("--iterations", type=int, default=50, help="Frames per resolution (default: 50)")
+    parser.add_argument("--batch-size", type=int, default=8, help="Preprocessor batch size (default: 8)")
+    return parser.parse_args()
+
+
+def make_frame(width, height):
+    # cameras are decoded to yuv420p, start from the same format
+    rgb = np.random.randint(0, 256, (height, width, 3), dtype=np.uint8)
+    return av.VideoFrame.from_ndarray(rgb, format='rgb24').reformat(format='yuv420p')
+
+
+def pil_path():
+    try:
+        from tensorflow.keras.preprocessing import image
+        from tensorflow.keras.applications.resnet50 import preprocess_input
+        img_to_array = image.img_to_array
+        name = 'pil+keras'
+    except ImportError:
+        # the same steps keras does, when tensorflow is not installed
+        def img_to_array(im):
+            return np.asarray(im, dtype=np.float32)
+
+        def preprocess_input(x):
+            x = x[..., ::-1]
+            return x - IMAGENET_BGR_MEAN
+        name = 'pil+numpy'
+
+    def run(frame):
+        im = frame.to_image()
+        im = im.resize((224, 224))
+        x = img_to_array(im)
+        x = np.expand_dims(x, axis=0)
+        return preprocess_input(x)
+
+    return name, run
+
+
+def current_rss_mib():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+
+
+def reset_peak_rss():
+    """
+    Makes peak resident memory start from the current one, so the test frame creation is not counted
+    :return:
+        False if the kernel does not support it
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mib():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def paths(batch_size):
+    preprocessor = FramePreprocessor(batch_size)
+    return [pil_path(), ('libav', lambda frame: preprocessor([frame]))]
+
+
+def measure(index, width, height, batch_size, iterations):
+    """
+    Runs in a new process
+    :return:
+        path name, milliseconds per frame and growth of peak resident memory in MiB
+    """
+    name, run = paths(batch_size)[index]
+    frame = make_frame(width, height)
+    baseline = current_rss_mib() if reset_peak_rss() else peak_rss_mib()
+    run(frame)
+    started = perf_counter()
+    for _ in range(iterations):
+        run(frame)
+    elapsed = perf_counter() - started
+    return name, elapsed / iterations * 1000, peak_rss_mib() - baseline
+
+
+def main():
+    args = get_arguments()
+    context = multiprocessing.get_context('spawn')
+
+    print(f'{"input":>6} {"path":>10} {"ms/frame":>10} {"peak MiB":>10}')
+    for resolution, (width, height) in RESOLUTIONS.items():
+        for index in range(len(paths(args.batch_size))):
+            with context.Pool(1) as pool:
+                name, ms, peak = pool.apply(measure, (index, width, height, args.batch_size, args.iterations))
+            print(f'{resolution:>6} {name:>10} {ms:>10.2f} {peak:>10.1f}')
+
+
+if __name__ == "__main__":
+    main()
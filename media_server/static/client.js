@@ -75,21 +75,20 @@ function stop() {
     document.getElementById('start').style.display = 'inline-block';
 }
 
-var classify_obj;
+var labels_ws = null;
 
 function classify() {
-    var url = "https://media.auditory.ru:443/classify/" + document.getElementById('cams').value.toString();
-    classify_obj = setInterval(function() {
-            const Http = new XMLHttpRequest();
-            Http.open("POST", url);
-            Http.send();
-            Http.onload = () => {
-                console.log(Http.responseText);
-            }
-    }, 1000);
+    var url = "wss://media.auditory.ru:443/labels/" + document.getElementById('cams').value.toString();
+    labels_ws = new WebSocket(url);
+    labels_ws.onmessage = function(evt) {
+        console.log(JSON.parse(evt.data).labels);
+    };
 }
 
 function stopClassify() {
     console.log('Stop classify');
-    clearInterval(classify_obj);
+    if (labels_ws) {
+        labels_ws.close();
+        labels_ws = null;
+    }
 }